@@ -0,0 +1,266 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Processing of many IMAP accounts in a single imapproc process.
+
+The accounts are read from an INI style accounts file with one section per
+account. Every scan of an account is a cycle of its own: a new
+ImapProcessor is created, the account's rc file is run with it in a fresh
+namespace, and the processor is discarded again once the rc file is done.
+Between cycles, an account only takes up its entry in the scheduler, so
+memory use depends on the number of accounts being scanned at the same
+time rather than on the number of accounts.
+"""
+
+import configparser
+import locale
+import os
+import subprocess
+import threading
+
+from mailprocessing.processor.imap import ImapProcessor
+
+from mailprocessing.util import iso_8601_now
+from mailprocessing.util import password_from_command
+from mailprocessing.util import safe_write
+
+# Settings an account section may contain.
+KEYS = ('cache_file', 'folders', 'host', 'interval', 'password',
+        'password_command', 'port', 'rcfile', 'use_ssl', 'user')
+
+_rcfile_lock = threading.Lock()
+_rcfiles = {}
+
+
+class Account(object):
+    """
+    An IMAP account processed by the multi-account daemon. Calling it runs
+    one cycle. processor_kwargs are the keyword arguments for ImapProcessor
+    (without the password if password_command is given); log is the log file
+    shared by all accounts.
+
+    If leases is set to a lease.LeaseManager, a cycle is only run while this
+    node holds the account's lease.
+    """
+
+    def __init__(self, name, rcfile, interval, processor_kwargs, log,
+                 password_command=None):
+        self.name = name
+        self.rcfile = rcfile
+        self.interval = interval
+        self.processor_kwargs = processor_kwargs
+        self.log = log
+        self.password_command = password_command
+        self.leases = None
+
+    def __str__(self):
+        return self.name
+
+    def __call__(self):
+        if self.leases is None:
+            self._run_cycle()
+            return
+        with self.leases.holding(self.name) as held:
+            if held:
+                self._run_cycle()
+
+    def log_error(self, text):
+        safe_write(self.log, "[%s] %s" % (self.name, text))
+        self.log.flush()
+
+    # ----------------------------------------------------------------
+
+    def _run_cycle(self):
+        kwargs = dict(self.processor_kwargs)
+
+        if self.password_command is not None:
+            try:
+                kwargs['password'] = password_from_command(
+                    self.password_command)
+            except subprocess.CalledProcessError as e:
+                self.log_error("Error: Password command failed with exit "
+                               "status %d" % e.returncode)
+                return
+            except OSError as e:
+                self.log_error("Error: Could not execute password command "
+                               "%s: %s" % (self.password_command, e))
+                return
+
+        try:
+            code = compile_rcfile(self.rcfile)
+        except IOError as e:
+            self.log_error("Error: Could not open RC file: {0}".format(e))
+            return
+
+        processor = ImapProcessor(self.rcfile, self.log, **kwargs)
+        processor.log("")
+        processor.log("Starting cycle at {0}".format(iso_8601_now()))
+        if "SENDMAIL" in os.environ:
+            processor.sendmail = os.environ["SENDMAIL"]
+        if "SENDMAILFLAGS" in os.environ:
+            processor.sendmail_flags = os.environ["SENDMAILFLAGS"]
+
+        try:
+            exec(code, {"processor": processor})
+        finally:
+            # The rc file may have raised before the processor logged out.
+            processor.close()
+
+
+class SharedLog(object):
+    """
+    The log file all accounts write to. Each line is written in one piece,
+    and reopen() reopens the file only if it has been rotated away, so it
+    can be invoked by every processor seeing SIGHUP.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fp = self._open()
+
+    def write(self, s):
+        with self.lock:
+            self.fp.write(s)
+
+    def flush(self):
+        with self.lock:
+            self.fp.flush()
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def reopen(self):
+        with self.lock:
+            try:
+                current = os.stat(self.path)
+            except OSError:
+                current = None
+            opened = os.fstat(self.fp.fileno())
+            if (current is None or (current.st_dev, current.st_ino) !=
+                    (opened.st_dev, opened.st_ino)):
+                self.fp.close()
+                self.fp = self._open()
+
+    def _open(self):
+        return open(self.path,
+                    "a",
+                    encoding=locale.getpreferredencoding(),
+                    errors="backslashreplace")
+
+
+def compile_rcfile(path):
+    """
+    Returns the code object for the rc file path. Accounts sharing an rc file
+    share its code object, which is only compiled again when the file's
+    modification time changes.
+    """
+    mtime = os.path.getmtime(path)
+    with _rcfile_lock:
+        cached = _rcfiles.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    with open(path) as f:
+        code = compile(f.read(), path, 'exec')
+    with _rcfile_lock:
+        _rcfiles[path] = (mtime, code)
+    return code
+
+
+def read_accounts(path, defaults, processor_kwargs, log,
+                  cache_directory=None):
+    """
+    Reads the accounts file path and returns a list of Accounts. defaults
+    maps the settings in KEYS to the values used for settings an account
+    does not specify. processor_kwargs holds the ImapProcessor keyword
+    arguments common to all accounts. If cache_directory is given, accounts
+    without a cache_file setting cache headers in <NAME>.cache in that
+    directory. Raises ValueError if the file is invalid.
+    """
+
+    parser = configparser.ConfigParser(interpolation=None)
+    try:
+        with open(path) as f:
+            parser.read_file(f)
+    except (IOError, configparser.Error) as e:
+        raise ValueError("Could not read accounts file %s: %s" % (path, e))
+
+    if not parser.sections():
+        raise ValueError("No accounts in accounts file %s" % path)
+
+    accounts = []
+    for name in parser.sections():
+        section = parser[name]
+
+        unknown = [key for key in section if key not in KEYS]
+        if unknown:
+            raise ValueError("Account %s: unknown setting %s" %
+                             (name, ", ".join(unknown)))
+
+        settings = dict(defaults)
+        try:
+            for key in section:
+                if key in ('interval', 'port'):
+                    settings[key] = section.getint(key)
+                elif key == 'use_ssl':
+                    settings[key] = section.getboolean(key)
+                elif key == 'folders':
+                    # One folder per line, so names may contain spaces.
+                    settings[key] = [folder.strip() for folder in
+                                     section[key].splitlines()
+                                     if folder.strip()]
+                else:
+                    settings[key] = section[key]
+        except ValueError as e:
+            raise ValueError("Account %s: %s" % (name, e))
+
+        for key in ('host', 'user', 'rcfile'):
+            if not settings.get(key):
+                raise ValueError("Account %s: no %s given" % (name, key))
+        if bool(settings.get('password')) == \
+           bool(settings.get('password_command')):
+            raise ValueError("Account %s: please specify either password or "
+                             "password_command" % name)
+        if not settings.get('folders'):
+            raise ValueError("Account %s: no folders given" % name)
+
+        rcfile = os.path.expanduser(settings['rcfile'])
+        if rcfile == "-":
+            raise ValueError("Account %s: the rc file cannot be read from "
+                             "standard input" % name)
+
+        kwargs = dict(processor_kwargs)
+        for key in ('folders', 'host', 'interval', 'port', 'use_ssl',
+                    'user'):
+            kwargs[key] = settings[key]
+        if settings.get('password'):
+            kwargs['password'] = settings['password']
+        if settings.get('cache_file'):
+            kwargs['cache_file'] = os.path.expanduser(settings['cache_file'])
+        elif cache_directory is not None:
+            kwargs['cache_file'] = os.path.join(
+                os.path.expanduser(cache_directory), name + '.cache')
+        kwargs['log_prefix'] = "[%s] " % name
+        kwargs['scheduled'] = True
+
+        accounts.append(Account(name, rcfile, settings['interval'], kwargs,
+                                log, settings.get('password_command')))
+
+    return accounts
@@ -0,0 +1,689 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+asyncio based IMAP client.
+
+AsyncImapClient speaks IMAP4rev1 over asyncio streams. Any number of tagged
+commands may be in flight at the same time; responses are matched to their
+commands by tag. ImapClient wraps it in the part of the imaplib.IMAP4
+interface used by ImapProcessor, which lets the processor (and thus the rc
+file) keep its synchronous API while all connections share one event loop.
+"""
+
+import asyncio
+import collections
+import imaplib
+import queue
+import re
+import threading
+
+from mailprocessing import deflate
+from mailprocessing import fetch
+
+# Maximum length of a single response line. UID SEARCH responses for large
+# folders can get quite long.
+MAXLINE = 10 * 1024 * 1024
+
+Literal = re.compile(br'.*\{(?P<size>\d+)\}$')
+Response_code = re.compile(br'\[(?P<type>[A-Z-]+)( (?P<data>.*))?\]')
+Tagged_response = re.compile(
+    br'(?P<tag>[A-Za-z0-9]+) (?P<type>[A-Z]+)( (?P<data>.*))?')
+Untagged_response = re.compile(br'\* (?P<type>[A-Z-]+)( (?P<data>.*))?')
+Untagged_status = re.compile(
+    br'\* (?P<data>\d+) (?P<type>[A-Z-]+)( (?P<data2>.*))?')
+
+# Untagged responses that end an IDLE command. With QRESYNC enabled,
+# expunged messages are reported as VANISHED.
+IDLE_EVENTS = ('EXISTS', 'EXPUNGE', 'FETCH', 'VANISHED')
+
+
+def quote(arg):
+    """
+    Returns arg as an IMAP quoted string.
+    """
+    arg = arg.replace('\\', '\\\\').replace('"', '\\"')
+    return '"' + arg + '"'
+
+
+class AsyncImapClient(object):
+    """
+    An IMAP client built on asyncio streams.
+
+    Every command is sent as soon as it is issued, so running several
+    command() coroutines concurrently pipelines them. Untagged responses are
+    attributed to the oldest command in flight, which is where the server
+    sends them when it processes commands in order.
+    """
+
+    error = imaplib.IMAP4.error
+    abort = imaplib.IMAP4.abort
+
+    def __init__(self, host, port=imaplib.IMAP4_PORT, ssl_context=None):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.capabilities = ()
+        self.state = 'LOGOUT'
+        self.welcome = None
+
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._failure = None
+        self._pending = []
+        self._unsolicited = {}
+        self._continuation = None
+        self._idle_event = None
+        self._tagnum = 0
+        self._compress_tag = None
+        self._inflate_task = None
+
+    async def connect(self):
+        """
+        Opens the connection and reads the server greeting and capabilities.
+        """
+
+        server_hostname = self.host if self.ssl_context is not None else None
+
+        self._reader, self._writer = await asyncio.open_connection(
+            self.host, self.port, ssl=self.ssl_context,
+            server_hostname=server_hostname, limit=MAXLINE)
+
+        greeting = await self._read_response()
+        self.welcome = greeting[0]
+
+        if self.welcome.startswith(b'* PREAUTH'):
+            self.state = 'AUTH'
+        elif self.welcome.startswith(b'* OK'):
+            self.state = 'NONAUTH'
+        else:
+            raise self.error(self.welcome)
+
+        self._read_task = asyncio.ensure_future(self._read_loop())
+
+        typ, data, untagged = await self.command('CAPABILITY')
+        self._update_capabilities(untagged)
+
+    async def command(self, name, *args, on_response=None, sink=None):
+        """
+        Sends command name with arguments args (bytes or str, sent verbatim)
+        and waits for its completion. Returns a (typ, data, untagged) tuple:
+        typ is the completion result ('OK' or 'NO'), data a list holding the
+        tagged response's text and untagged a dict mapping response types to
+        lists of untagged response data in imaplib's format. A BAD completion
+        raises error.
+
+        If given, the callable on_response is invoked in the event loop with
+        the parts of every untagged response to the command (see
+        _read_response()) as it arrives; responses it returns True for are
+        left out of untagged. It is invoked with None once the command is
+        complete or the connection failed.
+
+        If given, the callable sink is passed complete message bodies
+        (BODY[]) in chunks as they are read, which are then left out of the
+        responses (see fetch.read_response()). It is run in the event loop's
+        executor, so it may block.
+        """
+
+        future, untagged = await self._send(name, *args,
+                                            on_response=on_response,
+                                            sink=sink)
+        typ, data = await future
+
+        if typ == 'BAD':
+            raise self.error("%s command error: %s %s" % (name, typ, data))
+
+        return typ, data, untagged
+
+    async def login(self, user, password):
+        """
+        Authenticates with LOGIN. Both user and password are sent as quoted
+        strings, so they may contain spaces and other special characters.
+        """
+
+        typ, data, untagged = await self.command('LOGIN', quote(user),
+                                                 quote(password))
+        if typ != 'OK':
+            raise self.error(data[-1])
+
+        self.state = 'AUTH'
+        self._update_capabilities(untagged)
+
+        return typ, data, untagged
+
+    async def compress(self):
+        """
+        Issues COMPRESS DEFLATE (RFC 4978). The connection is compressed from
+        the server's OK response on.
+        """
+
+        typ, data, untagged = await self.command('COMPRESS', 'DEFLATE')
+        if typ != 'OK':
+            raise self.error(data[-1])
+
+        return typ, data, untagged
+
+    async def idle(self, timeout, interrupted=None):
+        """
+        Issues IDLE (RFC 2177) and waits until the server reports new,
+        expunged or changed messages, timeout seconds pass or the callable
+        interrupted returns True. Returns True if the server reported a change.
+        """
+
+        loop = asyncio.get_event_loop()
+        self._continuation = loop.create_future()
+
+        future, untagged = await self._send('IDLE')
+
+        done, _ = await asyncio.wait([self._continuation, future],
+                                     return_when=asyncio.FIRST_COMPLETED)
+        if self._continuation not in done:
+            # The server refused to IDLE.
+            self._continuation = None
+            await future
+            return False
+
+        self._continuation = None
+        self._idle_event = asyncio.Event()
+        deadline = loop.time() + timeout
+
+        try:
+            while not self._idle_event.is_set():
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                if interrupted is not None and interrupted():
+                    break
+                try:
+                    await asyncio.wait_for(self._idle_event.wait(),
+                                           min(remaining, 1))
+                except asyncio.TimeoutError:
+                    pass
+            changed = self._idle_event.is_set()
+        finally:
+            self._idle_event = None
+
+        self._writer.write(b'DONE\r\n')
+        await self._writer.drain()
+        await future
+
+        return changed
+
+    async def close(self):
+        """
+        Closes the connection without logging out.
+        """
+
+        if self._read_task is not None:
+            self._read_task.cancel()
+            self._read_task = None
+        if self._inflate_task is not None:
+            self._inflate_task.cancel()
+            self._inflate_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self.state = 'LOGOUT'
+
+    # ----------------------------------------------------------------
+
+    async def _send(self, name, *args, on_response=None, sink=None):
+        if self._failure is not None:
+            if on_response is not None:
+                on_response(None)
+            raise self._aborted()
+
+        self._tagnum += 1
+        tag = ('M%d' % self._tagnum).encode('ascii')
+
+        line = tag + b' ' + name.encode('ascii')
+        for arg in args:
+            if arg is None:
+                continue
+            if isinstance(arg, str):
+                arg = arg.encode('utf-8')
+            line += b' ' + arg
+
+        if name == 'COMPRESS':
+            self._compress_tag = tag
+
+        future = asyncio.get_event_loop().create_future()
+        untagged = {}
+        self._pending.append((tag, future, untagged, on_response, sink))
+
+        try:
+            self._writer.write(line + b'\r\n')
+            await self._writer.drain()
+        except OSError as e:
+            self._fail(e)
+
+        return future, untagged
+
+    async def _read_response(self):
+        """
+        Reads one response including all of its literals. Returns a list of
+        its parts in imaplib's format: a line followed by a literal is
+        returned as a (line, literal) tuple, the remainder of the response as
+        plain bytes. Message bodies are passed to the oldest pending
+        command's sink if it has one.
+        """
+
+        parts = []
+
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                raise self.abort("socket error: EOF")
+            if not line.endswith(b'\r\n'):
+                raise self.abort("socket error: unterminated line: %r" % line)
+            line = line[:-2]
+            m = Literal.match(line)
+            if m is None:
+                parts.append(line)
+                return parts
+            size = int(m.group('size'))
+            sink = self._pending[0][4] if self._pending else None
+            if sink is not None and fetch.Body_literal.match(line):
+                loop = asyncio.get_event_loop()
+                while size > 0:
+                    chunk = await self._reader.readexactly(
+                        min(size, fetch.CHUNK_SIZE))
+                    await loop.run_in_executor(None, sink, chunk)
+                    size -= len(chunk)
+                parts.append((line, b''))
+                continue
+            literal = await self._reader.readexactly(size)
+            parts.append((line, literal))
+
+    async def _read_loop(self):
+        try:
+            while True:
+                self._dispatch(await self._read_response())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._fail(e)
+
+    def _dispatch(self, parts):
+        first = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+
+        if first.startswith(b'+'):
+            if self._continuation is not None \
+               and not self._continuation.done():
+                self._continuation.set_result(first)
+            return
+
+        if first.startswith(b'* '):
+            if self._pending:
+                untagged, on_response = self._pending[0][2:4]
+                if on_response is not None and on_response(parts):
+                    return
+            else:
+                untagged = self._unsolicited
+            for typ, data in self._parse_untagged(first, parts):
+                untagged.setdefault(typ, []).append(data)
+                if typ in IDLE_EVENTS and self._idle_event is not None:
+                    self._idle_event.set()
+                if typ == 'BYE':
+                    self.state = 'LOGOUT'
+            return
+
+        m = Tagged_response.match(first)
+        if m is None:
+            raise self.abort("unexpected response: %r" % first)
+
+        for i, (tag, future, untagged, on_response, sink) in \
+                enumerate(self._pending):
+            if tag == m.group('tag'):
+                del self._pending[i]
+                if on_response is not None:
+                    on_response(None)
+                for typ in self._unsolicited:
+                    untagged.setdefault(typ, []).extend(
+                        self._unsolicited[typ])
+                self._unsolicited = {}
+                if tag == self._compress_tag and m.group('type') == b'OK':
+                    self._start_compression()
+                future.set_result((m.group('type').decode('ascii'),
+                                   [m.group('data') or b'']))
+                return
+
+        raise self.abort("unexpected tagged response: %r" % first)
+
+    def _start_compression(self):
+        """
+        Switches to a compressed stream. This happens in the read loop right
+        after the server's OK to COMPRESS, before the next response is read.
+        """
+
+        reader = asyncio.StreamReader(limit=MAXLINE)
+        self._inflate_task = asyncio.ensure_future(
+            deflate.inflate_stream(self._reader, reader))
+        self._reader = reader
+        self._writer = deflate.DeflateStreamWriter(self._writer)
+        self._compress_tag = None
+
+    def _parse_untagged(self, first, parts):
+        """
+        Splits an untagged response into (type, data) pairs the way imaplib
+        stores them, including response codes such as [UIDVALIDITY n].
+        """
+
+        m = Untagged_status.match(first)
+        if m is not None:
+            dat = m.group('data')
+            if m.group('data2'):
+                dat += b' ' + m.group('data2')
+        else:
+            m = Untagged_response.match(first)
+            if m is None:
+                raise self.abort("unexpected response: %r" % first)
+            dat = m.group('data') or b''
+
+        typ = m.group('type').decode('ascii')
+
+        if isinstance(parts[0], tuple):
+            parts = [(dat, parts[0][1])] + parts[1:]
+        else:
+            parts = [dat] + parts[1:]
+
+        result = [(typ, part) for part in parts]
+
+        if typ in ('OK', 'NO', 'BAD'):
+            m = Response_code.match(dat)
+            if m is not None:
+                result.append((m.group('type').decode('ascii'),
+                               m.group('data')))
+
+        return result
+
+    def _aborted(self):
+        if isinstance(self._failure, self.abort):
+            return self.abort(str(self._failure))
+        return self.abort("socket error: %s" % self._failure)
+
+    def _fail(self, exception):
+        self._failure = exception
+        self.state = 'LOGOUT'
+        for tag, future, untagged, on_response, sink in self._pending:
+            if on_response is not None:
+                on_response(None)
+            if not future.done():
+                future.set_exception(self._aborted())
+        self._pending = []
+        if self._continuation is not None and not self._continuation.done():
+            self._continuation.set_exception(self._aborted())
+
+    def _update_capabilities(self, untagged):
+        for data in untagged.get('CAPABILITY', []):
+            self.capabilities = tuple(data.decode('ascii').upper().split())
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def event_loop():
+    """
+    Returns the event loop shared by all ImapClient instances. It runs in a
+    daemon thread started on first use.
+    """
+
+    global _loop
+
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever,
+                                      name="aioimap", daemon=True)
+            thread.start()
+
+    return _loop
+
+
+class ImapClient(object):
+    """
+    Blocking wrapper around AsyncImapClient implementing the subset of the
+    imaplib.IMAP4 interface used by ImapProcessor. Return values and
+    exceptions match imaplib's. Commands issued from different threads are
+    pipelined on the shared event loop.
+    """
+
+    error = imaplib.IMAP4.error
+    abort = imaplib.IMAP4.abort
+    readonly = imaplib.IMAP4.readonly
+
+    def __init__(self, host='', port=imaplib.IMAP4_PORT, ssl_context=None):
+        self.untagged_responses = {}
+        self._client = AsyncImapClient(host, port, ssl_context)
+        self._run(self._client.connect())
+
+    def get_capabilities(self):
+        return self._client.capabilities
+
+    def set_capabilities(self, capabilities):
+        self._client.capabilities = capabilities
+
+    capabilities = property(get_capabilities, set_capabilities)
+
+    @property
+    def state(self):
+        return self._client.state
+
+    def capability(self):
+        typ, data = self._simple_command('CAPABILITY')
+        return self._untagged_response(typ, data, 'CAPABILITY')
+
+    def close(self):
+        try:
+            typ, data = self._simple_command('CLOSE')
+        finally:
+            self._client.state = 'AUTH'
+        return typ, data
+
+    def compress(self):
+        typ, data, untagged = self._run(self._client.compress())
+        self._merge(untagged)
+        return typ, data
+
+    def create(self, mailbox):
+        return self._simple_command('CREATE', mailbox)
+
+    def enable(self, capability):
+        if 'ENABLE' not in self.capabilities:
+            raise self.error("Server does not support ENABLE")
+        return self._simple_command('ENABLE', capability)
+
+    def expunge(self):
+        typ, data = self._simple_command('EXPUNGE')
+        return self._untagged_response(typ, data, 'EXPUNGE')
+
+    def idle(self, timeout, interrupted=None):
+        """
+        Waits in IDLE for up to timeout seconds. See AsyncImapClient.idle().
+        """
+        return self._run(self._client.idle(timeout, interrupted))
+
+    def list(self, directory='""', pattern='*'):
+        typ, data = self._simple_command('LIST', directory, pattern)
+        return self._untagged_response(typ, data, 'LIST')
+
+    def login(self, user, password):
+        typ, data, untagged = self._run(self._client.login(user, password))
+        self._merge(untagged)
+        return typ, data
+
+    def logout(self):
+        try:
+            typ, data = self._simple_command('LOGOUT')
+        except self.abort:
+            typ, data = 'NO', [b'connection already closed']
+        self._run(self._client.close())
+        if 'BYE' in self.untagged_responses:
+            return 'BYE', self.untagged_responses.pop('BYE')
+        return typ, data
+
+    def noop(self):
+        return self._simple_command('NOOP')
+
+    def response(self, code):
+        return code, self.untagged_responses.pop(code.upper(), [None])
+
+    def select(self, mailbox='INBOX', readonly=False):
+        self.untagged_responses = {}
+        if readonly:
+            name = 'EXAMINE'
+        else:
+            name = 'SELECT'
+        typ, data = self._simple_command(name, mailbox)
+        if typ != 'OK':
+            self._client.state = 'AUTH'
+            return typ, data
+        self._client.state = 'SELECTED'
+        return self._untagged_response(typ, data, 'EXISTS')
+
+    def status(self, mailbox, names):
+        typ, data = self._simple_command('STATUS', mailbox, names)
+        return self._untagged_response(typ, data, 'STATUS')
+
+    def subscribe(self, mailbox):
+        return self._simple_command('SUBSCRIBE', mailbox)
+
+    def uid(self, command, *args):
+        command = command.upper()
+        if command in ('SEARCH', 'SORT', 'THREAD'):
+            name = command
+        else:
+            name = 'FETCH'
+        typ, data = self._simple_command('UID', command, *args)
+        return self._untagged_response(typ, data, name)
+
+    def uid_pipelined(self, command, arg_lists, depth):
+        """
+        Issues the UID command command once for every tuple of arguments in
+        arg_lists, keeping up to depth commands in flight, and yields the
+        responses in order, as uid() returns them.
+        """
+        command = command.upper()
+        if command in ('SEARCH', 'SORT', 'THREAD'):
+            name = command
+        else:
+            name = 'FETCH'
+
+        pending = collections.deque()
+        for args in arg_lists:
+            if len(pending) >= depth:
+                yield self._uid_response(pending.popleft(), name)
+            pending.append(asyncio.run_coroutine_threadsafe(
+                self._client.command('UID', command, *args), event_loop()))
+
+        while pending:
+            yield self._uid_response(pending.popleft(), name)
+
+    def uid_fetch_body(self, uid, sink):
+        """
+        Issues UID FETCH uid BODY.PEEK[], passing the message to the callable
+        sink in chunks as it is read. Returns the parts of the FETCH
+        responses received. Raises error if the command fails.
+        """
+        responses = []
+
+        def on_response(parts):
+            if parts is None or not fetch.is_fetch(parts):
+                return False
+            responses.append(parts)
+            return True
+
+        typ, data, untagged = self._run(self._client.command(
+            'UID', 'FETCH', uid, 'BODY.PEEK[]', on_response=on_response,
+            sink=sink))
+        self._merge(untagged)
+        if typ != 'OK':
+            raise self.error("UID command error: %s %s" % (typ, data))
+        return responses
+
+    def uid_fetch_stream(self, arg_lists, depth):
+        """
+        Issues UID FETCH once for every tuple of arguments in arg_lists,
+        keeping up to depth commands in flight, and yields the parts of each
+        FETCH response as soon as it is received. Raises error if a command
+        fails.
+        """
+        responses = queue.Queue()
+
+        def on_response(parts):
+            if parts is not None and not fetch.is_fetch(parts):
+                return False
+            responses.put(parts)
+            return True
+
+        pending = collections.deque()
+        arg_lists = iter(arg_lists)
+
+        while True:
+            while len(pending) < depth:
+                args = next(arg_lists, None)
+                if args is None:
+                    break
+                pending.append(asyncio.run_coroutine_threadsafe(
+                    self._client.command('UID', 'FETCH', *args,
+                                         on_response=on_response),
+                    event_loop()))
+            if not pending:
+                return
+
+            parts = responses.get()
+            if parts is not None:
+                yield parts
+                continue
+
+            # The oldest command is complete.
+            typ, data, untagged = pending.popleft().result()
+            self._merge(untagged)
+            if typ != 'OK':
+                raise self.error("UID command error: %s %s" % (typ, data))
+
+    # ----------------------------------------------------------------
+
+    def _merge(self, untagged):
+        for typ in untagged:
+            self.untagged_responses.setdefault(typ, []).extend(untagged[typ])
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine,
+                                                event_loop()).result()
+
+    def _simple_command(self, name, *args):
+        for typ in ('OK', 'NO', 'BAD'):
+            self.untagged_responses.pop(typ, None)
+        typ, data, untagged = self._run(self._client.command(name, *args))
+        self._merge(untagged)
+        return typ, data
+
+    def _uid_response(self, future, name):
+        typ, data, untagged = future.result()
+        if typ == 'NO':
+            return typ, data
+        return typ, untagged.get(name, [None])
+
+    def _untagged_response(self, typ, data, name):
+        if typ == 'NO':
+            return typ, data
+        return typ, self.untagged_responses.pop(name, [None])
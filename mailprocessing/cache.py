@@ -0,0 +1,292 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Persistent storage for imapproc's header cache.
+
+The header cache is a dict keyed by folder name. Each folder's entry is a
+dict with the folder's 'uidvalidity', 'highestmodseq' and 'uids', the latter
+mapping message UIDs to dicts with the message's 'headers' and 'flags'.
+"""
+
+import collections.abc
+import errno
+import json
+import os
+import sqlite3
+import threading
+import types
+
+BACKENDS = ('json', 'sqlite')
+
+
+def open_cache(backend, path, host, user):
+    """
+    Returns a cache store of type backend for the cache file path.
+    """
+    if backend == 'sqlite':
+        return SqliteCache(path, host, user)
+    return JsonCache(path)
+
+
+class JsonCache(object):
+    """
+    Stores the whole header cache as a single JSON document.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """
+        Returns the stored header cache or an empty one if the cache file
+        does not exist, yet.
+        """
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return {}
+            raise
+
+    def save(self, cache):
+        """
+        Stores cache. The cache file is replaced atomically, so a crash while
+        saving leaves the previous version intact.
+        """
+        tmp = self.path + '.tmp'
+        with open(tmp, mode='w') as f:
+            json.dump(cache, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def close(self):
+        pass
+
+
+class SqliteCache(object):
+    """
+    Stores the header cache in an SQLite database. Messages are keyed by
+    (host, user, folder, uidvalidity, uid) and read from the database on
+    demand, so only the messages currently being worked on are held in
+    memory. Changes are written as they happen and committed by save(), in
+    one transaction per cycle.
+
+    If path holds a JSON header cache, it is imported and the JSON file is
+    kept as path.json.
+    """
+
+    def __init__(self, path, host, user):
+        self.path = path
+        self.host = host
+        self.user = user
+        self.lock = threading.RLock()
+
+        migrate = None
+        if self._is_json(path):
+            migrate = path + '.json'
+            os.rename(path, migrate)
+
+        # uidvalidity and highestmodseq are declared without a type so they
+        # are returned exactly as they were stored.
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS folders ("
+                        " host TEXT, user TEXT, folder TEXT,"
+                        " uidvalidity, highestmodseq, header_fields TEXT,"
+                        " watermark INTEGER, status TEXT,"
+                        " PRIMARY KEY (host, user, folder))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages ("
+                        " host TEXT, user TEXT, folder TEXT,"
+                        " uidvalidity, uid INTEGER,"
+                        " flags TEXT, headers TEXT,"
+                        " PRIMARY KEY (host, user, folder, uidvalidity, uid))")
+        self.db.commit()
+
+        if migrate is not None:
+            self.save(JsonCache(migrate).load())
+
+    def load(self):
+        """
+        Returns the header cache. Each folder's 'uids' entry is a
+        SqliteUidMap reading from and writing to the database.
+        """
+        cache = {}
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT folder, uidvalidity, highestmodseq, header_fields,"
+                " watermark, status FROM folders WHERE host = ? AND user = ?",
+                (self.host, self.user)).fetchall()
+        for folder, uidvalidity, highestmodseq, header_fields, watermark, \
+                status in rows:
+            cache[folder] = {
+                'uidvalidity': uidvalidity,
+                'highestmodseq': highestmodseq,
+                'header_fields': json.loads(header_fields),
+                'watermark': watermark,
+                'status': json.loads(status),
+                'uids': SqliteUidMap(self, folder, uidvalidity)
+                }
+        return cache
+
+    def save(self, cache):
+        """
+        Writes folder metadata and any folder whose messages are held in
+        memory (rather than in a SqliteUidMap) to the database and commits.
+        Messages of other UIDVALIDITY generations are dropped. The 'uids'
+        entries of folders written are replaced by SqliteUidMaps, so a cache
+        kept in memory across passes does not hold on to all messages and
+        is not written again as a whole by the next save().
+        """
+        with self.lock:
+            for folder, entry in cache.items():
+                if 'uids' not in entry:
+                    continue
+                uidvalidity = entry.get('uidvalidity')
+                uids = entry['uids']
+                self.db.execute(
+                    "INSERT OR REPLACE INTO folders"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (self.host, self.user, folder, uidvalidity,
+                     entry.get('highestmodseq'),
+                     json.dumps(entry.get('header_fields')),
+                     entry.get('watermark'),
+                     json.dumps(entry.get('status'))))
+                self.db.execute(
+                    "DELETE FROM messages WHERE host = ? AND user = ?"
+                    " AND folder = ? AND uidvalidity IS NOT ?",
+                    (self.host, self.user, folder, uidvalidity))
+                if isinstance(uids, SqliteUidMap) \
+                   and uids.uidvalidity == uidvalidity:
+                    continue
+                self.db.execute(
+                    "DELETE FROM messages WHERE host = ? AND user = ?"
+                    " AND folder = ?", (self.host, self.user, folder))
+                self.db.executemany(
+                    "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    ((self.host, self.user, folder, uidvalidity, int(uid),
+                      json.dumps(uids[uid]['flags']),
+                      json.dumps(dict(uids[uid]['headers'])))
+                     for uid in uids))
+                entry['uids'] = SqliteUidMap(self, folder, uidvalidity)
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def _is_json(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return f.read(1) == b'{'
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+
+
+class SqliteUidMap(collections.abc.MutableMapping):
+    """
+    A folder's 'uids' header cache entry backed by a SqliteCache.
+
+    Values are SqliteMessage dicts read from the database on every lookup.
+    Assigning to a message's 'flags' or 'headers' key, or assigning a whole
+    message to its UID, updates the database. Changing a value in place does
+    not: a message's headers are therefore read-only, and a changed flags
+    list has to be assigned back.
+    """
+
+    def __init__(self, store, folder, uidvalidity):
+        self.store = store
+        self.folder = folder
+        self.uidvalidity = uidvalidity
+        self._key = (store.host, store.user, folder, uidvalidity)
+
+    def _execute(self, sql, *args):
+        with self.store.lock:
+            return self.store.db.execute(
+                sql + " WHERE host = ? AND user = ? AND folder = ?"
+                " AND uidvalidity = ?" + (" AND uid = ?" if args else ""),
+                self._key + args).fetchall()
+
+    def __getitem__(self, uid):
+        rows = self._execute("SELECT flags, headers FROM messages", int(uid))
+        if not rows:
+            raise KeyError(uid)
+        return SqliteMessage(self, uid, flags=json.loads(rows[0][0]),
+                             headers=types.MappingProxyType(
+                                 json.loads(rows[0][1])))
+
+    def __setitem__(self, uid, message):
+        with self.store.lock:
+            self.store.db.execute(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                self._key + (int(uid), json.dumps(message['flags']),
+                             json.dumps(dict(message['headers']))))
+
+    def __delitem__(self, uid):
+        if uid not in self:
+            raise KeyError(uid)
+        self._execute("DELETE FROM messages", int(uid))
+
+    def __contains__(self, uid):
+        return bool(self._execute("SELECT 1 FROM messages", int(uid)))
+
+    def __iter__(self):
+        rows = self._execute("SELECT uid FROM messages")
+        return iter([str(uid) for uid in sorted(row[0] for row in rows)])
+
+    def __len__(self):
+        return self._execute("SELECT COUNT(*) FROM messages")[0][0]
+
+    def set_flags(self, uid, flags):
+        self._update(uid, 'flags', flags)
+
+    def set_headers(self, uid, headers):
+        self._update(uid, 'headers', dict(headers))
+
+    # ----------------------------------------------------------------
+
+    def _update(self, uid, column, value):
+        with self.store.lock:
+            self.store.db.execute(
+                "UPDATE messages SET %s = ? WHERE host = ? AND user = ?"
+                " AND folder = ? AND uidvalidity = ? AND uid = ?" % column,
+                (json.dumps(value),) + self._key + (int(uid),))
+
+
+class SqliteMessage(dict):
+    """
+    A message's header cache entry read from a SqliteUidMap. Assigning to
+    its 'flags' or 'headers' key writes the new value to the database.
+    """
+
+    def __init__(self, uids, uid, **kwargs):
+        super(SqliteMessage, self).__init__(**kwargs)
+        self._uids = uids
+        self._uid = uid
+
+    def __setitem__(self, key, value):
+        if key == 'flags':
+            self._uids.set_flags(self._uid, value)
+        elif key == 'headers':
+            self._uids.set_headers(self._uid, value)
+            value = types.MappingProxyType(dict(value))
+        super(SqliteMessage, self).__setitem__(key, value)
@@ -31,9 +31,15 @@ import subprocess
 import sys
 from optparse import OptionParser
 
+from mailprocessing.accounts import SharedLog
+from mailprocessing.accounts import read_accounts
+from mailprocessing.lease import LeaseManager
 from mailprocessing.processor.imap import ImapProcessor
+from mailprocessing.scheduler import Scheduler
 
 from mailprocessing.util import iso_8601_now
+from mailprocessing.util import password_from_command
+from mailprocessing.util import safe_write
 from mailprocessing.util import write_pidfile
 from mailprocessing.version import PKG_VERSION
 
@@ -129,6 +135,34 @@ def main():
         help="increase log level one step")
 
     # IMAP specific options
+    parser.add_option(
+        "--accounts",
+        type="string",
+        metavar="FILE",
+        help=(
+            "Process all IMAP accounts listed in the accounts file FILE in"
+            " this process rather than a single account."))
+    parser.add_option(
+        "--asyncio",
+        action="store_true",
+        default=False,
+        help=(
+            "Talk to the IMAP server through an asyncio based client instead"
+            " of imaplib."))
+    parser.add_option(
+        "--compress",
+        action="store_true",
+        default=False,
+        help=("Compress the IMAP session with COMPRESS=DEFLATE if the server"
+              " supports it (default: no)"))
+    parser.add_option(
+        "--cache-backend",
+        type="choice",
+        choices=["json", "sqlite"],
+        default="json",
+        metavar="BACKEND",
+        help=("Store the header cache as a JSON file (json, the default) or"
+              " in an SQLite database (sqlite)."))
     parser.add_option(
         "--cache-file",
         type="string",
@@ -145,11 +179,67 @@ def main():
         "--certfile",
         type="string",
         help="Certificate file to verify server's certificate against (only relevant for IMAPS)")
+    parser.add_option(
+        "--connections",
+        type="int",
+        default=1,
+        metavar="N",
+        help="Open N IMAP connections and synchronize folders in parallel"
+             " (default: 1)")
     parser.add_option(
         "-H",
         "--host",
         type="string",
         help="IMAP server to log in to.")
+    parser.add_option(
+        "--idle",
+        action="store_true",
+        default=False,
+        help=(
+            "Use IMAP IDLE to wait for changes in the first folder instead of"
+            " polling. All folders are still rescanned every INTERVAL"
+            " seconds. Falls back to polling if the server does not support"
+            " IDLE."))
+    parser.add_option(
+        "--incremental",
+        action="store_true",
+        default=False,
+        help=(
+            "Only pass messages to the rc file that have not been passed to"
+            " it before."))
+    parser.add_option(
+        "--jitter",
+        type="int",
+        default=30,
+        metavar="SECONDS",
+        help=("With --accounts, delay every scan of an account by a random"
+              " amount of up to SECONDS seconds (default: 30)"))
+    parser.add_option(
+        "--lease-directory",
+        type="string",
+        metavar="DIR",
+        help=("With --accounts, share the accounts with other imapproc"
+              " processes through lease files in DIR, which must be on a"
+              " file system shared by all of them."))
+    parser.add_option(
+        "--lease-timeout",
+        type="int",
+        default=120,
+        metavar="SECONDS",
+        help=("Consider an account's lease expired if its holder has not"
+              " renewed it for SECONDS seconds (default: 120)"))
+    parser.add_option(
+        "--node-id",
+        type="string",
+        metavar="ID",
+        help=("Name this process ID in lease files (default: HOST.PID)"))
+    parser.add_option(
+        "--keep-alive",
+        action="store_true",
+        default=False,
+        help=(
+            "Keep the IMAP session open between scans instead of logging out"
+            " and reconnecting for every scan."))
     parser.add_option(
         "-i",
         "--interval",
@@ -170,6 +260,21 @@ def main():
         metavar="COMMAND",
         help="Execute COMMAND and read the password to log in to IMAP "
              "server with from its standard output.")
+    parser.add_option(
+        "--pipeline-depth",
+        type="int",
+        default=1,
+        metavar="N",
+        help=("Keep up to N batched IMAP commands in flight at the same time"
+              " (default: 1)"))
+    parser.add_option(
+        "--reprocess-flag-changes",
+        action="store_true",
+        default=False,
+        help=(
+            "With --incremental, pass messages whose flags changed to the rc"
+            " file again. Unless the server supports CONDSTORE, this fetches"
+            " the flags of all messages in every scan."))
     parser.add_option(
         "-P",
         "--port",
@@ -192,6 +297,14 @@ def main():
         default=200,
         metavar="BATCHSIZE",
         help="Batch size to use for downloading message headers")
+    parser.add_option(
+        "--action-batchsize",
+        type="int",
+        default=100,
+        metavar="BATCHSIZE",
+        help="Queue up to BATCHSIZE copy/move/delete actions and execute"
+             " them in bulk (default: 100; 0 executes every action"
+             " immediately)")
     parser.add_option(
         "--flag-batchsize",
         type="int",
@@ -214,6 +327,12 @@ def main():
         action="store_true",
         default=False,
         help="Skip SSL certificate validation when connecting to IMAP server (unsafe).")
+    parser.add_option(
+        "--workers",
+        type="int",
+        default=4,
+        metavar="N",
+        help="With --accounts, scan up to N accounts at once (default: 4)")
     parser.add_option(
         "--pidfile",
         type="string",
@@ -225,19 +344,50 @@ def main():
 
     bad_options = False
 
-    for opt in ("host", "user"):
-        if not options.__dict__[opt]:
-            print("Please specify --%s option." % opt, file=sys.stderr)
+    if options.accounts:
+        # Host, user and password may be given in the accounts file.
+        for opt in ("idle", "keep_alive"):
+            if options.__dict__[opt]:
+                print("--%s cannot be used with --accounts." %
+                      opt.replace("_", "-"), file=sys.stderr)
+                bad_options = True
+        if options.workers < 1:
+            print("Please specify at least one worker.", file=sys.stderr)
+            bad_options = True
+        if options.jitter < 0:
+            print("Please specify a non-negative jitter.", file=sys.stderr)
             bad_options = True
+        if options.node_id and (options.node_id.split() != [options.node_id]
+                                or "/" in options.node_id):
+            print("Please specify a node ID without whitespace or slashes.",
+                  file=sys.stderr)
+            bad_options = True
+        if options.lease_timeout < 3:
+            print("Please specify a lease timeout of at least 3 seconds.",
+                  file=sys.stderr)
+            bad_options = True
+    else:
+        for opt in ("host", "user"):
+            if not options.__dict__[opt]:
+                print("Please specify --%s option." % opt, file=sys.stderr)
+                bad_options = True
 
-    if not (options.password or options.password_command):
-        print("Please specify either --password or --password-command.", file=sys.stderr)
-        bad_options = True
+        if not (options.password or options.password_command):
+            print("Please specify either --password or --password-command.", file=sys.stderr)
+            bad_options = True
 
     if options.password and options.password_command:
         print("Please specify only one of --password or --password-command.", file=sys.stderr)
         bad_options = True
 
+    if options.pipeline_depth < 1:
+        print("Please specify a pipeline depth of at least 1.",
+              file=sys.stderr)
+        bad_options = True
+    if options.connections < 1:
+        print("Please specify at least one connection.", file=sys.stderr)
+        bad_options = True
+
     if options.insecure and options.certfile:
         print("Please specify only one of --insecure or --certfile.", file=sys.stderr)
         bad_options = True
@@ -250,10 +400,9 @@ def main():
     if options.password:
         processor_kwargs['password'] = options.password
 
-    if options.password_command:
+    if options.password_command and not options.accounts:
         try:
-            p = subprocess.check_output(options.password_command, shell=True)
-            p = p.decode(locale.getpreferredencoding()).rstrip("\n")
+            p = password_from_command(options.password_command)
         except subprocess.CalledProcessError as e:
             print("Password command failed with exit status %d, "
                   "output follows." % e.returncode, file=sys.stderr)
@@ -274,6 +423,8 @@ def main():
 
     if options.logfile == "-":
         log_fp = sys.stdout
+    elif options.accounts:
+        log_fp = SharedLog(os.path.expanduser(options.logfile))
     else:
         log_fp = open(
             os.path.expanduser(options.logfile),
@@ -302,12 +453,19 @@ def main():
 
     processor_kwargs["run_once"] = options.once
 
-    for opt in ("auto_reload_rcfile", "certfile", "dry_run", "folders",
-                "folder_prefix", "folder_separator", "header_batchsize",
-                "flag_batchsize", "host", "interval", "port", "user",
-                "use_ssl", "insecure", "verbosity"):
+    for opt in ("action_batchsize", "asyncio", "auto_reload_rcfile",
+                "certfile", "compress", "connections", "dry_run", "folders",
+                "folder_prefix", "folder_separator",
+                "header_batchsize", "flag_batchsize", "host", "idle",
+                "incremental", "interval", "keep_alive", "pipeline_depth",
+                "port", "reprocess_flag_changes", "user", "use_ssl",
+                "insecure", "verbosity"):
         processor_kwargs[opt] = options.__dict__[opt]
 
+    if options.accounts:
+        sys.exit(run_accounts(options, processor_kwargs, log_fp,
+                              imapproc_directory, parser.version))
+
     if options.cache_headers:
         if options.cache_file:
             cache_file = options.cache_file
@@ -315,6 +473,7 @@ def main():
             cache_file = os.path.join(imapproc_directory,
                                       options.host + '.cache')
         processor_kwargs['cache_file'] = os.path.expanduser(cache_file)
+        processor_kwargs['cache_backend'] = options.cache_backend
 
     # Try to open rc file early on. Otherwise we'll process headers until we
     # get to the point where we open the rc-file, possibly wasting a lot of
@@ -357,3 +516,79 @@ def main():
                     # Normal exit.
                     break
                 # We should reload the RC file.
+
+
+def run_accounts(options, processor_kwargs, log_fp, imapproc_directory,
+                 version):
+    """
+    Processes all accounts in the accounts file given with --accounts until
+    imapproc is terminated. Returns the exit status.
+    """
+
+    defaults = {
+        "folders": options.folders,
+        "host": options.host,
+        "interval": options.interval,
+        "password": options.password,
+        "password_command": options.password_command,
+        "port": options.port,
+        "rcfile": options.rcfile,
+        "use_ssl": options.use_ssl,
+        "user": options.user,
+    }
+
+    cache_directory = None
+    if options.cache_headers:
+        cache_directory = imapproc_directory
+        processor_kwargs['cache_backend'] = options.cache_backend
+
+    try:
+        accounts = read_accounts(os.path.expanduser(options.accounts),
+                                 defaults, processor_kwargs, log_fp,
+                                 cache_directory)
+    except ValueError as e:
+        print("Error: %s" % e, file=sys.stderr)
+        return 1
+
+    safe_write(log_fp, "")
+    safe_write(log_fp, "Starting imapproc {0} at {1} for {2} accounts".format(
+        version, iso_8601_now(), len(accounts)))
+    log_fp.flush()
+
+    def log(text):
+        safe_write(log_fp, text)
+        log_fp.flush()
+
+    leases = None
+    if options.lease_directory:
+        try:
+            leases = LeaseManager(os.path.expanduser(options.lease_directory),
+                                  [account.name for account in accounts],
+                                  options.node_id, options.lease_timeout, log)
+            leases.start()
+        except OSError as e:
+            print("Error: Could not use lease directory %s: %s" %
+                  (options.lease_directory, e), file=sys.stderr)
+            return 1
+        log("==> Node %s holds leases for %d of %d accounts" %
+            (leases.node, len(leases.held), len(accounts)))
+        for account in accounts:
+            account.leases = leases
+
+    def log_error(account, e):
+        if isinstance(e, SystemExit):
+            # A fatal error, which the account's processor logged already.
+            account.log_error("Error: Processing account aborted with exit "
+                              "status %s" % e.code)
+        else:
+            account.log_error("Error: Processing account failed: %s" % e)
+
+    scheduler = Scheduler(options.workers, options.jitter, log_error)
+    for account in accounts:
+        scheduler.add(account, None if options.once else account.interval)
+    scheduler.run()
+
+    if leases is not None:
+        leases.stop()
+
+    return 0
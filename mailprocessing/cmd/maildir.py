@@ -64,6 +64,13 @@ def main():
         help=(
             "turn on automatic reloading of the rc file when it has been"
             " modified"))
+    parser.add_option(
+        "--digest-cache",
+        type="string",
+        metavar="FILE",
+        help=(
+            "remember the digests of mail files in FILE, so mail seen before"
+            " is not read again to log its digest"))
     parser.add_option(
         "--dry-run",
         action="store_true",
@@ -129,6 +136,28 @@ def main():
         help=(
             "only process the maildirs once and then exit; without this flag,"
             " maildirproc will scan the maildirs continuously"))
+    parser.add_option(
+        "--incremental",
+        action="store_true",
+        default=False,
+        help=(
+            "only pass mail to the rc file that has not been passed to it"
+            " before"))
+    parser.add_option(
+        "--inotify",
+        action="store_true",
+        default=False,
+        help=(
+            "wait for new mail with inotify rather than checking the maildirs"
+            " every second; falls back to checking if inotify is not"
+            " available"))
+    parser.add_option(
+        "--reprocess-flag-changes",
+        action="store_true",
+        default=False,
+        help=(
+            "with --incremental, pass mail whose flags changed to the rc file"
+            " again"))
     parser.add_option(
         "-r",
         "--rcfile",
@@ -175,9 +204,15 @@ def main():
     log_level = options.log_level + options.verbosity
 
     rcfile = os.path.expanduser(options.rcfile)
+    digest_cache = options.digest_cache
+    if digest_cache is not None:
+        digest_cache = os.path.expanduser(digest_cache)
     processor = MaildirProcessor(
         rcfile=rcfile, log_fp=log_fp, log_level=log_level,
         dry_run=options.dry_run, run_once=options.once,
+        incremental=options.incremental, inotify=options.inotify,
+        digest_cache=digest_cache,
+        reprocess_flag_changes=options.reprocess_flag_changes,
         auto_reload_rcfile=options.auto_reload_rcfile,
         folder_prefix=options.folder_prefix,
         folder_separator=options.folder_separator)
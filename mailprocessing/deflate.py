@@ -0,0 +1,164 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Raw DEFLATE streams for IMAP COMPRESS=DEFLATE (RFC 4978).
+
+Once the server has accepted COMPRESS DEFLATE, everything either side sends
+is compressed without a zlib header. Each write is followed by a sync flush
+so the peer can decompress a command or response as soon as it arrives.
+"""
+
+import zlib
+
+# Amount of compressed data read from the connection at a time.
+READ_SIZE = 65536
+
+
+def compress_imaplib(imap):
+    """
+    Makes the imaplib.IMAP4 (or IMAP4_SSL) instance imap compress everything
+    it sends and decompress everything it receives. To be invoked right after
+    the server accepted COMPRESS DEFLATE.
+    """
+    compressor = Compressor()
+    sock = imap.sock
+
+    def send(data):
+        sock.sendall(compressor.compress(data))
+
+    imap.send = send
+    imap.file = DeflateFile(imap.file)
+
+
+class Compressor(object):
+    """
+    Compresses data into a raw DEFLATE stream, flushing after every chunk.
+    """
+
+    def __init__(self):
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                           zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return (self.compressor.compress(data) +
+                self.compressor.flush(zlib.Z_SYNC_FLUSH))
+
+
+class DeflateFile(object):
+    """
+    Read-only file object decompressing the raw DEFLATE stream read from
+    the buffered socket file fileobj. Implements the subset of the file
+    interface imaplib uses.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.buffer = bytearray()
+
+    def pending(self):
+        """
+        Returns True if decompressed data is waiting to be read. select()
+        on the underlying socket does not know about it.
+        """
+        return len(self.buffer) > 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            if not self._fill():
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readline(self, limit=-1):
+        start = 0
+        while True:
+            end = self.buffer.find(b'\n', start) + 1
+            if end > 0:
+                break
+            if 0 <= limit <= len(self.buffer):
+                end = limit
+                break
+            start = len(self.buffer)
+            if not self._fill():
+                end = len(self.buffer)
+                break
+        if 0 <= limit < end:
+            end = limit
+        data = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+    def _fill(self):
+        """
+        Decompresses the next chunk read from the connection into the buffer.
+        Returns False at the end of the stream.
+        """
+        # read1() returns whatever the buffered file holds (or what a single
+        # recv() yields), so it neither blocks for more data than the server
+        # sent nor leaves compressed data behind in the file's buffer.
+        data = self.fileobj.read1(READ_SIZE)
+        if not data:
+            return False
+        self.buffer += self.decompressor.decompress(data)
+        return True
+
+
+class DeflateStreamWriter(object):
+    """
+    Wraps an asyncio.StreamWriter, compressing everything written to it.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.compressor = Compressor()
+
+    def write(self, data):
+        self.writer.write(self.compressor.compress(data))
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+
+
+async def inflate_stream(source, reader):
+    """
+    Decompresses the raw DEFLATE stream read from the asyncio.StreamReader
+    source into the asyncio.StreamReader reader until source ends.
+    """
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    try:
+        while True:
+            data = await source.read(READ_SIZE)
+            if not data:
+                break
+            reader.feed_data(decompressor.decompress(data))
+    except (OSError, zlib.error) as e:
+        reader.set_exception(e)
+        return
+    reader.feed_eof()
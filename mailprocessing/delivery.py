@@ -0,0 +1,330 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Delivery of forwarded messages.
+
+A message is delivered by starting a delivery with an envelope sender and
+a list of recipients, writing the message to it in chunks and finishing it.
+SendmailMessage pipes the message into a sendmail process. SmtpConnection
+keeps a connection to an SMTP or LMTP server open across messages and
+submits them over it.
+"""
+
+import getpass
+import re
+import smtplib
+import socket
+import subprocess
+import urllib.parse
+
+SCHEMES = ('smtp', 'lmtp')
+
+Line_ending = re.compile(br'\r\n|\n|\r')
+
+
+class DeliveryError(Exception):
+    pass
+
+
+def parse_server(url):
+    """
+    Splits the SMTP server URL url into (scheme, host, port). url is either
+    smtp://HOST[:PORT] or lmtp://HOST[:PORT] for a TCP server or smtp:PATH or
+    lmtp:PATH for a server listening on the UNIX socket PATH (in which case
+    host is PATH and port is None). Raises ValueError for other URLs.
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in SCHEMES:
+        raise ValueError("unsupported SMTP server URL %r (use smtp://HOST"
+                         "[:PORT], lmtp://HOST[:PORT], smtp:PATH or "
+                         "lmtp:PATH)" % url)
+    if parts.netloc:
+        return parts.scheme, parts.hostname, parts.port
+    if not parts.path.startswith('/'):
+        raise ValueError("UNIX socket path in SMTP server URL %r is not "
+                         "absolute" % url)
+    return parts.scheme, parts.path, None
+
+
+class SendmailMessage(object):
+    """
+    A message being piped into the sendmail command sendmail, invoked with
+    the command line flags flags.
+    """
+
+    # sendmail reports rejected recipients on its own.
+    rejected = []
+
+    def __init__(self, sendmail, flags, env_sender, addresses):
+        if env_sender is not None:
+            flags += " -f {0}".format(env_sender)
+        self.sendmail = sendmail
+        # exec, so abort() kills sendmail rather than the shell.
+        self.process = subprocess.Popen(
+            "exec {0} {1} -- {2}".format(sendmail, flags, " ".join(addresses)),
+            shell=True,
+            stdin=subprocess.PIPE)
+
+    def write(self, data):
+        try:
+            self.process.stdin.write(data)
+        except BrokenPipeError:
+            # sendmail exited prematurely, which its exit status will tell.
+            pass
+
+    def abort(self):
+        """
+        Kills sendmail before it sees the end of the message, so nothing is
+        sent.
+        """
+        self.process.kill()
+        self.process.wait()
+
+    def finish(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        status = self.process.wait()
+        if status != 0:
+            raise DeliveryError("%s exited %d" % (self.sendmail, status))
+
+
+class SmtpConnection(object):
+    """
+    A persistent connection to the SMTP or LMTP server given by the URL url
+    (see parse_server()). The connection is opened on first use and reopened
+    if the server closed it in the meantime. Transactions are pipelined
+    (RFC 2920) if the server supports it.
+    """
+
+    def __init__(self, url, timeout=60):
+        self.url = url
+        self.scheme, self.host, self.port = parse_server(url)
+        self.timeout = timeout
+        self.smtp = None
+        self.pipelining = False
+
+    def start(self, env_sender, addresses):
+        """
+        Sends the envelope for a message from env_sender (the local user if
+        None) to the list addresses and returns an SmtpMessage to write the
+        message to. Raises DeliveryError if the server refuses the message
+        for all recipients.
+        """
+        if env_sender is None:
+            env_sender = "%s@%s" % (getpass.getuser(), socket.getfqdn())
+
+        try:
+            if self.smtp is not None:
+                try:
+                    return self._start(env_sender, addresses)
+                except (OSError, smtplib.SMTPServerDisconnected):
+                    # Most likely the server closed the connection while we
+                    # were idle. Nothing has been sent yet, so start over.
+                    self.close()
+            self._connect()
+            return self._start(env_sender, addresses)
+        except (OSError, smtplib.SMTPException) as e:
+            self.close()
+            raise DeliveryError("SMTP server %s: %s" % (self.url, e))
+
+    def close(self):
+        """
+        Closes the connection, politely if possible.
+        """
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except (OSError, smtplib.SMTPException):
+            self.smtp.close()
+        self.smtp = None
+
+    # ----------------------------------------------------------------
+
+    def _connect(self):
+        if self.scheme == 'lmtp':
+            # smtplib.LMTP connects to UNIX sockets by itself.
+            self.smtp = smtplib.LMTP(timeout=self.timeout)
+            code, message = self.smtp.connect(self.host, self.port or
+                                              smtplib.LMTP_PORT)
+        else:
+            self.smtp = _Smtp(timeout=self.timeout)
+            code, message = self.smtp.connect(self.host, self.port or
+                                              smtplib.SMTP_PORT)
+        if code != 220:
+            raise smtplib.SMTPConnectError(code, message)
+
+        self.smtp.ehlo_or_helo_if_needed()
+        self.pipelining = self.smtp.has_extn('pipelining')
+
+    def _start(self, env_sender, addresses):
+        commands = [('mail', 'FROM:<%s>' % env_sender)]
+        for address in addresses:
+            commands.append(('rcpt', 'TO:<%s>' % address))
+        commands.append(('data', ''))
+
+        replies = []
+        if self.pipelining:
+            for command, args in commands:
+                self.smtp.putcmd(command, args)
+            for command in commands:
+                replies.append(self.smtp.getreply())
+        else:
+            for command, args in commands:
+                if command == 'data' and \
+                   not [r for r in replies[1:] if r[0] in (250, 251)]:
+                    # No recipient accepted, so there is no point in DATA.
+                    break
+                self.smtp.putcmd(command, args)
+                replies.append(self.smtp.getreply())
+                if command == 'mail' and replies[0][0] != 250:
+                    break
+
+        accepted = []
+        rejected = []
+        for address, reply in zip(addresses, replies[1:]):
+            if reply[0] in (250, 251):
+                accepted.append(address)
+            else:
+                rejected.append((address, reply))
+
+        data_reply = replies[-1] if len(replies) == len(commands) else None
+
+        if replies[0][0] != 250 or not accepted:
+            if data_reply is not None and data_reply[0] == 354:
+                # The server is waiting for the message nonetheless. End it
+                # without sending anything.
+                self.smtp.send(b'.\r\n')
+                self.smtp.getreply()
+            else:
+                self.smtp.rset()
+            if replies[0][0] != 250:
+                raise smtplib.SMTPSenderRefused(replies[0][0],
+                                                replies[0][1], env_sender)
+            raise smtplib.SMTPRecipientsRefused(dict(rejected))
+
+        if data_reply[0] != 354:
+            self.smtp.rset()
+            raise smtplib.SMTPDataError(*data_reply)
+
+        return SmtpMessage(self, len(accepted), rejected)
+
+
+class SmtpMessage(object):
+    """
+    A message being submitted through an SmtpConnection after the server
+    accepted its envelope. The message data is converted to CRLF line
+    endings and dot-stuffed as it is written, however it is split into
+    chunks.
+
+    rejected lists (address, (code, message)) for the recipients the server
+    refused.
+    """
+
+    def __init__(self, connection, recipients, rejected):
+        self.connection = connection
+        self.smtp = connection.smtp
+        # Number of accepted recipients: LMTP servers reply once for each.
+        self.recipients = recipients
+        self.rejected = rejected
+        self.line_start = True
+        self.pending_cr = False
+
+    def write(self, data):
+        if self.pending_cr:
+            data = b'\r' + data
+            self.pending_cr = False
+        # A CR at the end of a chunk may be followed by an LF in the next.
+        if data.endswith(b'\r'):
+            data = data[:-1]
+            self.pending_cr = True
+        if not data:
+            return
+
+        data = Line_ending.sub(b'\r\n', data)
+        data = data.replace(b'\n.', b'\n..')
+        if self.line_start and data.startswith(b'.'):
+            data = b'.' + data
+        self.line_start = data.endswith(b'\n')
+
+        try:
+            self.smtp.send(data)
+        except smtplib.SMTPServerDisconnected:
+            # Reported by finish().
+            pass
+
+    def abort(self):
+        """
+        Drops the connection, which is the only way of cancelling a message
+        in the middle of its data, so nothing is sent.
+        """
+        self.smtp.close()
+        self.connection.smtp = None
+
+    def finish(self):
+        end = b'.\r\n'
+        if self.pending_cr:
+            end = b'\r\n' + end
+        elif not self.line_start:
+            end = b'\r\n' + end
+
+        try:
+            self.smtp.send(end)
+            if self.connection.scheme == 'lmtp':
+                replies = [self.smtp.getreply()
+                           for i in range(self.recipients)]
+            else:
+                replies = [self.smtp.getreply()]
+        except (OSError, smtplib.SMTPException) as e:
+            self.connection.close()
+            raise DeliveryError("SMTP server %s: %s" % (self.connection.url,
+                                                        e))
+
+        failed = [reply for reply in replies if reply[0] != 250]
+        if failed:
+            raise DeliveryError("SMTP server %s: %d %s" % (
+                self.connection.url, failed[0][0],
+                failed[0][1].decode('ascii', 'replace')))
+
+
+class _Smtp(smtplib.SMTP):
+    """
+    smtplib.SMTP that, like smtplib.LMTP, connects to a UNIX socket if the
+    host is an absolute path.
+    """
+
+    def connect(self, host='localhost', port=0, source_address=None):
+        if not host.startswith('/'):
+            return super(_Smtp, self).connect(host, port, source_address)
+
+        try:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.file = None
+            self.sock.connect(host)
+        except OSError:
+            if self.sock:
+                self.sock.close()
+            self.sock = None
+            raise
+        code, message = self.getreply()
+        return code, message
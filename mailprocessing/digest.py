@@ -0,0 +1,161 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Digests of message files.
+
+Since maildir messages are never modified in place (only renamed), a
+file's digest stays valid as long as its device, inode, size and
+modification time do not change. DigestCache remembers digests under these,
+so files encountered again are not read again.
+"""
+
+import collections
+import hashlib
+import os
+import sqlite3
+import time
+
+# Digests not looked up for this many seconds are dropped from a
+# persistent cache when it is opened.
+EXPIRY = 90 * 24 * 3600
+
+# Maximum number of digests kept in memory.
+MEMORY_SIZE = 100000
+
+# Number of new digests after which a persistent cache is committed.
+COMMIT_INTERVAL = 100
+
+
+def file_digest(fp, algorithm):
+    """
+    Returns the hexadecimal digest of the contents of the binary file object
+    fp, computed with the hashlib algorithm algorithm.
+    """
+    hash_obj = hashlib.new(algorithm)
+    while True:
+        data = fp.read(65536)
+        if not data:
+            break
+        hash_obj.update(data)
+    return hash_obj.hexdigest()
+
+
+class DigestCache(object):
+    """
+    Caches the digests of files. If path is given, the digests are stored in
+    an SQLite database at path and survive restarts; otherwise they are kept
+    in memory. Raises OSError or sqlite3.Error if the database cannot be
+    opened.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        # Most recently used last.
+        self._digests = collections.OrderedDict()
+        self._db = None
+        self._pending = 0
+        if path is not None:
+            self._db = sqlite3.connect(path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS digests ("
+                "device INTEGER, inode INTEGER, algorithm TEXT, "
+                "size INTEGER, mtime INTEGER, digest TEXT, used INTEGER, "
+                "PRIMARY KEY (device, inode, algorithm))")
+            self._db.execute("DELETE FROM digests WHERE used < ?",
+                             (int(time.time()) - EXPIRY,))
+            self._db.commit()
+
+    def digest(self, path, algorithm):
+        """
+        Returns the hexadecimal digest of file path computed with algorithm,
+        reading the file only if its digest is not cached. Raises OSError if
+        the file cannot be read.
+        """
+        with open(path, "rb") as fp:
+            st = os.fstat(fp.fileno())
+            key = (st.st_dev, st.st_ino, algorithm)
+            version = (st.st_size, st.st_mtime_ns)
+
+            cached = self._lookup(key, version)
+            if cached is not None:
+                return cached
+
+            digest = file_digest(fp, algorithm)
+
+        self._store(key, version, digest)
+        return digest
+
+    def save(self):
+        """
+        Commits new digests to the database.
+        """
+        if self._db is not None and self._pending:
+            self._db.commit()
+            self._pending = 0
+
+    def close(self):
+        self.save()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    # ----------------------------------------------------------------
+
+    def _lookup(self, key, version):
+        if key in self._digests:
+            cached_version, digest = self._digests[key]
+            if cached_version == version:
+                self._digests.move_to_end(key)
+                return digest
+            return None
+        if self._db is None:
+            return None
+
+        row = self._db.execute(
+            "SELECT size, mtime, digest FROM digests "
+            "WHERE device = ? AND inode = ? AND algorithm = ?", key).fetchone()
+        if row is None or tuple(row[:2]) != version:
+            return None
+        self._db.execute(
+            "UPDATE digests SET used = ? "
+            "WHERE device = ? AND inode = ? AND algorithm = ?",
+            (int(time.time()),) + key)
+        self._pending += 1
+        self._remember(key, version, row[2])
+        return row[2]
+
+    def _remember(self, key, version, digest):
+        self._digests[key] = (version, digest)
+        self._digests.move_to_end(key)
+        if len(self._digests) > MEMORY_SIZE:
+            self._digests.popitem(last=False)
+
+    def _store(self, key, version, digest):
+        self._remember(key, version, digest)
+        if self._db is None:
+            return
+        self._db.execute(
+            "INSERT OR REPLACE INTO digests "
+            "(device, inode, algorithm, size, mtime, digest, used) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            key + version + (digest, int(time.time())))
+        self._pending += 1
+        if self._pending >= COMMIT_INTERVAL:
+            self.save()
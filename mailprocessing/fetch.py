@@ -0,0 +1,315 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Incremental reading and parsing of IMAP FETCH responses.
+
+A response is handled as a list of parts in imaplib's format: a line
+followed by a literal is a (line, literal) tuple, the line ending the
+response is plain bytes. FETCH responses are read from the connection and
+handed out one at a time, so memory use does not depend on how many
+messages a FETCH command covers.
+"""
+
+import collections
+import imaplib
+import re
+
+from email import errors as email_errors
+from email import header as email_header
+from email import parser as email_parser
+
+# Size of the chunks a streamed message body is passed on in.
+CHUNK_SIZE = 65536
+
+Body_literal = re.compile(br'.* BODY\[\](<\d+>)? \{(?P<size>\d+)\}$',
+                          re.IGNORECASE)
+Fetch_response = re.compile(br'\* (?P<seq>\d+) FETCH \(', re.IGNORECASE)
+Literal = re.compile(br'.*\{(?P<size>\d+)\}$')
+Token = re.compile(br'''
+    \s*(?:
+      (?P<open>\() |
+      (?P<close>\)) |
+      "(?P<quoted>(?:[^"\\]|\\.)*)" |
+      (?P<literal>\{\d+\}$) |
+      (?P<atom>[^\s()"\[\]]+(?:\[[^\]]*\])?(?:<[^>]*>)?)
+    )''', re.VERBOSE)
+
+
+def is_fetch(parts):
+    """
+    Returns True if parts is a FETCH response.
+    """
+    first = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+    return Fetch_response.match(first) is not None
+
+
+def parse_fetch(parts):
+    """
+    Parses the FETCH response parts. Returns a dict mapping the upper case
+    names of the message data items (such as 'UID', 'FLAGS' or
+    'BODY[HEADER]') to their values: bytes for atoms, strings and literals,
+    lists for parenthesized lists and None for NIL. Raises ValueError if the
+    response is malformed.
+    """
+    first = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+    m = Fetch_response.match(first)
+    if m is None:
+        raise ValueError("not a FETCH response: %r" % first[:80])
+
+    if isinstance(parts[0], tuple):
+        parts = [(first[m.end():], parts[0][1])] + parts[1:]
+    else:
+        parts = [first[m.end():]] + parts[1:]
+
+    items = _parse_list(_tokenize(parts))
+
+    if len(items) % 2:
+        raise ValueError("odd number of FETCH items: %r" % first[:80])
+
+    attributes = {}
+    for i in range(0, len(items), 2):
+        if not isinstance(items[i], bytes):
+            raise ValueError("bad FETCH item name: %r" % (items[i],))
+        attributes[items[i].decode('ascii').upper()] = items[i + 1]
+    return attributes
+
+
+def flags(attributes):
+    """
+    Returns the FLAGS of the parsed FETCH response attributes as a list of
+    strings.
+    """
+    return [flag.decode('ascii') for flag in attributes.get('FLAGS') or []]
+
+
+def body(attributes):
+    """
+    Returns the first BODY[...] section of the parsed FETCH response
+    attributes or None if there is none.
+    """
+    for name, value in attributes.items():
+        if name.startswith('BODY['):
+            return value
+    return None
+
+
+def decode_headers(data, uid, log_error):
+    """
+    Parses the message header block data (bytes) and returns a dict mapping
+    lower case header names to their decoded values. Undecodable headers are
+    reported through log_error and kept as they are.
+    """
+
+    headers_raw = email_parser.HeaderParser().parsestr(
+        data.decode('ascii', 'ignore'))
+
+    headers = {}
+    for name in headers_raw.keys():
+        value_parts = []
+        for header in headers_raw.get_all(name, []):
+            try:
+                for (s, c) in email_header.decode_header(header):
+                    # email.header.decode_header in Python 3.x may
+                    # return either [(str, None)] or [(bytes,
+                    # None), ..., (bytes, encoding)]. We must
+                    # compensate for this.
+                    if not isinstance(s, str):
+                        s = s.decode(c if c else "ascii")
+                    value_parts.append(s)
+            except (email_errors.HeaderParseError, LookupError,
+                    ValueError):
+                log_error("Error: Could not decode header {0} in message "
+                          "UID {1}".format(ascii(header), uid))
+                value_parts.append(header)
+        headers[name.lower()] = " ".join(value_parts)
+
+    return headers
+
+
+def read_response(readline, read, sink=None):
+    """
+    Reads one response including all of its literals using the callables
+    readline (returning a line without its CRLF) and read (returning the
+    given number of bytes). Returns the response's parts.
+
+    If the callable sink is given, complete message bodies (BODY[]) are
+    passed to it in chunks of up to CHUNK_SIZE bytes as they are read rather
+    than being returned. Their literals are returned empty.
+    """
+    parts = []
+    while True:
+        line = readline()
+        m = Literal.match(line)
+        if m is None:
+            parts.append(line)
+            return parts
+        size = int(m.group('size'))
+        if sink is not None and Body_literal.match(line):
+            while size > 0:
+                chunk = read(min(size, CHUNK_SIZE))
+                if not chunk:
+                    # The connection was closed; reading the next line
+                    # reports that.
+                    break
+                sink(chunk)
+                size -= len(chunk)
+            parts.append((line, b''))
+        else:
+            parts.append((line, read(size)))
+
+
+def uid_fetch_imaplib(imap, arg_lists, depth):
+    """
+    Issues UID FETCH on the imaplib.IMAP4 connection imap once for every
+    tuple of arguments in arg_lists, keeping up to depth commands in flight.
+    Yields the parts of each FETCH response as soon as it is read. Other
+    untagged responses are stored in imap.untagged_responses as imaplib
+    would store them. Raises imap.error if a command fails.
+    """
+    pending = collections.deque()
+    for args in arg_lists:
+        if len(pending) >= depth:
+            for parts in _complete_imaplib(imap, pending.popleft()):
+                yield parts
+        pending.append(imap._command('UID', 'FETCH', *args))
+
+    while pending:
+        for parts in _complete_imaplib(imap, pending.popleft()):
+            yield parts
+
+
+def uid_fetch_body_imaplib(imap, uid, sink):
+    """
+    Issues UID FETCH uid BODY.PEEK[] on the imaplib.IMAP4 connection imap,
+    passing the message to the callable sink in chunks as it is read (see
+    read_response()). Returns the parts of the FETCH responses received.
+    Raises imap.error if the command fails.
+    """
+    tag = imap._command('UID', 'FETCH', uid, 'BODY.PEEK[]')
+    return list(_complete_imaplib(imap, tag, sink))
+
+# ----------------------------------------------------------------
+
+
+def _complete_imaplib(imap, tag, sink=None):
+    """
+    Reads the responses to the command tagged tag up to and including its
+    completion. The server answers commands in order, so anything received
+    before the completion belongs to this command.
+    """
+
+    while True:
+        parts = read_response(imap._get_line, imap.read, sink)
+        first = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+
+        if first.startswith(tag + b' '):
+            del imap.tagged_commands[tag]
+            typ, _, data = first[len(tag) + 1:].partition(b' ')
+            if typ != b'OK':
+                raise imap.error("UID command error: %s %s" %
+                                 (typ.decode('ascii', 'replace'), data))
+            return
+
+        if Fetch_response.match(first):
+            yield parts
+            continue
+
+        _append_untagged_imaplib(imap, parts)
+
+
+def _append_untagged_imaplib(imap, parts):
+    first = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+
+    m = imaplib.Untagged_status.match(first)
+    if m is not None:
+        dat = m.group('data')
+        if m.group('data2'):
+            dat += b' ' + m.group('data2')
+    else:
+        m = imaplib.Untagged_response.match(first)
+        if m is None:
+            raise imap.abort("unexpected response: %r" % first)
+        dat = m.group('data') or b''
+
+    typ = m.group('type').decode('ascii')
+
+    if typ == 'BYE':
+        raise imap.abort(dat.decode('ascii', 'replace'))
+
+    for part in parts:
+        if part is parts[0]:
+            part = (dat, part[1]) if isinstance(part, tuple) else dat
+        imap._append_untagged(typ, part)
+
+    if typ in ('OK', 'NO', 'BAD'):
+        m = imaplib.Response_code.match(dat)
+        if m is not None:
+            imap._append_untagged(m.group('type').decode('ascii'),
+                                  m.group('data'))
+
+
+def _tokenize(parts):
+    """
+    Splits the response parts into tokens. Yields (kind, value) pairs, kind
+    being one of 'open', 'close', 'string' and 'atom'.
+    """
+    for part in parts:
+        if isinstance(part, tuple):
+            line, literal = part
+        else:
+            line, literal = part, None
+
+        pos = 0
+        while pos < len(line):
+            m = Token.match(line, pos)
+            if m is None:
+                if line[pos:].strip():
+                    raise ValueError("unexpected data: %r" %
+                                     line[pos:pos + 80])
+                break
+            pos = m.end()
+            if m.group('open'):
+                yield 'open', None
+            elif m.group('close'):
+                yield 'close', None
+            elif m.group('quoted') is not None:
+                yield 'string', re.sub(br'\\(.)', br'\1', m.group('quoted'))
+            elif m.group('atom'):
+                yield 'atom', m.group('atom')
+
+        if literal is not None:
+            yield 'string', literal
+
+
+def _parse_list(tokens):
+    """
+    Parses tokens up to the parenthesis closing the current list.
+    """
+    items = []
+    for kind, value in tokens:
+        if kind == 'open':
+            items.append(_parse_list(tokens))
+        elif kind == 'close':
+            return items
+        elif kind == 'atom' and value.upper() == b'NIL':
+            items.append(None)
+        else:
+            items.append(value)
+    raise ValueError("unterminated list")
@@ -0,0 +1,131 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Copying of mail files without copying their contents where possible.
+
+Mail files are never modified once delivered, so a copy can share the
+original's data. Depending on the strategy, copy_file() tries, in this order:
+
+link
+    A hard link to the original (only on the same file system).
+reflink
+    A copy-on-write clone of the original's data (FICLONE, supported by
+    file systems such as btrfs and XFS).
+copy
+    A copy made by the kernel (copy_file_range() or sendfile()), or
+    finally by reading and writing the data.
+
+Each strategy falls back to the ones after it.
+"""
+
+import errno
+import fcntl
+import os
+import shutil
+import sys
+
+STRATEGIES = ('link', 'reflink', 'copy')
+
+# _IOW(0x94, 9, int) from <linux/fs.h>.
+FICLONE = 0x40049409
+
+# Errors indicating that a way of copying is not supported for the files at
+# hand, rather than that copying failed.
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTTY,
+                errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+
+
+def copy_file(source, target, strategy='link'):
+    """
+    Creates the file target, which must not exist, as a copy of the file
+    source, using strategy (one of STRATEGIES). Returns how the copy was
+    made: 'link', 'reflink', 'copy_file_range', 'sendfile' or 'read/write'.
+    Raises OSError if the copy fails; a partial copy is removed.
+    """
+
+    if strategy == 'link':
+        try:
+            os.link(source, target)
+            return 'link'
+        except OSError:
+            # A different file system, too many links, or hard links not
+            # permitted (see protected_hardlinks); copying will tell if
+            # something else is wrong.
+            pass
+
+    with open(source, "rb") as source_fp:
+        target_fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        try:
+            with os.fdopen(target_fd, "wb") as target_fp:
+                if strategy in ('link', 'reflink') and \
+                   _reflink(source_fp, target_fp):
+                    return 'reflink'
+                return _copy_data(source_fp, target_fp)
+        except BaseException:
+            try:
+                os.unlink(target)
+            except OSError:
+                pass
+            raise
+
+
+def _reflink(source_fp, target_fp):
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(target_fp.fileno(), FICLONE, source_fp.fileno())
+        return True
+    except OSError as e:
+        if e.errno in _UNSUPPORTED:
+            return False
+        raise
+
+
+def _copy_data(source_fp, target_fp):
+    source_fd = source_fp.fileno()
+    target_fd = target_fp.fileno()
+    size = os.fstat(source_fd).st_size
+
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        offset = 0
+        try:
+            while offset < size:
+                if method == 'copy_file_range':
+                    count = os.copy_file_range(source_fd, target_fd,
+                                               size - offset, offset, offset)
+                else:
+                    os.lseek(target_fd, offset, os.SEEK_SET)
+                    count = os.sendfile(target_fd, source_fd, offset,
+                                        size - offset)
+                if count == 0:
+                    break
+                offset += count
+            if offset > 0 or size == 0:
+                return method
+            # Some file systems report nothing copied rather than an
+            # error.
+        except OSError as e:
+            if offset > 0 or e.errno not in _UNSUPPORTED:
+                raise
+
+    shutil.copyfileobj(source_fp, target_fp)
+    return 'read/write'
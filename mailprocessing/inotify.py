@@ -0,0 +1,161 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Minimal interface to Linux inotify(7), using ctypes.
+
+Only what maildirproc needs for watching directories for new files is
+provided. Everything raises OSError if inotify is not available, so callers
+can fall back to polling.
+"""
+
+import ctypes
+import errno
+import os
+import select
+import struct
+import sys
+
+# Event masks (see <sys/inotify.h>).
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# statfs(2) file system types on which inotify does not see changes made by
+# other hosts.
+REMOTE_FILESYSTEMS = {
+    0x00006969: 'nfs',
+    0x0000517b: 'smb',
+    0xff534d42: 'cifs',
+    0xfe534d42: 'smb2',
+    0x00c36400: 'ceph',
+    0x5346414f: 'afs',
+    0x01021997: '9p',
+    }
+
+# struct inotify_event without its variable length name.
+_EVENT = struct.Struct('iIII')
+
+# Large enough for many events, and for at least one with a name of
+# NAME_MAX bytes.
+_BUFFER_SIZE = 65536
+
+_libc = None
+
+
+class Inotify(object):
+    """
+    An inotify instance. Raises OSError if inotify is not available on this
+    system.
+    """
+
+    def __init__(self):
+        self._libc = _load_libc()
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            _raise_errno()
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """
+        Watches path for the events in mask. Returns the watch descriptor
+        the events are reported with.
+        """
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            _raise_errno(path)
+        return wd
+
+    def read(self, timeout=None):
+        """
+        Waits up to timeout seconds (indefinitely if timeout is None) for
+        events and returns all events queued as a list of (wd, mask, name)
+        tuples. name is the name of the file in the watched directory the
+        event is about, or "" for events about the directory itself.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        data = b""
+        while True:
+            try:
+                chunk = os.read(self.fd, _BUFFER_SIZE)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            data += chunk
+
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def remote_filesystem(path):
+    """
+    Returns the name of the network file system path is on, or None if it
+    is on a local file system (or its type cannot be determined).
+    """
+    try:
+        libc = _load_libc()
+    except OSError:
+        return None
+    # struct statfs starts with f_type, a long on all common platforms.
+    buf = ctypes.create_string_buffer(256)
+    if libc.statfs(os.fsencode(path), buf) != 0:
+        return None
+    f_type = ctypes.c_long.from_buffer(buf).value & 0xffffffff
+    return REMOTE_FILESYSTEMS.get(f_type)
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "C library lacks inotify support")
+        _libc = libc
+    return _libc
+
+
+def _raise_errno(path=None):
+    e = ctypes.get_errno()
+    raise OSError(e, os.strerror(e), path)
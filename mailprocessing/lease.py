@@ -0,0 +1,278 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Distribution of accounts across imapproc nodes through lease files.
+
+Every account has a lease file <NAME>.lease in a directory shared by all
+nodes, holding the name of the node currently processing the account and
+the time its lease expires. Lease files are only ever modified while
+holding an exclusive flock() on them, so two nodes cannot claim the same
+account at once. Nodes renew their leases periodically; the leases of a
+node that died expire and are claimed by the remaining nodes.
+
+Every node also touches a heartbeat file nodes/<NODE> in the directory.
+From the number of live nodes, each node computes its fair share of the
+accounts. A node holding more than its share releases the surplus (once
+the accounts are not being processed), a node holding less claims free
+leases, so accounts are rebalanced as nodes come and go.
+
+A node that fails to renew a lease (because the lease directory cannot be
+reached, for instance) stops processing the account once the lease it last
+wrote expires, since other nodes may claim it from then on.
+"""
+
+import contextlib
+import fcntl
+import os
+import socket
+import threading
+import time
+import zlib
+
+LEASE_SUFFIX = '.lease'
+NODE_DIRECTORY = 'nodes'
+
+
+class LeaseManager(object):
+    """
+    Claims, renews and releases the leases for the accounts names in the
+    lease directory directory on behalf of the node node (defaults to
+    HOST.PID). Leases are valid for timeout seconds and renewed every third
+    of that. Log messages are passed to the callable log.
+
+    held maps the names of the accounts whose leases the node holds to the
+    time the leases expire.
+    """
+
+    def __init__(self, directory, names, node=None, timeout=120, log=None):
+        self.directory = directory
+        self.names = list(names)
+        self.node = node or "%s.%d" % (socket.gethostname(), os.getpid())
+        self.timeout = timeout
+        self.log = log or (lambda text: None)
+        self.held = {}
+        self.busy = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        # Start looking for free leases at a different account on every
+        # node, so nodes starting at the same time do not all compete for
+        # the same leases.
+        offset = zlib.crc32(self.node.encode('utf-8')) % max(len(names), 1)
+        self.names = self.names[offset:] + self.names[:offset]
+
+        os.makedirs(os.path.join(directory, NODE_DIRECTORY), exist_ok=True)
+
+    def start(self):
+        """
+        Claims the node's initial share of leases and starts renewing them in
+        a background thread.
+        """
+        self.renew()
+        self._thread = threading.Thread(target=self._run,
+                                        name="lease-renewal", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops renewing leases and releases all leases the node holds.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            for name in list(self.held):
+                self._release(name)
+        try:
+            os.unlink(self._node_file(self.node))
+        except OSError:
+            pass
+
+    def holds(self, name):
+        with self._lock:
+            self._expire()
+            return name in self.held
+
+    @contextlib.contextmanager
+    def holding(self, name):
+        """
+        Context manager yielding True if the node holds an unexpired lease
+        for the account name. The lease is not released while the context is
+        active.
+        """
+        with self._lock:
+            self._expire()
+            held = name in self.held
+            if held:
+                self.busy.add(name)
+        try:
+            yield held
+        finally:
+            if held:
+                with self._lock:
+                    self.busy.discard(name)
+
+    def renew(self):
+        """
+        Performs one round of lease maintenance: touches the node's
+        heartbeat file, renews the leases held, releases leases beyond the
+        node's share and claims free leases up to it.
+        """
+        with self._lock:
+            share = self._share()
+
+            for name in list(self.held):
+                expires = self._update(name, self._renew_lease)
+                if expires is None:
+                    del self.held[name]
+                    self.log("==> Lost lease for account %s" % name)
+                else:
+                    self.held[name] = expires
+
+            surplus = len(self.held) - share
+            for name in [n for n in self.names
+                         if n in self.held and n not in self.busy]:
+                if surplus <= 0:
+                    break
+                self._release(name)
+                surplus -= 1
+
+            for name in self.names:
+                if len(self.held) >= share:
+                    break
+                if name in self.held:
+                    continue
+                expires = self._update(name, self._claim_lease)
+                if expires is not None:
+                    self.held[name] = expires
+                    self.log("==> Claimed lease for account %s" % name)
+
+    # ----------------------------------------------------------------
+
+    def _run(self):
+        while not self._stopped.wait(self.timeout / 3):
+            try:
+                self.renew()
+            except OSError as e:
+                self.log("Error: Renewing leases failed: %s" % e)
+                with self._lock:
+                    self._expire()
+
+    def _expire(self):
+        """
+        Forgets the leases that expired without being renewed. Other nodes
+        may have claimed them since.
+        """
+        now = time.time()
+        for name, expires in list(self.held.items()):
+            if expires <= now:
+                del self.held[name]
+                self.log("==> Lease for account %s expired" % name)
+
+    def _share(self):
+        """
+        Touches the node's heartbeat file and returns the number of accounts
+        the node should hold, given the number of live nodes. Heartbeat files
+        of dead nodes are removed.
+        """
+        now = time.time()
+
+        path = self._node_file(self.node)
+        open(path, 'a').close()
+        os.utime(path, (now, now))
+
+        nodes = 0
+        directory = os.path.join(self.directory, NODE_DIRECTORY)
+        for entry in os.scandir(directory):
+            try:
+                mtime = entry.stat().st_mtime
+            except OSError:
+                continue
+            if mtime >= now - self.timeout:
+                nodes += 1
+            else:
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    pass
+
+        nodes = max(nodes, 1)
+        return (len(self.names) + nodes - 1) // nodes
+
+    def _release(self, name):
+        self._update(name, self._release_lease)
+        self.held.pop(name, None)
+        self.log("==> Released lease for account %s" % name)
+
+    def _claim_lease(self, owner, expires, now):
+        if owner != self.node and owner and expires > now:
+            return None
+        return self.node, now + self.timeout
+
+    def _renew_lease(self, owner, expires, now):
+        if owner != self.node:
+            return None
+        return self.node, now + self.timeout
+
+    def _release_lease(self, owner, expires, now):
+        if owner != self.node:
+            return None
+        return "", 0
+
+    def _update(self, name, func):
+        """
+        Locks the lease file for account name and passes its owner, its
+        expiry time and the current time to func. If func returns a new
+        (owner, expiry time) pair, it is written to the lease file. Returns
+        the new expiry time, or None if the lease file was not updated.
+        """
+        path = os.path.join(self.directory, name + LEASE_SUFFIX)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            owner, expires = _parse_lease(os.read(fd, 4096))
+            lease = func(owner, expires, time.time())
+            if lease is None:
+                return None
+            data = ("%s %.3f\n" % lease).encode('utf-8')
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, data)
+            os.fsync(fd)
+            return lease[1]
+        finally:
+            # Closing the file releases the lock.
+            os.close(fd)
+
+    def _node_file(self, node):
+        return os.path.join(self.directory, NODE_DIRECTORY, node)
+
+
+def _parse_lease(data):
+    """
+    Returns the (owner, expiry time) pair in the lease file contents data,
+    or ("", 0) for an empty or garbled lease file.
+    """
+    try:
+        owner, expires = data.decode('utf-8').split()
+        return owner, float(expires)
+    except ValueError:
+        return "", 0
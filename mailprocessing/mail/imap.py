@@ -18,13 +18,10 @@
 # 02110-1301, USA.
 
 import imaplib
-import subprocess
-
-from email import errors as email_errors
-from email import header as email_header
-from email import parser as email_parser
 
 from mailprocessing.mail.base import MailBase
+from mailprocessing import delivery
+from mailprocessing import fetch
 from mailprocessing import signals
 
 
@@ -39,6 +36,8 @@ class ImapMail(MailBase):
         self.message_flags = None
         self._uid = kwargs['uid']
         self._folder = kwargs['folder']
+        # Header fields self._headers is restricted to (None: all of them).
+        self._header_fields = kwargs.get('header_fields')
 
         if 'headers' in kwargs:
             self._headers = kwargs['headers']
@@ -48,6 +47,28 @@ class ImapMail(MailBase):
 
         super(ImapMail, self).__init__(processor, **kwargs)
 
+    def __getitem__(self, header_name):
+        if self._header_fields is not None \
+           and header_name.lower() not in self._header_fields:
+            # The header field was not downloaded. Add it to the processor's
+            # header fields and download it for all messages in this
+            # message's folder, so the other messages have it as well.
+            fields = self._processor.header_fields
+            if fields is not None and header_name.lower() not in fields:
+                self._processor.header_fields = fields + [header_name]
+            self._processor.log_debug(
+                "==> Header field {0} missing for UID {1}, downloading "
+                "it".format(header_name, self.uid))
+            headers = self._processor.fetch_missing_headers(self.folder,
+                                                            self.uid)
+            if headers is None:
+                # Not a cached message.
+                self._fetch_headers()
+            else:
+                self._headers = headers
+                self._header_fields = self._processor.header_fields
+        return super(ImapMail, self).__getitem__(header_name)
+
     @property
     def uid(self):
         """
@@ -78,44 +99,11 @@ class ImapMail(MailBase):
         # where applicable.
         folder = self.processor.path_ensure_prefix(folder)
 
-        # Make sure we have this message's folder selected (UIDs should be
-        # globally unique but may only unique in folder scope in sufficiently
-        # broken IMAP implementations).
-        if self.processor.selected != self.folder:
-            self.processor.select(self.folder)
-
         folder = self._processor.list_path(folder, sep=self._processor.separator)
 
-        try:
-            self._processor.log("==> Copying {0} to {1}".format(self.uid, folder))
-            status, data = self._processor.imap.uid('copy', self.uid, folder)
-        except self._processor.imap.error as e:
-            self._processor.fatal_imap_error("Copying message UID %s to %s"
-                                             % (self.uid, folder), e)
-        if status == 'NO':
-            if create and 'TRYCREATE' in data[0].decode('ascii'):
-                self._processor.log("==> Destination folder %s does not exist, "
-                                    "creating." % folder)
-                self._processor.create_folder(folder)
-                try:
-                    self._processor.log("==> Copying {0} to {1}".format(self.uid, folder))
-                    status, data = self._processor.imap.uid('copy', self.uid, folder)
-                except self._processor.imap.error as e:
-                    self._processor.fatal_imap_error("Copying message UID %s to %s"
-                                                     % (self.uid, folder), e)
-                if status == 'NO':
-                    self._processor.fatal_imap_error("Copying message UID %s "
-                                                     " to %s failed with NO, "
-                                                     " aborting." %
-                                                     (self.uid, folder))
-            else:
-                self._processor.fatal_error("Destination folder %s does not "
-                                            "exist and I am not supposed to "
-                                            "create folders. Please use "
-                                            "move() or copy() with "
-                                            "create=True to automatically "
-                                            "create nonexistent "
-                                            "folders." % folder)
+        self._processor.log("==> Copying {0} to {1}".format(self.uid, folder))
+        self._processor.queue_action('copy', self.folder, self.uid, folder,
+                                     create)
 
     def delete(self):
         """
@@ -125,25 +113,8 @@ class ImapMail(MailBase):
         if signals.terminate():
             self.processor.clean_exit()
 
-        # Make sure we have this message's folder selected (UIDs should be
-        # globally unique but may only unique in folder scope in sufficiently
-        # broken IMAP implementations).
-        if self.processor.selected != self.folder:
-            self.processor.select(self.folder)
-
-        try:
-            self._processor.log("==> Deleting %s" % self.uid)
-            self._processor.imap.uid('store', self.uid, '+FLAGS', '\\Deleted')
-            self._processor.imap.expunge()
-        except self._processor.imap.error as e:
-            # Fail hard because repeated failures here can leave a mess of
-            # messages with `Deleted` flags.
-            self._processor.fatal_imap_error("Deleting message %s'" %
-                                             self.uid, e)
-            raise
-
-        # make sure this gets purged from cache later
-        self.processor.cache_delete[self.folder].append(self.uid)
+        self._processor.log("==> Deleting %s" % self.uid)
+        self._processor.queue_action('delete', self.folder, self.uid)
 
     def forward(self, addresses, env_sender, delete=True):
         """
@@ -154,12 +125,6 @@ class ImapMail(MailBase):
         if signals.terminate():
             self.processor.clean_exit()
 
-        # Make sure we have this message's folder selected (UIDs should be
-        # globally unique but may be on a per folder basis in sufficiently
-        # broken IMAP implementations).
-        if self.processor.selected != self.folder:
-            self._processor.select(self.folder)
-
         if isinstance(addresses, str):
             addresses = [addresses]
         else:
@@ -168,40 +133,54 @@ class ImapMail(MailBase):
             copy = ""
         else:
             copy = " copy"
-        flags = self._processor.sendmail_flags
-        if env_sender is not None:
-            flags += " -f {0}".format(env_sender)
 
         self._processor.log(
             "==> Forwarding{0} to {1!r}".format(copy, addresses))
+
         try:
-            ret, msg = self._processor.imap.uid('fetch', self.uid, "RFC822")
-        except self._processor.imap.error as e:
-            # Fail soft, since we haven't changed any mailbox state or forwarded
-            # anything, yet. Hence we might as well retry later.
-            self._processor.log_imap_error(
-                "Error forwarding: Could not retrieve message UID {0}: "
-                "{1}".format(self.uid, e))
+            message = self._processor.start_delivery(env_sender, addresses)
+        except delivery.DeliveryError as e:
+            self._processor.log_error("Forwarding message failed: %s" % e)
             return
 
-        p = subprocess.Popen(
-            "{0} {1} -- {2}".format(self._processor.sendmail,
-                                    flags,
-                                    " ".join(addresses)
-                                    ),
-            shell=True,
-            stdin=subprocess.PIPE)
-
-        p.stdin.write(msg)
-        p.stdin.close()
-        sendmail_status = p.wait()
-
-        if sendmail_status != 0:
-            self._processor.log_error("Forwarding message failed: %s "
-                                      "exited %d" % (self._processor.sendmail,
-                                                     sendmail_status))
+        with self._processor.session_for(self.folder):
+            # The message is streamed into the delivery as it arrives. If it
+            # cannot be retrieved, the delivery is aborted before the end of
+            # the message, so nothing gets sent.
+            try:
+                # Make sure we have this message's folder selected (UIDs
+                # should be globally unique but may be on a per folder basis
+                # in sufficiently broken IMAP implementations).
+                self._processor.ensure_selected(self.folder)
+                received = self._processor.fetch_message(self.uid,
+                                                         message.write)
+            except self._processor.imap.error as e:
+                # Fail soft, since we haven't changed any mailbox state or
+                # forwarded anything, yet. Hence we might as well retry later.
+                message.abort()
+                self._processor.log_imap_error(
+                    "Error forwarding: Could not retrieve message UID {0}: "
+                    "{1}".format(self.uid, e))
+                return
+
+        if not received:
+            message.abort()
+            self._processor.log_error(
+                "Error forwarding: Could not retrieve message UID "
+                "{0}".format(self.uid))
             return
 
+        try:
+            message.finish()
+        except delivery.DeliveryError as e:
+            self._processor.log_error("Forwarding message failed: %s" % e)
+            return
+
+        for address, (code, text) in message.rejected:
+            self._processor.log_error(
+                "Forwarding to {0} failed: {1} {2}".format(
+                    address, code, text.decode('ascii', 'replace')))
+
         if delete:
             self.delete()
 
@@ -260,8 +239,8 @@ class ImapMail(MailBase):
 
         folder = self._processor.list_path(folder, sep=self._processor.separator)
         self._processor.log("==> Moving UID {0} to {1}".format(self.uid, folder))
-        self.copy(folder, create)
-        self.delete()
+        self._processor.queue_action('move', self.folder, self.uid, folder,
+                                     create)
 
     def parse_mail(self):
         """
@@ -277,55 +256,52 @@ class ImapMail(MailBase):
         self._processor.log("")
         self._processor.log("New mail detected with UID {0}:".format(self.uid))
 
-        try:
-            ret, data = self._processor.imap.uid('fetch', self.uid,
-                                                 "(FLAGS BODY.PEEK[HEADER])")
-        except self._processor.imap.error as e:
-            # Anything imaplib raises an exception for is fatal here.
-            self._processor.fatal_error("Error retrieving message "
-                                        "with UID %s: %s" % (self.uid, e))
+        return self._fetch_headers()
+
+    # ----------------------------------------------------------------
+
+    def _fetch_headers(self):
+        """
+        Downloads the message's flags and the header fields selected by the
+        processor's header_fields property.
+        """
+
+        with self._processor.session_for(self.folder):
+            self._processor.ensure_selected(self.folder)
+            try:
+                ret, data = self._processor.imap.uid(
+                    'fetch', self.uid,
+                    "(FLAGS %s)" % self._processor.header_fetch_item())
+            except self._processor.imap.error as e:
+                # Anything imaplib raises an exception for is fatal here.
+                self._processor.fatal_error("Error retrieving message "
+                                            "with UID %s: %s" % (self.uid, e))
         if ret != 'OK':
             self._processor.log_error(
                 "Error: Could not retrieve message {0}: {1}".format(self.uid,
                                                                     ret))
             return False
 
+        # The first (response, literal) pair is this message's; there is
+        # none if the message was expunged in the meantime.
+        data = [part for part in data if isinstance(part, tuple)]
+        if not data:
+            self._processor.log_error(
+                "Error: Could not retrieve message {0}: no such "
+                "message".format(self.uid))
+            return False
+
         flags = imaplib.ParseFlags(data[0][0])
 
-        if self.message_flags is None:
-            self.message_flags = []
-            for flag in flags:
-                self.message_flags.append(flag.decode('ascii'))
-
-        headers = email_parser.Parser().parsestr(data[0][1].decode('ascii',
-                                                                   'ignore'),
-                                                 headersonly=True)
-
-        if self._headers is None:
-            self._headers = {}
-            for name in headers.keys():
-                value_parts = []
-                for header in headers.get_all(name, []):
-                    try:
-                        for (s, c) in email_header.decode_header(header):
-                            # email.header.decode_header in Python 3.x may
-                            # return either [(str, None)] or [(bytes,
-                            # None), ..., (bytes, encoding)]. We must
-                            # compensate for this.
-                            if not isinstance(s, str):
-                                s = s.decode(c if c else "ascii")
-                            value_parts.append(s)
-                    except (email_errors.HeaderParseError, LookupError,
-                            ValueError):
-                        self._processor.log_error(
-                            "Error: Could not decode header {0} in message "
-                            "UID {1}".format(ascii(header), self.uid))
-                        value_parts.append(header)
-                self._headers[name.lower()] = " ".join(value_parts)
+        self.message_flags = []
+        for flag in flags:
+            self.message_flags.append(flag.decode('ascii'))
 
-        return True
+        self._header_fields = self._processor.header_fields
+        self._headers = fetch.decode_headers(data[0][1], self.uid,
+                                             self._processor.log_error)
 
-    # ----------------------------------------------------------------
+        return True
 
     def _log_processing(self):
         """
@@ -19,15 +19,15 @@
 
 import os
 import shutil
-import subprocess
 
 from email import errors as email_errors
 from email import header as email_header
 from email import parser as email_parser
 
+from mailprocessing import delivery
 from mailprocessing.mail.base import MailBase
 from mailprocessing.util import iso_8601_now
-from mailprocessing.util import sha1sum
+from mailprocessing.util import read_header
 
 
 class MaildirMail(MailBase):
@@ -41,6 +41,23 @@ class MaildirMail(MailBase):
     def maildir(self):
         return self._maildir
 
+    @property
+    def digest(self):
+        """
+        The hexadecimal digest of the message file, computed with the
+        processor's digest_algorithm, or None if the file cannot be read.
+        """
+        return self._processor.file_digest(self.path,
+                                           self._processor.digest_algorithm)
+
+    @property
+    def sha1(self):
+        """
+        The hexadecimal SHA1 digest of the message file, or None if the file
+        cannot be read.
+        """
+        return self._processor.file_digest(self.path, 'sha1')
+
     @property
     def path(self):
         return self._path
@@ -106,14 +123,21 @@ class MaildirMail(MailBase):
         self._processor.log("")
         self._processor.log("New mail detected at {0}:".format(iso_8601_now()))
         self._processor.log("Path:       {0}".format(ascii(self.path)))
+        limit = self._processor.max_header_size
         try:
-            fp = open(self.path, encoding=encoding)
-        except IOError as e:
+            data, truncated = read_header(self.path, limit)
+        except OSError as e:
             # The file was probably (re)moved by some other process.
             self._processor.log_mail_opening_error(self.path, e)
             return False
-        headers = email_parser.Parser().parse(fp, headersonly=True)
-        fp.close()
+        if truncated:
+            self._processor.log_error(
+                "Error: Header of {0} exceeds {1} bytes; ignoring the "
+                "rest".format(ascii(self.path), limit))
+        # Only the header needs to be decoded. Line endings are converted
+        # like in text mode.
+        data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        headers = email_parser.HeaderParser().parsestr(data.decode(encoding))
         for name in headers.keys():
             value_parts = []
             for header in headers.get_all(name, []):
@@ -144,35 +168,21 @@ class MaildirMail(MailBase):
             except OSError as e:
                 self._processor.fatal_error("Couldn't create maildir "
                                             "%s: %s" % (maildir, e))
-        try:
-            source_fp = open(self.path, "rb")
-        except IOError as e:
-            # The file was probably (re)moved by some other process.
-            self._processor.log_mail_opening_error(self.path, e)
-            return
-
         tmp_target = os.path.join(
             self._processor.maildir_base,
             maildir,
             "tmp",
             self._processor.create_maildir_name())
         try:
-            tmp_target_fp = os.fdopen(
-                os.open(tmp_target, os.O_WRONLY | os.O_CREAT | os.O_EXCL),
-                "wb")
-        except IOError as e:
-            self._processor.log_io_error(
-                "Could not open {0} for writing".format(tmp_target),
-                e)
-            return
-        try:
-            shutil.copyfileobj(source_fp, tmp_target_fp)
-            source_fp.close()
-            tmp_target_fp.close()
+            self._processor.copy_file(self.path, tmp_target)
         except IOError as e:
-            self._processor.log_io_error(
-                "Could not copy {0} to {1}".format(self.path, tmp_target),
-                e)
+            if e.filename == self.path:
+                # The file was probably (re)moved by some other process.
+                self._processor.log_mail_opening_error(self.path, e)
+            else:
+                self._processor.log_io_error(
+                    "Could not copy {0} to {1}".format(self.path, tmp_target),
+                    e)
             return
 
         flagpart = self._get_flagpart()
@@ -207,9 +217,6 @@ class MaildirMail(MailBase):
             copy = ""
         else:
             copy = " copy"
-        flags = self._processor.sendmail_flags
-        if env_sender is not None:
-            flags += " -f {0}".format(env_sender)
 
         self._processor.log(
             "==> Forwarding{0} to {1!r}".format(copy, addresses))
@@ -220,17 +227,20 @@ class MaildirMail(MailBase):
             self._processor.log_mail_opening_error(self.path, e)
             return
 
-        p = subprocess.Popen(
-            "{0} {1} -- {2}".format(self._processor.sendmail,
-                                    flags,
-                                    " ".join(addresses)
-                                    ),
-            shell=True,
-            stdin=subprocess.PIPE)
-        shutil.copyfileobj(source_fp, p.stdin)
-        p.stdin.close()
-        p.wait()
-        source_fp.close()
+        try:
+            message = self._processor.start_delivery(env_sender, addresses)
+            shutil.copyfileobj(source_fp, message)
+            message.finish()
+        except delivery.DeliveryError as e:
+            self._processor.log_error("Forwarding message failed: %s" % e)
+            return
+        finally:
+            source_fp.close()
+
+        for address, (code, text) in message.rejected:
+            self._processor.log_error(
+                "Forwarding to {0} failed: {1} {2}".format(
+                    address, code, text.decode('ascii', 'replace')))
 
         if delete:
             self._delete()
@@ -261,13 +271,14 @@ class MaildirMail(MailBase):
             return ""
 
     def _log_processing(self):
-        try:
-            fp = open(self.path, "rb")
-        except IOError as e:
-            # The file was probably (re)moved by some other process.
-            self._processor.log_mail_opening_error(self.path, e)
+        if self._processor.log_level < 1:
+            # Nothing would be logged, so do not compute the digest.
+            return
+        digest = self.digest
+        if digest is None:
             return
-        self._processor.log("SHA1:       {0}".format(ascii(sha1sum(fp))))
+        self._processor.log("{0:<11} {1}".format(
+            self._processor.digest_algorithm.upper() + ":", ascii(digest)))
         for name in "Message-ID Subject Date From To Cc".split():
             self._processor.log(
                 "{0:<11} {1}".format(name + ":", ascii(self[name])))
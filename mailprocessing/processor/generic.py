@@ -22,6 +22,7 @@ import os
 import sys
 import time
 
+from mailprocessing import delivery
 from mailprocessing import signals
 
 from mailprocessing.util import safe_write
@@ -46,9 +47,12 @@ class MailProcessor(object):
         self._log_level = kwargs['log_level']
         self._run_once = kwargs['run_once'] or kwargs['dry_run']
         self._auto_reload_rcfile = kwargs['auto_reload_rcfile']
+        self.log_prefix = kwargs.get('log_prefix', "")
         self._deliveries = 0
         self._sendmail = "/usr/sbin/sendmail"
         self._sendmail_flags = "-i"
+        self._smtp_server = None
+        self._smtp = None
         self.rcfile_modified = False
         self._previous_rcfile_mtime = self._get_previous_rcfile_mtime()
 
@@ -82,6 +86,10 @@ class MailProcessor(object):
     logfile = property(fset=set_logfile)
 
     def reopen_logfile(self):
+        # Log files shared between processors reopen themselves.
+        if hasattr(self._log_fp, 'reopen'):
+            self._log_fp.reopen()
+            return
         # log file is a stream, so no need to reopen
         if self._log_fp.fileno() < 3:
             return
@@ -93,6 +101,10 @@ class MailProcessor(object):
     def rcfile(self):
         return self._rcfile
 
+    @property
+    def log_level(self):
+        return self._log_level
+
     def get_sendmail(self):
         return self._sendmail
 
@@ -109,6 +121,50 @@ class MailProcessor(object):
 
     sendmail_flags = property(get_sendmail_flags, set_sendmail_flags)
 
+    def get_smtp_server(self):
+        return self._smtp_server
+
+    def set_smtp_server(self, url):
+        """
+        Setter method for the SMTP or LMTP server forwarded messages are
+        submitted to instead of passing them to sendmail. url is one of
+        smtp://HOST[:PORT], lmtp://HOST[:PORT], smtp:PATH or lmtp:PATH (PATH
+        being a UNIX socket). None switches back to sendmail.
+        """
+        if url is not None:
+            try:
+                delivery.parse_server(url)
+            except ValueError as e:
+                self.fatal_error("Error: %s" % e)
+        self.close_delivery()
+        self._smtp_server = url
+
+    smtp_server = property(get_smtp_server, set_smtp_server)
+
+    def start_delivery(self, env_sender, addresses):
+        """
+        Starts delivering a message from env_sender (None for the default
+        sender) to the list addresses through smtp_server, or sendmail if
+        that is not set. Returns a message object with write(), abort() and
+        finish() methods. Raises delivery.DeliveryError if the message is
+        refused.
+        """
+        if self._smtp_server is None:
+            return delivery.SendmailMessage(self.sendmail,
+                                            self.sendmail_flags,
+                                            env_sender, addresses)
+        if self._smtp is None:
+            self._smtp = delivery.SmtpConnection(self._smtp_server)
+        return self._smtp.start(env_sender, addresses)
+
+    def close_delivery(self):
+        """
+        Closes the connection to smtp_server, if any.
+        """
+        if self._smtp is not None:
+            self._smtp.close()
+            self._smtp = None
+
     def __iter__(self):
         """
         Iterator method used to invoke the processor from default.rc.
@@ -142,7 +198,7 @@ class MailProcessor(object):
 
     def log(self, text, level=1):
         if level <= self._log_level:
-            safe_write(self._log_fp, text)
+            safe_write(self._log_fp, self.log_prefix + text)
             self._log_fp.flush()
 
     def log_debug(self, text):
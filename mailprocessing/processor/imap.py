@@ -17,24 +17,158 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 
-import errno
+import collections
+import concurrent.futures
+import contextlib
 import imaplib
-import json
+import select
 import ssl
 import re
+import sqlite3
 import sys
+import threading
+import time
 
-from email import errors as email_errors
-from email import header as email_header
-from email import parser as email_parser
-
+from mailprocessing import deflate
+from mailprocessing import fetch
 from mailprocessing import signals
 
+from mailprocessing.aioimap import ImapClient
+from mailprocessing.cache import open_cache
+
 from mailprocessing.util import batch_list
+from mailprocessing.util import compact_uid_set
+from mailprocessing.util import expand_uid_set
 
 from mailprocessing.mail.dryrun import DryRunImap
 from mailprocessing.mail.imap import ImapMail
 from mailprocessing.processor.generic import MailProcessor
+from mailprocessing.rule import Rule
+
+# imaplib refuses to send commands it does not know about. Register the
+# extension commands we use.
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+imaplib.Commands.setdefault('ENABLE', ('AUTH',))
+imaplib.Commands.setdefault('IDLE', ('AUTH', 'SELECTED'))
+imaplib.Commands.setdefault('MOVE', ('SELECTED',))
+
+# RFC 2177 recommends terminating and re-issuing IDLE at least every 29
+# minutes to avoid being logged off for inactivity.
+IDLE_TIMEOUT = 29 * 60
+
+# Interval in seconds between NOOP commands keeping an otherwise idle
+# session alive.
+NOOP_INTERVAL = 120
+
+# Number of times updating the header cache is attempted in a pass if the
+# server keeps dropping the connection.
+SYNC_ATTEMPTS = 2
+
+# Untagged responses reporting new, expunged or modified messages during
+# IDLE. With QRESYNC enabled, expunged messages are reported as VANISHED.
+Idle_change = re.compile(br'\* (\d+ (EXISTS|EXPUNGE|FETCH)|VANISHED)\b')
+
+List_response = re.compile(r'\((?P<attributes>[^()]*)\) '
+                           r'(?P<separator>"(?:[^"\\]|\\.)*"|NIL) ?'
+                           r'(?P<name>.*)$', re.IGNORECASE)
+
+# Header fields ImapMail logs for every message. These are always downloaded,
+# even if header_fields restricts the header fields to download.
+LOGGED_HEADERS = ('message-id', 'subject', 'date', 'from', 'to', 'cc')
+
+
+class ImapSession(object):
+    """
+    An IMAP connection along with the folder currently selected on it.
+    """
+    def __init__(self):
+        self.imap = None
+        self.selected = None
+
+
+class FolderRegistry(object):
+    """
+    The folders existing on the IMAP server as reported by LIST, mapping
+    their full names (prefix included, as sent to the server) to their
+    attributes and hierarchy separator. The registry starts out unloaded and
+    is kept up to date with the folders imapproc creates itself.
+    """
+    def __init__(self):
+        self.folders = None
+
+    @property
+    def loaded(self):
+        return self.folders is not None
+
+    def load(self, responses):
+        """
+        Replaces the registry's contents with the folders in the LIST
+        responses responses (as returned by imaplib's list()).
+        """
+        self.folders = {}
+        for response in responses:
+            if isinstance(response, tuple):
+                # Folder name sent as a literal.
+                line, name = response[0], response[1]
+                line = line[:line.rfind(b'{')]
+            elif isinstance(response, bytes):
+                line, name = response, None
+            else:
+                continue
+            m = List_response.match(line.decode('utf-8', 'replace'))
+            if m is None:
+                continue
+            if name is None:
+                name = m.group('name')
+                if name.startswith('"'):
+                    name = re.sub(r'\\(.)', r'\1', name[1:-1])
+            else:
+                name = name.decode('utf-8', 'replace')
+            attributes = tuple(m.group('attributes').upper().split())
+            if '\\NONEXISTENT' in attributes:
+                continue
+            separator = m.group('separator')
+            if separator.upper() == 'NIL':
+                separator = None
+            else:
+                separator = re.sub(r'\\(.)', r'\1', separator[1:-1])
+            self.folders[self.normalize(name)] = (attributes, separator)
+
+    def invalidate(self):
+        """
+        Forgets all folders, so the registry is reloaded on next use.
+        """
+        self.folders = None
+
+    def exists(self, name):
+        return self.normalize(name) in self.folders
+
+    def attributes(self, name):
+        return self.folders[self.normalize(name)][0]
+
+    def add(self, name, separator=None):
+        """
+        Records the folder name as existing after it has been created.
+        """
+        if self.loaded:
+            self.folders[self.normalize(name)] = ((), separator)
+
+    def remove(self, name):
+        """
+        Records the folder name as not existing (any more).
+        """
+        if self.loaded:
+            self.folders.pop(self.normalize(name), None)
+
+    @staticmethod
+    def normalize(name):
+        """
+        Returns folder name name in the form the registry stores it in. INBOX
+        is case-insensitive (RFC 3501, section 5.1).
+        """
+        if name.upper() == 'INBOX':
+            return 'INBOX'
+        return name
 
 
 class ImapProcessor(MailProcessor):
@@ -46,18 +180,48 @@ class ImapProcessor(MailProcessor):
     def __init__(self, *args, **kwargs):
         super(ImapProcessor, self).__init__(*args, **kwargs)
 
+        # IMAP commands go to the session owning the folder they operate on.
+        # See session_for().
+        self._local = threading.local()
+        self._sessions = [ImapSession()]
+        self._folder_sessions = {}
+
         self.user = kwargs['user']
         self.password = kwargs['password']
         self.cache_file = kwargs.get('cache_file', None)
+        self.cache_backend = kwargs.get('cache_backend') or 'json'
+        self._cache_store = None
+        self._cache_loaded = False
+        self._header_fields = None
         self.header_cache = {}
         self._folders = {}
+        self.folder_registry = FolderRegistry()
         self.uidvalidity = {}
-        self.selected = None
+        self.highestmodseq = {}
+        self.exists = {}
+        self.condstore = False
+        self.qresync = False
+        self._flags_synced = set()
+        self._flags_changed = {}
+        self._iterating = False
+        self.incremental = kwargs.get('incremental', False)
+        self.reprocess_flag_changes = kwargs.get('reprocess_flag_changes',
+                                                 False)
         self.flag_batchsize = kwargs.get('flag_batchsize')
         self.header_batchsize = kwargs.get('header_batchsize')
+        self.action_batchsize = kwargs.get('action_batchsize') or 0
+        self.action_queue = []
+        self.rules = []
+        self.pipeline_depth = kwargs.get('pipeline_depth') or 1
 
         self.interval = kwargs['interval']
         self.host = kwargs['host']
+        self.capabilities = ()
+        self.use_idle = kwargs.get('idle', False)
+        self.keep_alive = kwargs.get('keep_alive', False)
+        self.use_asyncio = kwargs.get('asyncio', False)
+        self.use_compression = kwargs.get('compress', False)
+        self._scheduled = kwargs.get('scheduled', False)
 
         if kwargs['log_level'] > 2:
             imaplib.Debug = 1
@@ -87,7 +251,8 @@ class ImapProcessor(MailProcessor):
                 self.port=kwargs['port']
             self.connect_plain()
 
-        if 'dry_run' in kwargs and kwargs['dry_run'] is True:
+        self.dry_run = kwargs.get('dry_run') is True
+        if self.dry_run:
             self._mail_class = DryRunImap
         else:
             self._mail_class = ImapMail
@@ -98,6 +263,15 @@ class ImapProcessor(MailProcessor):
         self._separator_prefix(cmd_separator=self.separator,
                                cmd_prefix=self.prefix)
 
+        for i in range(1, kwargs.get('connections') or 1):
+            session = ImapSession()
+            self._sessions.append(session)
+            with self._using_session(session):
+                self.connect()
+
+        if len(self._sessions) > 1:
+            self.log("==> Using %d IMAP connections" % len(self._sessions))
+
         self.log("==> Separator character is `%s`" % self.separator)
         self.log("==> Folder name prefix is `%s`" % self.prefix)
 
@@ -106,15 +280,75 @@ class ImapProcessor(MailProcessor):
         if kwargs['folders'] is not None:
             self.set_folders(kwargs['folders'])
 
+    @property
+    def imap(self):
+        """
+        The imaplib connection of the current session.
+        """
+        return self._session.imap
+
+    @imap.setter
+    def imap(self, connection):
+        self._session.imap = connection
+
+    @property
+    def selected(self):
+        """
+        The folder selected in the current session.
+        """
+        return self._session.selected
+
+    @selected.setter
+    def selected(self, folder):
+        self._session.selected = folder
+
+    @property
+    def _session(self):
+        return getattr(self._local, 'session', self._sessions[0])
+
+    @contextlib.contextmanager
+    def _using_session(self, session):
+        previous = getattr(self._local, 'session', None)
+        self._local.session = session
+        try:
+            yield session
+        finally:
+            if previous is None:
+                del self._local.session
+            else:
+                self._local.session = previous
+
+    def session_for(self, folder):
+        """
+        Returns a context manager routing all IMAP commands issued within it
+        to the connection owning folder. Folders that are not being processed
+        are owned by the first connection.
+        """
+        return self._using_session(
+            self._folder_sessions.get(folder, self._sessions[0]))
+
     def authenticate(self):
         try:
             self.imap.login(self.user, self.password)
         except self.imap.error as e:
             self.fatal_imap_error("Login to IMAP server failed", e)
+        self._refresh_capabilities()
+        if self.use_compression:
+            self._enable_compression()
+        self._enable_condstore()
+
+    def has_capability(self, capability):
+        """
+        Returns True if the IMAP server advertised capability after login.
+        """
+        return capability.upper() in self.capabilities
 
     def connect_plain(self):
         try:
-            self.imap = imaplib.IMAP4(host=self.host, port=self.port)
+            if self.use_asyncio:
+                self.imap = ImapClient(host=self.host, port=self.port)
+            else:
+                self.imap = imaplib.IMAP4(host=self.host, port=self.port)
         except Exception as e:
             self.fatal_error("Couldn't connect to IMAP server "
                              "imap://%s:%d: %s" % (self.host, self.port, e))
@@ -122,9 +356,14 @@ class ImapProcessor(MailProcessor):
 
     def connect_ssl(self, **kwargs):
         try:
-            self.imap = imaplib.IMAP4_SSL(host=self.host,
-                                          port=self.port,
-                                          ssl_context=self.ssl_context)
+            if self.use_asyncio:
+                self.imap = ImapClient(host=self.host,
+                                       port=self.port,
+                                       ssl_context=self.ssl_context)
+            else:
+                self.imap = imaplib.IMAP4_SSL(host=self.host,
+                                              port=self.port,
+                                              ssl_context=self.ssl_context)
         except Exception as e:
             self.fatal_error("couldn't connect to imap server "
                              "imaps://%s:%d: %s" % (self.host, self.port, e))
@@ -135,14 +374,31 @@ class ImapProcessor(MailProcessor):
         # out, we'll get a bad file descriptor.
         try:
             self.imap.logout()
-        except OSError:
+        except (OSError, self.imap.error):
             pass
 
+        self.connect()
+
+    def connect(self):
+        """
+        Opens a new IMAP connection for the current session.
+        """
+
+        self.selected = None
+
         if self.ssl_context is None:
             self.connect_plain()
         else:
             self.connect_ssl()
 
+    def reconnect_all(self):
+        """
+        Reconnects all IMAP connections.
+        """
+        for session in self._sessions:
+            with self._using_session(session):
+                self.reconnect()
+
     def get_folders(self):
         return self._folders
 
@@ -158,15 +414,144 @@ class ImapProcessor(MailProcessor):
             self.log("    " + folder)
             self.log("")
 
+        # Spread folders evenly across connections.
+        self._folder_sessions = {}
+        for i, folder in enumerate(self.folders):
+            self._folder_sessions[folder] = self._sessions[
+                i % len(self._sessions)]
+
         for folder in self.folders:
             if folder not in self.header_cache:
                 self.header_cache[folder] = {}
             if folder not in self.cache_delete:
                 self.cache_delete[folder] = []
-        self._cache_headers()
+
+        if self._iterating:
+            # Folders added while the rc file is iterating would otherwise
+            # lack cached headers until the next pass; cache them now.
+            for folder in self.folders:
+                if 'uids' in self.header_cache[folder]:
+                    continue
+                try:
+                    with self.session_for(folder):
+                        self._cache_folder(folder)
+                except self.imap.abort as e:
+                    self.log_error("IMAP connection aborted (%s), "
+                                   "reconnecting." % e)
+                    self.reconnect_all()
 
     folders = property(get_folders, set_folders)
 
+    def get_header_fields(self):
+        return self._header_fields
+
+    def set_header_fields(self, fields):
+        """
+        Restricts header downloads to the header fields named in the list
+        fields (plus the ones logged for every message). If a message is
+        asked for a header field that was not downloaded, the field is added
+        and downloaded for all cached messages in the message's folder (see
+        fetch_missing_headers()). The header fields rules (see rule()) look
+        at are always downloaded as well. None (the default) downloads
+        complete message headers.
+        """
+        if fields is None:
+            self._header_fields = None
+            return
+
+        header_fields = list(LOGGED_HEADERS)
+        # Rules may have to be evaluated on the downloaded headers.
+        rule_fields = [rule.header for rule in self.rules
+                       if rule.header is not None]
+        for name in list(fields) + rule_fields:
+            name = name.lower()
+            if name not in header_fields:
+                header_fields.append(name)
+        self._header_fields = header_fields
+
+    header_fields = property(get_header_fields, set_header_fields)
+
+    def header_fetch_item(self):
+        """
+        Returns the FETCH data item for downloading message headers as
+        restricted by header_fields.
+        """
+        if self.header_fields is None:
+            return "BODY.PEEK[HEADER]"
+        return "BODY.PEEK[HEADER.FIELDS (%s)]" % " ".join(
+            name.upper() for name in self.header_fields)
+
+    def fetch_missing_headers(self, folder, uid=None):
+        """
+        Downloads the header fields header_fields asks for but the header
+        cache for folder lacks, for all cached messages in folder at once,
+        and adds them to the cached headers. Returns the cached headers of
+        message uid, or None if folder or uid is not cached.
+        """
+
+        if 'uids' not in self.header_cache.get(folder, {}):
+            return None
+        cache = self.header_cache[folder]
+
+        if not self._header_fields_cached(folder):
+            uids = list(cache['uids'])
+            batches = batch_list(uids, self.header_batchsize)
+            item = "(%s)" % self.header_fetch_item()
+
+            self.log_debug("==> Downloading missing header fields for %d "
+                           "messages in folder %s" % (len(uids), folder))
+
+            with self.session_for(folder):
+                self.ensure_selected(folder)
+                try:
+                    for fetched, attributes in self._uid_fetch(
+                            [(",".join(batch), item) for batch in batches]):
+                        header = fetch.body(attributes)
+                        if header is None or fetched not in cache['uids']:
+                            continue
+                        # Assign a new entry rather than changing the cached
+                        # one in place: the cache store may hand out copies.
+                        message = cache['uids'][fetched]
+                        headers = dict(message['headers'])
+                        headers.update(fetch.decode_headers(header, fetched,
+                                                            self.log_error))
+                        cache['uids'][fetched] = {'flags': message['flags'],
+                                                  'headers': headers}
+                except self.imap.abort:
+                    raise
+                except self.imap.error as e:
+                    self.fatal_error("Error retrieving headers for messages "
+                                     "in folder %s: %s" % (folder, e))
+            # Only now that they are stored are the fields cached.
+            cache['header_fields'] = self.header_fields
+
+        if uid not in cache['uids']:
+            return None
+        return cache['uids'][uid]['headers']
+
+    def fetch_message(self, uid, sink):
+        """
+        Downloads the complete message uid from the selected folder without
+        setting its \\Seen flag. The message is passed to the callable sink in
+        chunks as it arrives, so it is never held in memory as a whole.
+        Returns True if the server sent the message. Raises imap.error if
+        the download fails.
+        """
+        if isinstance(self.imap, ImapClient):
+            responses = self.imap.uid_fetch_body(uid, sink)
+        else:
+            responses = fetch.uid_fetch_body_imaplib(self.imap, uid, sink)
+
+        for parts in responses:
+            try:
+                attributes = fetch.parse_fetch(parts)
+            except ValueError as e:
+                raise self.imap.error("Malformed FETCH response: %s" % e)
+            if attributes.get('UID') == uid.encode('ascii') and \
+               fetch.body(attributes) is not None:
+                return True
+        return False
+
     # ----------------------------------------------------------------
     # Logging methods
 
@@ -188,9 +573,10 @@ class ImapProcessor(MailProcessor):
 
         It can safely be invoked with an existing folder name since it checks
         for existence of the folder first and will do nothing if the folder
-        exists. This method creates a folder's parent directories recursively
-        by default. If you do not wish this behaviour, please specify
-        parents=False.
+        exists. Existence is looked up in the folder registry, so no folder
+        needs to be selected for that. This method creates a folder's parent
+        directories recursively by default. If you do not wish this
+        behaviour, please specify parents=False.
         """
 
         folder_list = self.path_list(folder, sep=self.separator)
@@ -203,9 +589,7 @@ class ImapProcessor(MailProcessor):
 
         target = self.list_path(folder, sep=self.separator)
 
-        exists, detail = self._status(target)
-
-        if exists:
+        if self._folder_exists(target):
             self.log("==> Not creating folder %s: folder exists." % folder)
             return
 
@@ -218,6 +602,7 @@ class ImapProcessor(MailProcessor):
             self.fatal_error("Couldn't create folder "
                              "%s: %s / %s" % (target,
                                               status, data[0].decode('ascii')))
+        self.folder_registry.add(target, self.separator)
         try:
             status, data = self.imap.subscribe(target)
         except self.imap.error as e:
@@ -231,14 +616,21 @@ class ImapProcessor(MailProcessor):
 
     def list_messages(self, folder):
         """
-        Lists all messages in an IMAP folder.
+        Lists all messages in an IMAP folder, using the connection owning it
+        (see session_for()).
         """
 
-        self.select(folder)
+        with self.session_for(folder):
+            return self._list_messages(folder)
+
+    def _list_messages(self, folder):
+        self.ensure_selected(folder)
         self.log_debug("Listing messages in folder %s" % folder)
 
         try:
             ret, data = self.imap.uid('search', None, "ALL")
+        except self.imap.abort:
+            raise
         except self.imap.error as e:
             self.fatal_error("Listing messages in folder %s "
                              "failed: %s" % (folder, e))
@@ -253,6 +645,37 @@ class ImapProcessor(MailProcessor):
 
         return messages
 
+    def rule(self, header=None, contains=None, seen=None, flagged=None,
+             folder=None):
+        """
+        Defines a rule for messages in which the header field header contains
+        the string contains (case-insensitively), whose \\Seen flag is set
+        (seen=True) or not set (seen=False) and whose \\Flagged flag is set
+        (flagged=True) or not set (flagged=False). If folder is given, the
+        rule only applies to messages in that folder. Returns the rule, whose
+        copy(), move() and delete() methods add the actions to apply to
+        matching messages:
+
+          processor.rule(header="list-id", contains="foo").move("Lists.foo")
+
+        Rules apply to every message once, when it is first seen, before its
+        headers are downloaded: they are evaluated by the server with UID
+        SEARCH and their actions are applied to all matching messages at
+        once. Messages moved or deleted by a rule are not passed to the rc
+        file. Rules are evaluated in the order they were defined. Should a
+        rule need to be evaluated locally (because it searches for non-ASCII
+        text or the server's SEARCH failed), it and all rules after it are
+        evaluated on the downloaded headers instead. If header_fields is set,
+        header is added to it for that purpose.
+        """
+
+        rule = Rule(header=header, contains=contains, seen=seen,
+                    flagged=flagged, folder=folder)
+        self.rules.append(rule)
+        if header is not None and self.header_fields is not None:
+            self.header_fields = self.header_fields + [header]
+        return rule
+
     def __iter__(self):
         """
         Iterator method used to invoke the processor from the filter
@@ -263,36 +686,511 @@ class ImapProcessor(MailProcessor):
 
         self.rcfile_modified = False
 
+        # Synchronize only now, so settings made in the rc file (such as
+        # header_fields) apply to the first pass as well.
+        synced = self._update_header_cache()
+        self._iterating = True
+
         while not signals.signal_event.is_set():
-            if self.auto_reload_rcfile:
+            # Scheduled passes always run the rc file as it is now.
+            if self.auto_reload_rcfile and not self._scheduled:
                 current_rcfile_mtime = self._get_previous_rcfile_mtime()
                 if current_rcfile_mtime != self._previous_rcfile_mtime:
                     self._previous_rcfile_mtime = current_rcfile_mtime
                     self.rcfile_modified = True
                     self.log_info("Detected modified RC file; reloading")
+                    # The reloaded rc file defines its rules anew.
+                    self.rules = []
                     break
 
-            for folder in self.folders:
-                for message in self.header_cache[folder]['uids']:
-                    yield self.header_cache[folder]['uids'][message]['obj']
+            # Without an up to date header cache, wait for the next pass.
+            if synced:
+                for folder in self.folders:
+                    for message in self._unprocessed(folder):
+                        if signals.terminate():
+                            self.clean_exit()
+                        yield self._mail(folder, message)
+                        if self.incremental:
+                            self._advance_watermark(folder, message)
+                    self.flush_actions()
+
+            if self._scheduled:
+                # The multi-account scheduler starts the next pass with a new
+                # processor, so just end this one.
+                self.clean_sleep()
+                return
 
             if self._run_once:
                 self.clean_exit()
+
+            if self.use_idle and not self.has_capability('IDLE'):
+                self.log_info("==> Server does not support IDLE, "
+                              "falling back to polling.")
+                self.use_idle = False
+
+            if self.use_idle or self.keep_alive:
+                self.checkpoint()
+
+                if self.use_idle:
+                    self._wait_idle()
+                else:
+                    self._wait_keepalive()
+
+                if signals.terminate():
+                    self.clean_exit()
             else:
                 self.clean_sleep()
 
-            signals.signal_event.wait(self.interval)
+                signals.signal_event.wait(self.interval)
 
-            if signals.terminate():
-                # Simply exit, since clean_sleep() will already have performed
-                # all exit rites if get here.
-                sys.exit(0)
+                if signals.terminate():
+                    # Simply exit, since clean_sleep() will already have
+                    # performed all exit rites if get here.
+                    sys.exit(0)
 
-            self.reconnect()
-            self._cache_headers()
+                self.reconnect_all()
+
+            synced = self._update_header_cache()
+
+    def _unprocessed(self, folder):
+        """
+        Returns the UIDs of the messages in folder to pass to the rc file. In
+        incremental mode, these are the messages above the folder's
+        watermark, plus messages whose flags changed if
+        reprocess_flag_changes is set.
+        """
+
+        # Folders whose headers could not be cached yet are processed in the
+        # next pass.
+        uids = self.header_cache[folder].get('uids', {})
+        changed = self._flags_changed.pop(folder, set())
+
+        if self.dry_run:
+            uids = self._without_removed(folder, uids)
+
+        if not self.incremental:
+            return uids
+
+        watermark = self.header_cache[folder].get('watermark') or 0
+        if not self.reprocess_flag_changes:
+            changed = set()
+
+        pending = [uid for uid in uids
+                   if int(uid) > watermark or uid in changed]
+        self.log_debug("==> %d of %d messages in folder %s are new or "
+                       "changed" % (len(pending), len(uids), folder))
+        return pending
+
+    def _without_removed(self, folder, uids):
+        """
+        Returns the UIDs in folder's header cache uids except for those of
+        messages a rule moves or deletes. In dry-run mode, these messages
+        stay in folder and are cached like any other message, so they are
+        not downloaded again in every pass, but the rc file does not get to
+        see them, just as if the rule had been applied.
+        """
+        rules = [rule for rule in self.rules
+                 if rule.removes and rule.applies_to(folder)]
+        if not rules:
+            return uids
+        kept = []
+        for uid in uids:
+            message = uids[uid]
+            if not any(rule.matches(message['headers'], message['flags'])
+                       for rule in rules):
+                kept.append(uid)
+        return kept
+
+    def _advance_watermark(self, folder, uid):
+        """
+        Records message uid in folder as processed.
+        """
+        watermark = self.header_cache[folder].get('watermark') or 0
+        self.header_cache[folder]['watermark'] = max(watermark, int(uid))
+
+    def checkpoint(self):
+        """
+        Executes all queued actions and saves the header cache without closing
+        the IMAP session.
+        """
+
+        self.flush_actions()
+        self.log("==> Saving header cache...")
+        self._save_cache(self.header_cache)
+
+    def noop(self):
+        """
+        Sends a NOOP command to keep the IMAP sessions alive. If the server
+        dropped a connection in the meantime, imapproc reconnects.
+        """
+
+        for session in self._sessions:
+            with self._using_session(session):
+                try:
+                    self.imap.noop()
+                except self.imap.abort as e:
+                    self.log_error("IMAP connection aborted (%s), "
+                                   "reconnecting." % e)
+                    self.reconnect()
+
+    def queue_action(self, action, folder, uid, target=None, create=False):
+        """
+        Queues a 'copy', 'move' or 'delete' action for the message with UID
+        uid in folder. target is the destination folder for copy and move
+        actions. Queued actions are executed in bulk by flush_actions() once
+        the action batch size is reached, at the end of each folder pass and
+        before exiting. Without an action batch size, actions are executed
+        right away.
+        """
+        self.action_queue.append((action, folder, uid, target, create))
+        if len(self.action_queue) >= self.action_batchsize:
+            self.flush_actions()
+
+    def flush_actions(self):
+        """
+        Executes all queued actions. Messages are copied with one UID COPY per
+        source and destination folder. If the server supports MOVE (RFC 6851),
+        moved messages are transferred with one UID MOVE per source and
+        destination folder. All other messages to be removed are flagged with
+        a single UID STORE per folder and expunged with a single UID EXPUNGE
+        (or EXPUNGE if the server does not support UIDPLUS).
+        """
+
+        if not self.action_queue:
+            return
+
+        queue = self.action_queue
+        self.action_queue = []
+
+        actions = {}
+
+        for action, folder, uid, target, create in queue:
+            copies, moved, remove = actions.setdefault(folder, ({}, {}, []))
+            if action in ('copy', 'move'):
+                uids, create_target = copies.get(target, ([], False))
+                if uid not in uids:
+                    uids.append(uid)
+                copies[target] = (uids, create_target or create)
+            if action == 'move':
+                moved[uid] = target
+            if action in ('move', 'delete') and uid not in remove:
+                remove.append(uid)
+
+        for folder in actions:
+            copies, moved, remove = actions[folder]
+            moves = {}
+
+            if self.has_capability('MOVE'):
+                # A message can only be moved once. Its last move target
+                # gets a UID MOVE, all other targets still get a UID COPY.
+                for uid in moved:
+                    target = moved[uid]
+                    uids, create = copies[target]
+                    uids.remove(uid)
+                    moves.setdefault(target, ([], create))[0].append(uid)
+                    remove.remove(uid)
+
+            with self.session_for(folder):
+                # Make sure we have the messages' folder selected (UIDs should
+                # be globally unique but may only unique in folder scope in
+                # sufficiently broken IMAP implementations).
+                try:
+                    self.ensure_selected(folder)
+                except self.imap.abort as e:
+                    self.fatal_imap_error("Selecting folder %s" % folder, e)
+
+                self._transfer(copies)
+                self._transfer(moves, move=True)
+
+                for target in moves:
+                    # make sure these get purged from cache later
+                    self.cache_delete[folder].extend(moves[target][0])
+
+                if remove:
+                    self._delete_uids(folder, remove)
 
     # ----------------------------------------------------------------
 
+    def _transfer(self, transfers, move=False):
+        """
+        Copies messages from the selected folder. transfers maps destination
+        folders to (uids, create) tuples; see _copy_uids(). The commands for
+        all destinations are pipelined. If move is True, the messages are
+        moved using UID MOVE instead.
+        """
+
+        targets = [target for target in transfers if transfers[target][0]]
+
+        if move:
+            command, operation = 'move', "Moving"
+        else:
+            command, operation = 'copy', "Copying"
+
+        for target in targets:
+            self.log_debug("==> {0} UIDs {1} to {2}".format(
+                operation, compact_uid_set(transfers[target][0]), target))
+
+        try:
+            # Collect all responses before handling any of them: creating a
+            # destination folder must not interleave with commands still in
+            # flight.
+            responses = list(self._uid_pipelined(
+                command, [(compact_uid_set(transfers[target][0]), target)
+                          for target in targets]))
+        except self.imap.error as e:
+            self.fatal_imap_error("%s messages to %s" % (
+                operation, ", ".join(targets)), e)
+
+        for target, response in zip(targets, responses):
+            uids, create = transfers[target]
+            self._copy_uids(uids, target, create, move, response)
+
+    def _copy_uids(self, uids, folder, create=False, move=False,
+                   response=None):
+        """
+        Copies the messages with the given UIDs from the selected folder to
+        folder, creating folder first if the server asks for it with
+        TRYCREATE and create is True. If move is True, the messages are moved
+        using UID MOVE instead. If the command was issued already, response
+        is its (status, data) response.
+        """
+
+        uid_set = compact_uid_set(uids)
+
+        if move:
+            command, operation = 'move', "Moving"
+        else:
+            command, operation = 'copy', "Copying"
+
+        if response is not None:
+            status, data = response
+        else:
+            try:
+                self.log_debug("==> {0} UIDs {1} to {2}".format(
+                    operation, uid_set, folder))
+                status, data = self.imap.uid(command, uid_set, folder)
+            except self.imap.error as e:
+                self.fatal_imap_error("%s message UIDs %s to %s"
+                                      % (operation, uid_set, folder), e)
+        if status == 'NO':
+            if create and 'TRYCREATE' in data[0].decode('ascii'):
+                self.log("==> Destination folder %s does not exist, "
+                         "creating." % folder)
+                # The folder may have been deleted since the folder
+                # registry was loaded.
+                self.folder_registry.remove(folder)
+                self.create_folder(folder)
+                try:
+                    self.log_debug("==> {0} UIDs {1} to {2}".format(
+                        operation, uid_set, folder))
+                    status, data = self.imap.uid(command, uid_set, folder)
+                except self.imap.error as e:
+                    self.fatal_imap_error("%s message UIDs %s to %s"
+                                          % (operation, uid_set, folder), e)
+                if status == 'NO':
+                    self.fatal_imap_error("%s message UIDs %s "
+                                          " to %s failed with NO, "
+                                          " aborting." % (operation, uid_set,
+                                                          folder),
+                                          data[0].decode('ascii'))
+            else:
+                self.fatal_error("Destination folder %s does not "
+                                 "exist and I am not supposed to "
+                                 "create folders. Please use "
+                                 "move() or copy() with "
+                                 "create=True to automatically "
+                                 "create nonexistent "
+                                 "folders." % folder)
+
+    def _uid_pipelined(self, command, arg_lists):
+        """
+        Issues the UID command command once for every tuple of arguments in
+        arg_lists and yields the responses in order, as imap.uid() returns
+        them. Up to pipeline_depth commands are kept in flight, so a batch of
+        commands costs one round trip rather than one per command.
+        """
+
+        if isinstance(self.imap, ImapClient):
+            for response in self.imap.uid_pipelined(command, arg_lists,
+                                                    self.pipeline_depth):
+                yield response
+            return
+
+        command = command.upper()
+        if command in ('SEARCH', 'SORT', 'THREAD'):
+            name = command
+        else:
+            name = 'FETCH'
+
+        # imaplib matches tagged responses to their commands, and the server
+        # answers commands in order, so any untagged responses received
+        # before a command's completion belong to that command.
+        pending = collections.deque()
+        for args in arg_lists:
+            if len(pending) >= self.pipeline_depth:
+                typ, data = self.imap._command_complete('UID',
+                                                        pending.popleft())
+                yield self.imap._untagged_response(typ, data, name)
+            pending.append(self.imap._command('UID', command, *args))
+
+        while pending:
+            typ, data = self.imap._command_complete('UID', pending.popleft())
+            yield self.imap._untagged_response(typ, data, name)
+
+    def _uid_fetch(self, arg_lists):
+        """
+        Issues UID FETCH once for every tuple of arguments in arg_lists,
+        keeping up to pipeline_depth commands in flight. Yields (uid,
+        attributes) for every message as soon as its FETCH response has been
+        read, attributes being the response parsed by fetch.parse_fetch().
+        Raises imap.error if a command fails.
+        """
+
+        if isinstance(self.imap, ImapClient):
+            responses = self.imap.uid_fetch_stream(arg_lists,
+                                                   self.pipeline_depth)
+        else:
+            responses = fetch.uid_fetch_imaplib(self.imap, arg_lists,
+                                                self.pipeline_depth)
+
+        for parts in responses:
+            try:
+                attributes = fetch.parse_fetch(parts)
+            except ValueError as e:
+                raise self.imap.error("Malformed FETCH response: %s" % e)
+            if 'UID' not in attributes:
+                continue
+            yield attributes['UID'].decode('ascii'), attributes
+
+    def _apply_rules(self, folder, uids):
+        """
+        Evaluates the rules applying to folder for the messages with the
+        given UIDs with UID SEARCH and applies their actions. Returns the
+        UIDs of the messages still in folder and the rules left to evaluate
+        on the messages' downloaded headers.
+        """
+
+        rules = [rule for rule in self.rules if rule.applies_to(folder)]
+        if not rules:
+            return uids, []
+
+        self.ensure_selected(folder)
+
+        for i, rule in enumerate(rules):
+            if not uids:
+                break
+
+            criteria = rule.search_criteria()
+            if criteria is None:
+                self.log_debug("==> Evaluating rule (%s) locally" % rule)
+                return uids, rules[i:]
+
+            uid_set = compact_uid_set(uids)
+            try:
+                status, data = self.imap.uid('search', None, "UID %s %s" %
+                                             (uid_set, criteria))
+            except self.imap.abort:
+                raise
+            except self.imap.error as e:
+                status, data = 'NO', [str(e).encode('ascii', 'replace')]
+            if status != 'OK':
+                self.log_imap_error("Evaluating rule (%s) in folder %s" %
+                                    (rule, folder),
+                                    "%s, evaluating it locally" %
+                                    data[0].decode('ascii', 'replace'))
+                return uids, rules[i:]
+
+            found = set(b" ".join(d for d in data if d).decode('ascii')
+                        .split())
+            matched = [uid for uid in uids if uid in found]
+            if matched:
+                self._execute_rule(folder, rule, matched)
+                if rule.removes:
+                    uids = [uid for uid in uids if uid not in found]
+
+        return uids, []
+
+    def _execute_rule(self, folder, rule, uids):
+        """
+        Applies the actions of rule to the messages with the given UIDs in
+        the selected folder.
+        """
+
+        uid_set = compact_uid_set(uids)
+        self.log("==> Rule (%s) matched UIDs %s in folder %s" %
+                 (rule, uid_set, folder))
+
+        for action, target, create in rule.actions:
+            if target is not None:
+                target = self.list_path(self.path_ensure_prefix(target),
+                                        sep=self.separator)
+
+            if action == 'copy':
+                self.log("==> Copying {0} to {1}".format(uid_set, target))
+            elif action == 'move':
+                self.log("==> Moving {0} to {1}".format(uid_set, target))
+            else:
+                self.log("==> Deleting %s" % uid_set)
+
+            if self.dry_run:
+                continue
+
+            if action == 'delete':
+                self._delete_uids(folder, uids)
+            elif action == 'move' and self.has_capability('MOVE'):
+                self._transfer({target: (uids, create)}, move=True)
+                # make sure these get purged from cache later
+                self.cache_delete[folder].extend(uids)
+            else:
+                self._transfer({target: (uids, create)})
+                if action == 'move':
+                    self._delete_uids(folder, uids)
+
+    def _delete_uids(self, folder, uids):
+        """
+        Flags the messages with the given UIDs in the selected folder as
+        deleted and expunges them.
+        """
+
+        uid_set = compact_uid_set(uids)
+
+        try:
+            self.log_debug("==> Deleting UIDs %s" % uid_set)
+            self.imap.uid('store', uid_set, '+FLAGS.SILENT', '(\\Deleted)')
+            if self.has_capability('UIDPLUS'):
+                # Only expunge what we deleted ourselves.
+                self.imap.uid('expunge', uid_set)
+            else:
+                self.imap.expunge()
+        except self.imap.error as e:
+            # Fail hard because repeated failures here can leave a mess of
+            # messages with `Deleted` flags.
+            self.fatal_imap_error("Deleting messages %s" % uid_set, e)
+
+        # make sure these get purged from cache later
+        self.cache_delete[folder].extend(uids)
+
+    def _update_header_cache(self):
+        """
+        Updates the header cache, reconnecting and trying again if the server
+        dropped a connection. Returns False if the header cache could not be
+        updated; the pass is then skipped and the update retried in the next
+        one.
+        """
+
+        for attempt in range(SYNC_ATTEMPTS):
+            try:
+                self._cache_headers()
+                return True
+            except self.imap.abort as e:
+                self.log_error("IMAP connection aborted (%s), "
+                               "reconnecting." % e)
+                self.reconnect_all()
+
+        self.log_error("Updating header cache failed %d times, skipping this "
+                       "pass." % SYNC_ATTEMPTS)
+        return False
+
     def _cache_headers(self):
         """
         This method updates the processor's header cache for all folders this
@@ -305,38 +1203,224 @@ class ImapProcessor(MailProcessor):
             self._cache_headers_file()
         else:
             self._cache_headers_memory()
+            if self.incremental and self.reprocess_flag_changes:
+                # Flag changes are only noticed by fetching all flags unless
+                # CONDSTORE told us about them already.
+                self.refresh_flags()
 
     def _cache_headers_memory(self):
         """
         This method creates the run time memory header cache.
         """
 
-        for folder in self.folders:
-            uidvalidity = self._uidvalidity(folder)
-            if folder not in self.header_cache:
-                self.header_cache[folder] = {}
-                self.header_cache[folder]['uids'] = self._initialize_cache(
-                    folder)
-                self.header_cache[folder]['uidvalidity'] = uidvalidity
-                continue
+        self._flags_synced = set()
+        self._flags_changed = {}
+        self._folder_status = self._query_status()
+        self._for_each_folder(self._cache_folder)
+        self.log("Header cache up to date.")
+
+    def _cache_folder(self, folder):
+        """
+        This method updates the run time memory header cache for a single
+        folder.
+        """
 
-            if uidvalidity == self.header_cache[folder].get('uidvalidity'):
+        status = self._folder_status.get(folder)
+        if status is not None and self._folder_unchanged(folder, status):
+            return
+
+        # Select the folder once per pass for its current UIDVALIDITY and
+        # HIGHESTMODSEQ; listing its messages reuses the selection. Query
+        # HIGHESTMODSEQ first: anything that changes while we update the
+        # cache will then be picked up in the next cycle.
+        self.select(folder)
+        modseq = self._highestmodseq(folder)
+        uidvalidity = self._uidvalidity(folder)
+        if folder not in self.header_cache:
+            self.header_cache[folder] = {}
+            self.header_cache[folder]['uids'] = self._initialize_cache(
+                folder)
+            self.header_cache[folder]['uidvalidity'] = uidvalidity
+            self.header_cache[folder]['highestmodseq'] = modseq
+            self.header_cache[folder]['header_fields'] = self.header_fields
+            self.header_cache[folder]['status'] = status
+            # The flags were downloaded along with the headers.
+            self._flags_synced.add(folder)
+            return
+
+        cached_modseq = self.header_cache[folder].get('highestmodseq')
+
+        if uidvalidity == self.header_cache[folder].get('uidvalidity'):
+            if not self._header_fields_cached(folder):
+                self.log_debug("Cached headers for folder %s lack header "
+                               "fields, downloading them." % folder)
+                self.fetch_missing_headers(folder)
+            if modseq is not None and cached_modseq is not None:
+                self.header_cache[folder]['uids'] = self._sync_changes(
+                    folder, self.header_cache[folder]['uids'],
+                    cached_modseq, modseq)
+            else:
                 self.header_cache[folder]['uids'] = self._update_cache(
                     folder, self.header_cache[folder]['uids'])
+        else:
+            self.header_cache[folder]['uids'] = self._initialize_cache(
+                folder)
+            self.header_cache[folder]['uidvalidity'] = uidvalidity
+            self.header_cache[folder]['header_fields'] = self.header_fields
+            # UIDs from before the UIDVALIDITY change are meaningless now.
+            self.header_cache[folder]['watermark'] = None
+            self._flags_synced.add(folder)
+        self.header_cache[folder]['highestmodseq'] = modseq
+        self.header_cache[folder]['status'] = status
+
+    def _folder_unchanged(self, folder, status):
+        """
+        Compares status (see _query_status()) with the status folder had when
+        its header cache was last updated. If UIDVALIDITY, UIDNEXT and the
+        message count did not change, the cached message list is still
+        current and True is returned. Flags may still have changed unless
+        HIGHESTMODSEQ is known and did not change either; in that case, the
+        folder's flags are marked up to date as well.
+        """
+        if folder not in self.header_cache \
+           or 'uids' not in self.header_cache[folder]:
+            return False
+        if self.header_cache[folder].get('status') != status:
+            return False
+        if not self._header_fields_cached(folder):
+            return False
+
+        if 'highestmodseq' in status:
+            self.log_debug("==> Folder %s unchanged, skipping." % folder)
+            self._flags_synced.add(folder)
+        else:
+            self.log_debug("==> No new or expunged messages in folder %s." %
+                           folder)
+        return True
+
+    def _query_status(self):
+        """
+        Queries UIDVALIDITY, UIDNEXT, the message count and (with CONDSTORE)
+        HIGHESTMODSEQ for all folders this processor is configured to process,
+        without selecting them. Uses a single LIST command if the server
+        supports LIST-STATUS (RFC 5819) and one STATUS command per folder
+        otherwise. Returns a dict mapping folder names to dicts of lower case
+        status item names and values. Folders whose status could not be
+        determined are left out.
+        """
+
+        items = ['MESSAGES', 'UIDNEXT', 'UIDVALIDITY']
+        if self.condstore:
+            items.append('HIGHESTMODSEQ')
+        items = "(%s)" % " ".join(items)
+
+        names = {}
+        for folder in self.folders:
+            names[self.list_path(self.path_ensure_prefix(folder))] = folder
+
+        responses = []
+        try:
+            if self.has_capability('LIST-STATUS'):
+                # imaplib has no notion of LIST return options, so they are
+                # passed along with the pattern.
+                ret, data = self.imap.list(
+                    '""', '* RETURN (STATUS %s)' % items)
+                if ret == 'OK':
+                    responses = self.imap.response('STATUS')[1]
+                    # This lists all folders anyway.
+                    self.folder_registry.load(data)
             else:
-                self.header_cache[folder]['uids'] = self._initialize_cache(
-                    folder)
-                self.header_cache[folder]['uidvalidity'] = uidvalidity
+                for name in names:
+                    ret, data = self.imap.status(name, items)
+                    if ret == 'OK':
+                        responses.extend(data)
+        except self.imap.abort:
+            raise
+        except self.imap.error as e:
+            self.log_imap_error("Querying folder status", e)
+            return {}
+
+        status = {}
+        for response in responses:
+            if not isinstance(response, bytes):
+                # Folder name sent as a literal. Such folders are simply
+                # synchronized as usual.
+                continue
+            m = re.match(r'(?P<name>.*) \((?P<items>[^()]*)\)$',
+                         response.decode('utf-8', 'replace'))
+            if m is None:
+                continue
+            name = m.group('name')
+            if name.startswith('"'):
+                name = name[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+            if name not in names:
+                continue
+            values = m.group('items').split()
+            status[names[name]] = dict(
+                (values[i].lower(), values[i + 1])
+                for i in range(0, len(values) - 1, 2))
 
-        self.log("Header cache up to date.")
+        return status
+
+    def _header_fields_cached(self, folder):
+        """
+        Returns True if the header cache for folder holds all header fields
+        header_fields asks for.
+        """
+        if 'uids' not in self.header_cache[folder]:
+            return True
+        cached_fields = self.header_cache[folder].get('header_fields')
+        if cached_fields is None:
+            return True
+        if self.header_fields is None:
+            return False
+        return set(self.header_fields) <= set(cached_fields)
+
+    def _for_each_folder(self, func):
+        """
+        Invokes func for every folder this processor is configured to
+        process. If there is more than one IMAP connection, folders are
+        processed in parallel, each by a worker thread using the connection
+        owning the folder. Once a termination signal is received, no further
+        folders are processed and imapproc exits.
+
+        Workers must only return or raise: exiting cleanly flushes actions
+        and logs out on all connections, which may only happen once all
+        workers have finished.
+        """
+
+        def worker(session):
+            with self._using_session(session):
+                for folder in self.folders:
+                    if signals.terminate():
+                        return
+                    if self._folder_sessions[folder] is session:
+                        func(folder)
+
+        if len(self._sessions) == 1:
+            worker(self._sessions[0])
+        else:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=len(self._sessions)) as executor:
+                futures = [executor.submit(worker, session)
+                           for session in self._sessions]
+                for future in futures:
+                    future.result()
+
+        if signals.terminate():
+            self.clean_exit()
 
     def _cache_headers_file(self):
         """
         This method updates the header cache from a cache file. The cache file
-        is created if it does not exist, yet.
+        is created if it does not exist, yet. The cache is only read from the
+        file after logging out: while the IMAP connections stay up (with
+        keep-alive or IDLE), the header cache in memory is current.
         """
 
-        self.header_cache = self._load_cache()
+        if not self._cache_loaded:
+            self.header_cache = self._load_cache()
+            self._cache_loaded = True
         self._cache_headers_memory()
         self.refresh_flags()
 
@@ -347,20 +1431,21 @@ class ImapProcessor(MailProcessor):
         if self.cache_file is None:
             return
         try:
-            f = open(self.cache_file)
-            cache = json.load(f)
-            f.close()
-            return cache
-        except OSError as e:
-            if e.errno == errno.ENOENT:
-                return {}
-            else:
-                self.fatal_error("Couldn't load stored cache from "
-                                 "%s: %s" % (self.cache_file, e))
+            return self._get_cache_store().load()
         except Exception as e:
             self.fatal_error("Couldn't load stored cache from "
                              " %s: %s" % (self.cache_file, e))
 
+    def _get_cache_store(self):
+        """
+        Returns the store for the header cache, opening it on first use.
+        """
+        if self._cache_store is None:
+            self._cache_store = open_cache(self.cache_backend,
+                                           self.cache_file, self.host,
+                                           self.user)
+        return self._cache_store
+
     def _save_cache(self, cache):
         """
         This method dumps the current state of the header cache to the cache
@@ -375,24 +1460,12 @@ class ImapProcessor(MailProcessor):
         # Delete UIDs marked for deletion when the messages where deleted/moved
         for folder in self.cache_delete:
             for uid in self.cache_delete[folder]:
-                self.header_cache[folder]['uids'].pop(uid)
+                self.header_cache[folder]['uids'].pop(uid, None)
             self.cache_delete[folder] = []
 
-        # Drop unserializable mail objects from header cache before saving.
-        for folder in self.header_cache:
-            if 'uids' in self.header_cache[folder]:
-                for uid in self.header_cache[folder]['uids']:
-                    try:
-                        self.header_cache[folder]['uids'][uid].pop('obj')
-                    except KeyError:
-                        self.log_error("Couldn't drop Mail object for UID %s in "
-                                       "folder %s from cache: Mail object "
-                                       "missing" % (uid, folder))
         try:
-            f = open(self.cache_file, mode='w')
-            cache = json.dump(cache, f)
-            f.close()
-        except OSError as e:
+            self._get_cache_store().save(cache)
+        except (OSError, sqlite3.Error) as e:
             self.fatal_error("Couldn't save cache to "
                              "%s: %s" % (self.cache_file, e))
 
@@ -401,85 +1474,66 @@ class ImapProcessor(MailProcessor):
     def _download_headers_batched(self, folder, uids):
         """
         This method downloads headers and flags for a list of message UIDs in a
-        batched manner. It returns a dict of messages keyed by UID upon successful
-        fetch and will fail hard otherwise. Entries in the dictionary returned will
-        have a 'flags' and 'headers' key.
+        batched manner. It yields (uid, message) pairs as the messages arrive
+        and will fail hard if the download fails. Messages have a 'flags' and
+        'headers' key. Rules (see rule()) are applied to the messages first;
+        messages they move or delete are not yielded, except in dry-run mode,
+        where they stay in folder (see _unprocessed()).
         """
 
-        msgs = {}
+        if len(uids) == 0:
+            return
 
-        for batch in batch_list(uids, self.header_batchsize):
-            uid_list = ",".join(batch)
+        remaining, rules = self._apply_rules(folder, uids)
+        if not self.dry_run:
+            uids = remaining
+        if len(uids) == 0:
+            return
+        remaining = set(remaining)
+        matches = [[] for rule in rules]
 
-            self.log_debug("==> Downloading headers for UIDs %s" % uid_list)
+        batches = batch_list(uids, self.header_batchsize)
+        item = "(FLAGS %s)" % self.header_fetch_item()
 
-            try:
-                self.select(folder)
-                ret, data = self.imap.uid('fetch', uid_list,
-                                          "(FLAGS BODY.PEEK[HEADER])")
-            except self.imap.error as e:
-                # Anything imaplib raises an exception for is fatal here.
-                self.fatal_error("Error retrieving headers for message "
-                                 "UIDs %s: %s" % (",".join(uid_list), e))
-
-            if ret != 'OK':
-                self.fatal_error(
-                    "Error: Header retrieval failed with status "
-                    "%s for messages: %s" % (ret, ",".join(uid_list)))
-
-            for i in range(0, len(data), 2):
-                next_decoded = data[i + 1].decode('ascii')
-
-                # The data we are looking for may be in data[i][0] or data[i+1],
-                # depending on the IMAP server. Let's find out where it is:
-
-                if next_decoded == ')':
-                    # Dovecot
-                    uid_raw = data[i][0].decode('ascii')
-
-                if 'UID' in next_decoded:
-                    # Groupwise
-                    uid_raw = next_decoded
-
-                uid = re.search('UID (\d+)', uid_raw).group().split(" ")[1]
-
-                flags = []
-                flags_raw = imaplib.ParseFlags(data[i][0])
-
-                for flag in flags_raw:
-                    flags.append(flag.decode('ascii'))
-
-                headers_raw = email_parser.Parser().parsestr(data[i][1].decode('ascii',
-                                                                               'ignore'),
-                                                             headersonly=True)
-                headers = {}
-                for name in headers_raw.keys():
-                    value_parts = []
-                    for header in headers_raw.get_all(name, []):
-                        try:
-                            for (s, c) in email_header.decode_header(header):
-                                # email.header.decode_header in Python 3.x may
-                                # return either [(str, None)] or [(bytes,
-                                # None), ..., (bytes, encoding)]. We must
-                                # compensate for this.
-                                if not isinstance(s, str):
-                                        s = s.decode(c if c else "ascii")
-                                value_parts.append(s)
-                        except (email_errors.HeaderParseError, LookupError,
-                                ValueError):
-                                self._processor.log_error(
-                                        "Error: Could not decode header {0} in message "
-                                        "UID {1}".format(ascii(header), uid))
-                                value_parts.append(header)
-                    headers[name.lower()] = " ".join(value_parts)
-
-                    msgs[uid] = {}
-                    msgs[uid]['flags'] = flags
-                    msgs[uid]['headers'] = headers
-
-            self.log_debug("==> Header download finished for for UIDs %s" % uid_list)
-
-        return msgs
+        self.log_debug("==> Downloading headers for %d messages in folder %s"
+                       % (len(uids), folder))
+
+        self.ensure_selected(folder)
+
+        try:
+            for uid, attributes in self._uid_fetch(
+                    [(",".join(batch), item) for batch in batches]):
+                header = fetch.body(attributes)
+                if header is None:
+                    # An unsolicited FETCH response (such as a flag change
+                    # caused by another client).
+                    continue
+                message = {
+                    'flags': fetch.flags(attributes),
+                    'headers': fetch.decode_headers(header, uid,
+                                                    self.log_error)
+                    }
+                removed = uid not in remaining
+                for rule, matched in zip(rules, matches):
+                    if removed:
+                        break
+                    if rule.matches(message['headers'], message['flags']):
+                        matched.append(uid)
+                        removed = rule.removes
+                if not removed or self.dry_run:
+                    yield uid, message
+        except self.imap.abort:
+            raise
+        except self.imap.error as e:
+            # Anything imaplib raises an exception for is fatal here.
+            self.fatal_error("Error retrieving headers for messages in "
+                             "folder %s: %s" % (folder, e))
+
+        for rule, matched in zip(rules, matches):
+            if matched:
+                self._execute_rule(folder, rule, matched)
+
+        self.log_debug("==> Header download finished for folder %s" % folder)
 
     def _initialize_cache(self, folder):
         """
@@ -487,19 +1541,9 @@ class ImapProcessor(MailProcessor):
         """
         cache = {}
         uids = self.list_messages(folder)
-        messages = self._download_headers_batched(folder, uids)
 
-        for message_uid in uids:
-            if signals.terminate():
-                self.clean_exit()
-            msg_obj = self._mail_class(self, folder=folder,
-                                       uid=message_uid,
-                                       headers=messages[message_uid]['headers'],
-                                       flags=messages[message_uid]['flags'])
-            cache[message_uid] = {}
-            cache[message_uid]['headers'] = msg_obj._headers
-            cache[message_uid]['flags'] = msg_obj.message_flags
-            cache[message_uid]['obj'] = msg_obj
+        for uid, message in self._download_headers_batched(folder, uids):
+            cache[uid] = message
         return cache
 
     def _update_cache(self, folder, cache):
@@ -524,57 +1568,156 @@ class ImapProcessor(MailProcessor):
 
         for message in message_list:
             if signals.terminate():
-                self.clean_exit()
-            if message in cache:
-                cached_headers = cache[message]['headers']
-                cached_flags = cache[message]['flags']
-                msg_obj = self._mail_class(self, folder=folder,
-                                           uid=message,
-                                           headers=cached_headers,
-                                           flags=cached_flags)
-                cache[message]['obj'] = msg_obj
-
-            else:
+                # Leave exiting to the main thread (see _for_each_folder()).
+                return cache
+            if message not in cache:
                 uids_download.append(message)
 
         self.log_debug("Cache miss for the following UIDs: %s" % ",".join(uids_download))
 
-        if len(uids_download) != 0:
-            messages = self._download_headers_batched(folder, uids_download)
-            for uid in uids_download:
-                msg_obj = self._mail_class(self, folder=folder,
-                                           uid=uid,
-                                           headers=messages[uid]['headers'],
-                                           flags=messages[uid]['flags'])
-                cache[uid] = {}
-                cache[uid]['headers'] = msg_obj._headers
-                cache[uid]['flags'] = msg_obj.message_flags
-                cache[uid]['obj'] = msg_obj
+        for uid, message in self._download_headers_batched(folder,
+                                                           uids_download):
+            cache[uid] = message
         return cache
 
+    def _sync_changes(self, folder, cache, cached_modseq, modseq):
+        """
+        This method updates an existing header cache data structure for a
+        given folder using CONDSTORE/QRESYNC (RFC 7162). Only messages whose
+        mod-sequence exceeds cached_modseq are fetched. Expunged messages are
+        learned from VANISHED responses if QRESYNC is enabled, and otherwise
+        by listing the folder's UIDs if its message count does not match the
+        cache. If neither the folder's HIGHESTMODSEQ nor its message count
+        changed, no IMAP commands are issued at all.
+        """
+
+        if modseq != cached_modseq:
+            self.log_debug("Fetching changes in folder %s since mod-sequence "
+                           "%s" % (folder, cached_modseq))
+            self.ensure_selected(folder)
+
+            if self.qresync:
+                modifiers = "(CHANGEDSINCE %s VANISHED)" % cached_modseq
+            else:
+                modifiers = "(CHANGEDSINCE %s)" % cached_modseq
+
+            uids_download = []
+            try:
+                for uid, attributes in self._uid_fetch(
+                        [('1:*', '(UID FLAGS)', modifiers)]):
+                    if uid not in cache:
+                        uids_download.append(uid)
+                    elif 'FLAGS' in attributes:
+                        self._update_flags(folder, cache, uid,
+                                           fetch.flags(attributes))
+            except self.imap.abort:
+                raise
+            except self.imap.error as e:
+                self.fatal_error("Fetching changes in folder %s failed: "
+                                 "%s" % (folder, e))
+
+            _, vanished = self.imap.response('VANISHED')
+            for item in vanished:
+                if item is None:
+                    continue
+                uid_set = item.decode('ascii').replace('(EARLIER)', '')
+                for uid in expand_uid_set(uid_set.strip()):
+                    cache.pop(uid, None)
+
+            self.log_debug("New UIDs: %s" % ",".join(uids_download))
+
+            for uid, message in self._download_headers_batched(
+                    folder, uids_download):
+                cache[uid] = message
+        else:
+            self.log_debug("Folder %s unchanged since mod-sequence "
+                           "%s" % (folder, modseq))
+
+        # Without QRESYNC we do not learn about expunged messages, and
+        # expunging messages need not raise HIGHESTMODSEQ. Fall back to a
+        # full UID listing if the message count does not add up.
+        exists = self.exists.get(self.mailbox_name(folder))
+        if not self.qresync and exists != len(cache):
+            message_list = set(self.list_messages(folder))
+            for uid in list(cache):
+                if uid not in message_list:
+                    cache.pop(uid)
+
+        self._flags_synced.add(folder)
+        return cache
+
+    def _mail(self, folder, uid):
+        """
+        Creates the mail object for message uid in folder from the header
+        cache.
+        """
+        message = self.header_cache[folder]['uids'][uid]
+        return self._mail_class(
+            self, folder=folder, uid=uid, headers=message['headers'],
+            flags=message['flags'],
+            header_fields=self.header_cache[folder].get('header_fields'))
+
+    def _highestmodseq(self, folder):
+        """
+        This method returns the HIGHESTMODSEQ (RFC 7162) for a given folder
+        or None if the server does not support CONDSTORE.
+        """
+        if not self.condstore:
+            return None
+        self.ensure_selected(folder)
+        return self.highestmodseq.get(self.mailbox_name(folder))
+
     def _uidvalidity(self, folder):
         """
         This message returns the IMAP UIDVALIDITY for a given folder. This
         information is needed to determine whether the cache for a given folder
         needs to be reinitialized.
         """
-        if folder not in self.uidvalidity:
+        name = self.mailbox_name(folder)
+        if name not in self.uidvalidity:
             self.select(folder)
-        return self.uidvalidity[folder]
+        return self.uidvalidity[name]
+
+    def mailbox_name(self, folder):
+        """
+        Returns the name folder is selected by, with the folder name prefix
+        prepended where applicable. folder may be a string or a list of path
+        components.
+        """
+        return FolderRegistry.normalize(
+            self.list_path(self.path_ensure_prefix(folder)))
+
+    def ensure_selected(self, folder):
+        """
+        Selects folder unless it is selected already on the connection owning
+        it (see session_for()).
+        """
+        with self.session_for(folder):
+            if self.selected != self.mailbox_name(folder):
+                self.select(folder)
 
     def select(self, folder):
         """
-        Performs an IMAP SELECT on folder.
+        Performs an IMAP SELECT on folder, on the connection owning it (see
+        session_for()). Raises imap.abort if the server dropped the
+        connection.
         """
 
-        # Make sure the folder name is prepended with prefix where applicable.
-        folder = self.path_ensure_prefix(folder)
-        folder = self.list_path(folder)
+        with self.session_for(folder):
+            return self._select(self.mailbox_name(folder))
+
+    def _select(self, folder):
+        """
+        Performs an IMAP SELECT on the folder named folder (as sent to the
+        server) in the current session.
+        """
 
         self.log("==> Selecting folder %s" % folder)
 
         try:
             status, data = self.imap.select(mailbox=folder)
+        except self.imap.abort:
+            raise
         except self.imap.error as e:
             self.fatal_error("Couldn't select folder %s: %s" % (folder, e))
         if status != 'OK':
@@ -587,6 +1730,14 @@ class ImapProcessor(MailProcessor):
         v_string = self.imap.response('UIDVALIDITY')[1][0].decode('ascii')
         self.uidvalidity[folder] = v_string
 
+        self.exists[folder] = int(data[-1])
+
+        modseq = self.imap.response('HIGHESTMODSEQ')[1][0]
+        if modseq is not None:
+            self.highestmodseq[folder] = modseq.decode('ascii')
+        else:
+            self.highestmodseq.pop(folder, None)
+
         self.selected = folder
         self.log("==> Folder %s selected." % folder)
 
@@ -628,32 +1779,41 @@ class ImapProcessor(MailProcessor):
 
     def get_flags(self, folder):
         """
-        Get message flags for a folder.
+        Get message flags for a folder, using the connection owning it (see
+        session_for()). Returns a dict mapping the UIDs of the messages in
+        the folder's header cache to lists of their flags.
         """
+
+        with self.session_for(folder):
+            return self._get_flags(folder)
+
+    def _get_flags(self, folder):
         self.log_debug("%d UIDs in cache" % len(self.header_cache[folder]['uids']))
 
         uid_list = list(self.header_cache[folder]['uids'].keys())
 
+        flags = {}
+
         if len(uid_list) == 0:
-          return ([], [])
+            return flags
 
-        for batch in batch_list(uid_list, self.flag_batchsize):
-            self.log_debug("%d UIDs in batch" % len(batch))
-            ret_full = []
-            data_full = []
+        batches = batch_list(uid_list, self.flag_batchsize)
 
-            try:
-                self.select(folder)
-                uids = ",".join(batch)
-                ret, data = self.imap.uid('fetch', uids, "FLAGS")
-                ret_full.append(data)
-                data_full.extend(data)
-            except self.imap.error as e:
-                self.fatal_error(
-                    "Could not retrieve message flags for folder {0}, UIDs {1}: {2}"
-                    "{1}".format(folder, uids, e))
+        self.ensure_selected(folder)
+
+        try:
+            for uid, attributes in self._uid_fetch(
+                    [(",".join(batch), "FLAGS") for batch in batches]):
+                if 'FLAGS' in attributes:
+                    flags[uid] = fetch.flags(attributes)
+        except self.imap.abort:
+            raise
+        except self.imap.error as e:
+            self.fatal_error(
+                "Could not retrieve message flags for folder {0}: "
+                "{1}".format(folder, e))
 
-            return (ret_full, data_full)
+        return flags
 
     def refresh_flags(self):
         """
@@ -661,56 +1821,295 @@ class ImapProcessor(MailProcessor):
         """
 
         self.log_info("==> Updating message flags...")
-        for folder in self.header_cache:
+        self._for_each_folder(self._refresh_folder_flags)
+        self.log_info("==> Message flags updated.")
+
+    def _refresh_folder_flags(self, folder):
+        """
+        Refreshes message flags for all messages in a folder's header cache.
+        """
+
+        if folder in self._flags_synced:
+            # Already up to date: downloaded along with the headers or
+            # brought up to date through CONDSTORE.
+            return
+        try:
+            server_flags = self.get_flags(folder)
+        except self.imap.abort:
+            self.log_error("IMAP connection aborted, reconnecting.")
+            # Reconnect if the connection has timed out due to the header
+            # cache update taking too long (may happen on mailboxes with
+            # lots of messages).
+            self.reconnect()
+            server_flags = self.get_flags(folder)
+        for uid, flags in server_flags.items():
+            self.log_debug("UID: %s" % uid)
+            self.log_debug("  server flags: %s" % flags)
+            self._update_flags(folder, self.header_cache[folder]['uids'],
+                               uid, flags)
+
+    def _update_flags(self, folder, cache, uid, flags):
+        """
+        Updates the flags of message uid in the header cache for folder,
+        remembering the message if its flags changed.
+        """
+        message = cache[uid]
+        self.log_debug("   cache flags: %s" % message['flags'])
+        if sorted(message['flags']) != sorted(flags):
+            self._flags_changed.setdefault(folder, set()).add(uid)
+            message['flags'] = flags
+
+    def idle(self, folder, timeout):
+        """
+        Waits for changes to folder using IMAP IDLE (RFC 2177). Returns True
+        as soon as the server reports new, expunged or modified messages and
+        False if timeout seconds pass without any such report or a
+        termination signal is received.
+        """
+
+        self.select(folder)
+        self.log_debug("==> Entering IDLE on folder %s" % folder)
+
+        if isinstance(self.imap, ImapClient):
+            changed = self.imap.idle(timeout, signals.signal_event.is_set)
+            self.log_debug("==> Left IDLE on folder %s" % folder)
+            return changed
+
+        tag = self.imap._command('IDLE')
+        changed = False
+
+        # Wait for the server's continuation request. Anything tagged with
+        # our tag at this point means the server refused to IDLE. Changes
+        # may be reported before the continuation request already.
+        while True:
+            line = self.imap._get_line()
+            if line.startswith(b'+'):
+                break
+            if line.startswith(tag):
+                self.log_imap_error("IDLE on folder %s" % folder,
+                                    line.decode('ascii', 'replace'))
+                return changed
+            if Idle_change.match(line):
+                changed = True
+
+        deadline = time.time() + timeout
+        sock = self.imap.socket()
+
+        while not changed and not signals.signal_event.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if not self._input_pending(sock):
+                readable, _, _ = select.select([sock], [], [],
+                                               min(remaining, 1))
+                if not readable:
+                    continue
+            line = self.imap._get_line()
+            self.log_debug("IDLE: %s" % line.decode('ascii', 'replace'))
+            if Idle_change.match(line):
+                changed = True
+
+        self.imap.send(b'DONE\r\n')
+        self.imap._command_complete('IDLE', tag)
+        self.log_debug("==> Left IDLE on folder %s" % folder)
+
+        return changed
+
+    def _input_pending(self, sock):
+        """
+        Returns True if data sent by the server is waiting to be read without
+        select() on sock knowing about it: data already decrypted by SSL,
+        decompressed, or read into the buffer of imaplib's socket file.
+        """
+        if hasattr(sock, 'pending') and sock.pending():
+            return True
+        reader = self.imap.file
+        if isinstance(reader, deflate.DeflateFile):
+            if reader.pending():
+                return True
+            reader = reader.fileobj
+        # peek() returns the buffered data if there is any and reads from
+        # the socket otherwise, which must not block here.
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            return len(reader.peek()) > 0
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            sock.settimeout(timeout)
+
+    def _wait_idle(self):
+        """
+        Waits for new mail in the first configured folder using IDLE. Other
+        folders are rescanned once --interval seconds have passed.
+        """
+
+        folder = self.folders[0]
+        deadline = time.time() + self.interval
+
+        self.log("==> Waiting for changes in folder %s..." % folder)
+
+        while not signals.signal_event.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
             try:
-                ret, data = self.get_flags(folder)
-            except self.imap.abort:
-                self.log_error("IMAP connection aborted, reconnecting.")
-                # Reconnect if the connection has timed out due to the header
-                # cache update taking too long (may happen on mailboxes with
-                # lots of messages).
+                if self.idle(folder, min(remaining, IDLE_TIMEOUT)):
+                    self.log("==> Folder %s changed." % folder)
+                    return
+            except self.imap.abort as e:
+                self.log_error("IMAP connection aborted during IDLE (%s), "
+                               "reconnecting." % e)
                 self.reconnect()
-                ret, data = self.get_flags(folder)
-            for msg in data:
-                flags = []
-                flags_raw = imaplib.ParseFlags(msg)
-                for flag in flags_raw:
-                    flags.append(flag.decode('ascii'))
-                uid = re.search('UID (\d+)',
-                                msg.decode('ascii')).group().split(" ")[1]
-                self.log_debug("UID: %s" % uid)
-                self.log_debug("  server flags: %s" % flags)
-                self.log_debug("   cache flags: %s" %
-                               self.header_cache[folder]['uids'][uid]['flags'])
-                self.header_cache[folder]['uids'][uid]['flags'] = flags
-                self.header_cache[folder]['uids'][uid]['obj'].message_flags = flags
-        self.log_info("==> Message flags updated.")
+                return
+
+    def _enable_condstore(self):
+        """
+        Enables QRESYNC (or plain CONDSTORE if QRESYNC is not available) so
+        folders can be synchronized incrementally by mod-sequence.
+        """
+        self.condstore = False
+        self.qresync = False
+
+        if not self.has_capability('ENABLE'):
+            return
 
-    def _status(self, folder):
+        for extension in ('QRESYNC', 'CONDSTORE'):
+            if not self.has_capability(extension):
+                continue
+            try:
+                status, data = self.imap._simple_command('ENABLE', extension)
+            except self.imap.error as e:
+                self.log_imap_error("ENABLE %s" % extension, e)
+                continue
+            if status == 'OK':
+                self.log_debug("==> Enabled %s" % extension)
+                self.condstore = True
+                self.qresync = extension == 'QRESYNC'
+                return
+
+    def _enable_compression(self):
         """
-        Performs an IMAP STATUS on folder. Primarily useful for checking folder
-        existence.
+        Compresses the session with COMPRESS=DEFLATE (RFC 4978) if the server
+        supports it.
         """
+        if not self.has_capability('COMPRESS=DEFLATE'):
+            self.log_debug("==> Server does not support COMPRESS=DEFLATE")
+            return
+
         try:
-            status, data = self.imap.select(mailbox=folder)
+            if isinstance(self.imap, ImapClient):
+                status, data = self.imap.compress()
+            else:
+                status, data = self.imap._simple_command('COMPRESS',
+                                                         'DEFLATE')
+        except self.imap.error as e:
+            self.log_imap_error("COMPRESS DEFLATE", e)
+            return
+
+        if status != 'OK':
+            self.log_imap_error("COMPRESS DEFLATE", data[-1])
+            return
+
+        if not isinstance(self.imap, ImapClient):
+            deflate.compress_imaplib(self.imap)
+        self.log_debug("==> Enabled COMPRESS=DEFLATE")
+
+    def _wait_keepalive(self):
+        """
+        Waits for --interval seconds, keeping the IMAP session alive with
+        periodic NOOP commands.
+        """
+
+        deadline = time.time() + self.interval
+
+        while not signals.signal_event.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            signals.signal_event.wait(min(remaining, NOOP_INTERVAL))
+            if not signals.signal_event.is_set():
+                self.noop()
+
+    def _refresh_capabilities(self):
+        """
+        Retrieves the server's capabilities. Many servers advertise more
+        capabilities after login than in their greeting, so this should be
+        invoked once the session is authenticated.
+        """
+        try:
+            status, data = self.imap.capability()
+        except self.imap.error as e:
+            self.log_imap_error("CAPABILITY", e)
+            self.capabilities = tuple(self.imap.capabilities)
+            return
+        self.capabilities = tuple(data[-1].decode('ascii').upper().split())
+        self.log_debug("==> Server capabilities: %s" %
+                       " ".join(self.capabilities))
+
+    def _folder_exists(self, folder):
+        """
+        Returns True if the folder named folder (as sent to the server)
+        exists. The folder registry is loaded with a single LIST command on
+        first use. Should that fail, folder is looked up with STATUS, which
+        leaves the selected folder alone.
+        """
+        if not self.folder_registry.loaded:
+            self._load_folder_registry()
+        if self.folder_registry.loaded:
+            return self.folder_registry.exists(folder)
+
+        try:
+            status, data = self.imap.status(folder, '(MESSAGES)')
         except self.imap.error as e:
             self.fatal_error("Couldn't query status for "
                              "folder %s: %s" % (folder, e))
-        data = data[0].decode('ascii')
-        # STATUS ends SELECT state, so return to previously selected folder.
-        self.select(self.selected)
-        return (status == 'OK', data)
+        return status == 'OK'
+
+    def _load_folder_registry(self):
+        """
+        Loads the folder registry with all folders on the server.
+        """
+        try:
+            status, data = self.imap.list('""', '*')
+        except self.imap.error as e:
+            self.log_imap_error("Listing folders", e)
+            return
+        if status != 'OK':
+            self.log_imap_error("Listing folders", status)
+            return
+        self.folder_registry.load(data)
+        self.log_debug("==> %d folders on server" %
+                       len(self.folder_registry.folders))
+
+    def _logout(self):
+        """
+        Closes the selected folder and logs out on all IMAP connections.
+        """
+
+        for session in self._sessions:
+            if session.selected is not None:
+                session.imap.close()
+                session.selected = None
+            session.imap.logout()
+
+        # Folders may be created or deleted by others before the next
+        # session.
+        self.folder_registry.invalidate()
+        self._cache_loaded = False
 
     def clean_sleep(self):
         """
         Close IMAP connection and save cache before going to sleep.
         """
 
+        self.flush_actions()
         self.log("==> Saving header cache...")
         self._save_cache(self.header_cache)
         self.log("==> Closing IMAP connection...")
-        self.imap.close()
-        self.imap.logout()
+        self._logout()
+        self.close_delivery()
         self.log("==> ...done.")
 
     def clean_exit(self):
@@ -718,10 +2117,31 @@ class ImapProcessor(MailProcessor):
         Close connnection and exit in a clean manner.
         """
 
+        self.flush_actions()
         self.log("==> Saving header cache...")
         self._save_cache(self.header_cache)
         self.log("==> Closing IMAP connection...")
-        self.imap.close()
-        self.imap.logout()
+        self._logout()
+        self.close_delivery()
         self.log("==> ...done.")
         sys.exit(0)
+
+    def close(self):
+        """
+        Logs out on the IMAP connections still open and closes the header
+        cache store and the delivery connection, without saving or flushing
+        anything. Used for cleaning up after a scheduled pass, however the rc
+        file ended.
+        """
+
+        for session in self._sessions:
+            if session.imap is None or session.imap.state == 'LOGOUT':
+                continue
+            try:
+                session.imap.logout()
+            except (session.imap.error, OSError):
+                pass
+        self.close_delivery()
+        if self._cache_store is not None:
+            self._cache_store.close()
+            self._cache_store = None
@@ -18,17 +18,29 @@
 # 02110-1301, USA.
 
 import errno
+import hashlib
 import os
 import random
 import socket
+import sqlite3
 import time
 
+from mailprocessing import filecopy
+from mailprocessing import inotify
 from mailprocessing import signals
 
+from mailprocessing.digest import DigestCache
 from mailprocessing.processor.generic import MailProcessor
 from mailprocessing.mail.dryrun import DryRunMaildir
 from mailprocessing.mail.maildir import MaildirMail
 
+# Default for MaildirProcessor.max_header_size.
+MAX_HEADER_SIZE = 1024 * 1024
+
+# How long to wait for inotify events before checking for termination
+# signals and a modified rc file again.
+INOTIFY_TIMEOUT = 1
+
 
 class MaildirProcessor(MailProcessor):
     def __init__(self, *args, **kwargs):
@@ -36,12 +48,32 @@ class MaildirProcessor(MailProcessor):
         self._maildirs = []
         self.separator = kwargs.get('folder_separator', '.')
         self.prefix = kwargs.get('folder_prefix', '.')
+        self.use_inotify = kwargs.get('inotify', False)
+        self.incremental = kwargs.get('incremental', False)
+        self.reprocess_flag_changes = kwargs.get('reprocess_flag_changes',
+                                                 False)
+        # Maps maildirs to the set of keys (see _mail_key()) of the mail
+        # passed to the rc file, for incremental processing.
+        self._processed = {}
+        # (maildir, key) tuples of the mail inotify reported as removed in
+        # the last batch of events (see _unprocessed()).
+        self._removed = []
+        self._max_header_size = MAX_HEADER_SIZE
+        self._digest_algorithm = 'sha1'
+        self._copy_strategy = 'link'
         if 'dry_run' in kwargs and kwargs['dry_run'] is True:
             self._mail_class = DryRunMaildir
         else:
             self._mail_class = MaildirMail
         super(MaildirProcessor, self).__init__(*args, **kwargs)
 
+        digest_cache = kwargs.get('digest_cache')
+        try:
+            self._digest_cache = DigestCache(digest_cache)
+        except (OSError, sqlite3.Error) as e:
+            self.fatal_error("Error: Could not open digest cache "
+                             "%s: %s" % (digest_cache, e))
+
     def get_maildir_base(self):
         return self._maildir_base
 
@@ -58,39 +90,68 @@ class MaildirProcessor(MailProcessor):
 
     maildirs = property(get_maildirs, set_maildirs)
 
+    def get_digest_algorithm(self):
+        return self._digest_algorithm
+
+    def set_digest_algorithm(self, algorithm):
+        """
+        Setter method for the hashlib algorithm used for the digests of
+        messages that are logged, such as 'sha1' or 'blake2b'.
+        """
+        try:
+            hashlib.new(algorithm)
+        except ValueError:
+            self.fatal_error("Error: Unsupported digest algorithm "
+                             "%s" % algorithm)
+        self._digest_algorithm = algorithm
+
+    digest_algorithm = property(get_digest_algorithm, set_digest_algorithm)
+
+    def get_copy_strategy(self):
+        return self._copy_strategy
+
+    def set_copy_strategy(self, strategy):
+        """
+        Setter method for how mail is copied: 'link' (hard links where
+        possible), 'reflink' (copy-on-write clones where possible) or 'copy'.
+        See mailprocessing.filecopy.
+        """
+        if strategy not in filecopy.STRATEGIES:
+            self.fatal_error("Error: Unknown copy strategy %s (expected one "
+                             "of %s)" % (strategy,
+                                         ", ".join(filecopy.STRATEGIES)))
+        self._copy_strategy = strategy
+
+    copy_strategy = property(get_copy_strategy, set_copy_strategy)
+
+    def get_max_header_size(self):
+        return self._max_header_size
+
+    def set_max_header_size(self, size):
+        self._max_header_size = size
+
+    max_header_size = property(get_max_header_size, set_max_header_size)
+
     def __iter__(self):
         if not self._maildirs:
             self.fatal_error("Error: No maildirs to process")
 
         self.rcfile_modified = False
-        mtime_map = {}
-        while True:
-            if self.auto_reload_rcfile:
-                current_rcfile_mtime = self._get_previous_rcfile_mtime()
-                if current_rcfile_mtime != self._previous_rcfile_mtime:
-                    self._previous_rcfile_mtime = current_rcfile_mtime
-                    self.rcfile_modified = True
-                    self.log_info("Detected modified RC file; reloading")
-                    break
-            for maildir in self._maildirs:
-                maildir_path = os.path.join(self._maildir_base, maildir)
-                for subdir in ["cur", "new"]:
-                    subdir_path = os.path.join(maildir_path, subdir)
-                    cur_mtime = os.path.getmtime(subdir_path)
-                    if cur_mtime != mtime_map.setdefault(subdir_path, 0):
-                        if cur_mtime < int(time.time()):
-                            # If cur_mtime == int(time.time()) we
-                            # can't be sure that everything has been
-                            # processed; a new mail may be delivered
-                            # later the same second.
-                            mtime_map[subdir_path] = cur_mtime
-                        for mail_file in os.listdir(subdir_path):
-                            mail_path = os.path.join(subdir_path, mail_file)
-                            yield self._mail_class(self, maildir=maildir,
-                                                   mail_path=mail_path)
-            if self._run_once or signals.terminate():
-                break
-            time.sleep(1)
+
+        watches = None
+        if self.use_inotify and not self._run_once:
+            watches = self._watch_maildirs()
+
+        if watches is None:
+            yield from self._poll_maildirs()
+        else:
+            watcher, watches = watches
+            try:
+                yield from self._wait_maildirs(watcher, watches)
+            finally:
+                watcher.close()
+        self.close_delivery()
+        self._digest_cache.save()
 
     # ----------------------------------------------------------------
     # Interface used by MailBase and descendants:
@@ -157,6 +218,28 @@ class MaildirProcessor(MailProcessor):
         self._deliveries += 1
         return "{0}.{1}.{2}".format(now, delivery_identifier, hostname)
 
+    def copy_file(self, source, target):
+        """
+        Creates the file target as a copy of the mail file source, according
+        to copy_strategy. Raises OSError if copying fails.
+        """
+        method = filecopy.copy_file(source, target, self._copy_strategy)
+        self.log_debug("==> Copied {0} to {1} ({2})".format(
+            source, target, method))
+
+    def file_digest(self, path, algorithm):
+        """
+        Returns the hexadecimal digest of the message file path computed with
+        the hashlib algorithm algorithm, or None if the file cannot be read.
+        Digests are cached, so files are only read once.
+        """
+        try:
+            return self._digest_cache.digest(path, algorithm)
+        except OSError as e:
+            # The file was probably (re)moved by some other process.
+            self.log_mail_opening_error(path, e)
+            return None
+
     def log_io_error(self, errmsg, os_errmsg):
         self.log_error(
             "Error: {0} (error message from OS: {1})".format(
@@ -174,3 +257,285 @@ class MaildirProcessor(MailProcessor):
         except FileNotFoundError:
             self.log_error("Error: Moving file from {0} to {1}. Maybe it doesn't exist?".format(
                 source, target))
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            self._move_across_devices(source, target)
+
+    # ----------------------------------------------------------------
+
+    def _move_across_devices(self, source, target):
+        """
+        Moves the mail file source to target in another maildir on a
+        different file system: copies it to the target maildir's tmp
+        directory, renames the copy to target and removes source.
+        """
+        tmp_target = os.path.join(os.path.dirname(os.path.dirname(target)),
+                                  "tmp", self.create_maildir_name())
+        self.copy_file(source, tmp_target)
+        try:
+            st = os.stat(source)
+            os.utime(tmp_target, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.rename(tmp_target, target)
+        except OSError:
+            os.unlink(tmp_target)
+            raise
+        os.unlink(source)
+
+    def _rcfile_reloaded(self):
+        """
+        Returns True (and flags the rc file for reloading) if automatic
+        reloading is enabled and the rc file was modified.
+        """
+        if not self.auto_reload_rcfile:
+            return False
+        current_rcfile_mtime = self._get_previous_rcfile_mtime()
+        if current_rcfile_mtime == self._previous_rcfile_mtime:
+            return False
+        self._previous_rcfile_mtime = current_rcfile_mtime
+        self.rcfile_modified = True
+        self.log_info("Detected modified RC file; reloading")
+        return True
+
+    def _subdirs(self):
+        """
+        Returns (maildir, paths) tuples for all maildirs, paths being the
+        paths of their cur and new directories.
+        """
+        subdirs = []
+        for maildir in self._maildirs:
+            maildir_path = os.path.join(self._maildir_base, maildir)
+            subdirs.append((maildir, [os.path.join(maildir_path, subdir)
+                                      for subdir in ["cur", "new"]]))
+        return subdirs
+
+    def _mail_key(self, name):
+        """
+        Returns the key identifying the mail file name within its maildir
+        for incremental processing: a 64 bit hash of its unique name without
+        the info suffix holding its flags, or with --reprocess-flag-changes,
+        of its unique name and flags. Hashes take up a fraction of the memory
+        the names would in large maildirs.
+        """
+        unique, _, flags = name.partition(":2,")
+        if self.reprocess_flag_changes:
+            unique = "%s:2,%s" % (unique, flags)
+        digest = hashlib.blake2b(unique.encode('utf-8', 'surrogateescape'),
+                                 digest_size=8).digest()
+        return int.from_bytes(digest, 'big')
+
+    def _scan(self, maildir, paths):
+        """
+        Yields the mail in the directories paths of maildir. In incremental
+        mode, only mail not yielded before is yielded, and paths must hold
+        both the cur and the new directory, so mail moved from one to the
+        other is recognized.
+        """
+        if not self.incremental:
+            for path in paths:
+                for entry in list(os.scandir(path)):
+                    yield self._mail_class(self, maildir=maildir,
+                                           mail_path=entry.path)
+            return
+
+        processed = self._processed.get(maildir, set())
+        present = set()
+        for path in paths:
+            for entry in list(os.scandir(path)):
+                key = self._mail_key(entry.name)
+                present.add(key)
+                if key not in processed:
+                    yield self._mail_class(self, maildir=maildir,
+                                           mail_path=entry.path)
+        # Forget mail that is gone.
+        self._processed[maildir] = present
+
+    def _poll_maildirs(self):
+        """
+        Yields the mail in every maildir directory whose modification time
+        changed, checking all of them once a second.
+        """
+        mtime_map = {}
+        while True:
+            if self._rcfile_reloaded():
+                break
+            for maildir, subdir_paths in self._subdirs():
+                changed = []
+                for subdir_path in subdir_paths:
+                    cur_mtime = os.path.getmtime(subdir_path)
+                    if cur_mtime != mtime_map.setdefault(subdir_path, 0):
+                        if cur_mtime < int(time.time()):
+                            # If cur_mtime == int(time.time()) we
+                            # can't be sure that everything has been
+                            # processed; a new mail may be delivered
+                            # later the same second.
+                            mtime_map[subdir_path] = cur_mtime
+                        changed.append(subdir_path)
+                if not changed:
+                    continue
+                if self.incremental:
+                    changed = subdir_paths
+                yield from self._scan(maildir, changed)
+            if self._run_once or signals.terminate():
+                break
+            time.sleep(1)
+
+    def _watch_maildirs(self):
+        """
+        Sets up inotify watches for the cur and new directories of all
+        maildirs. Returns the inotify instance and a dict mapping watch
+        descriptors to (maildir, path) tuples, or None if the maildirs
+        cannot be watched with inotify.
+        """
+        subdirs = [(maildir, path) for maildir, paths in self._subdirs()
+                   for path in paths]
+
+        for maildir, path in subdirs:
+            filesystem = inotify.remote_filesystem(path)
+            if filesystem is not None:
+                self.log_info("==> %s is on a network file system (%s); "
+                              "falling back to polling" % (path, filesystem))
+                return None
+
+        try:
+            watcher = inotify.Inotify()
+        except OSError as e:
+            self.log_info("==> inotify is not available (%s); falling back "
+                          "to polling" % e)
+            return None
+
+        # Mail delivered properly is renamed (or linked) from tmp into new,
+        # so it is complete when it shows up. Mail written to new directly
+        # is only picked up once it has been written and closed.
+        mask = (inotify.IN_MOVED_TO | inotify.IN_CLOSE_WRITE |
+                inotify.IN_CREATE | inotify.IN_ONLYDIR)
+        if self.incremental:
+            # Needed to forget mail that is gone.
+            mask |= inotify.IN_DELETE | inotify.IN_MOVED_FROM
+
+        watches = {}
+        try:
+            for maildir, path in subdirs:
+                watches[watcher.add_watch(path, mask)] = (maildir, path)
+        except OSError as e:
+            watcher.close()
+            self.log_info("==> Could not watch %s with inotify (%s); falling "
+                          "back to polling" % (e.filename, e))
+            return None
+
+        self.log_debug("==> Watching %d directories with inotify" %
+                       len(watches))
+        return watcher, watches
+
+    def _wait_maildirs(self, watcher, watches):
+        """
+        Yields all mail in the watched maildir directories, then the mail
+        arriving in them as inotify reports it. If the kernel's event queue
+        overflows, all directories are scanned again.
+        """
+        rescan = True
+        while True:
+            if self._rcfile_reloaded():
+                break
+
+            # Mail found by a scan is not yielded again for the events
+            # queued while scanning.
+            scanned = set()
+            if rescan:
+                rescan = False
+                # The scan records what is there now.
+                self._removed = []
+                watched = set(path for maildir, path in watches.values())
+                for maildir, subdir_paths in self._subdirs():
+                    paths = [path for path in subdir_paths if path in watched]
+                    for mail in self._scan(maildir, paths):
+                        scanned.add(mail.path)
+                        yield mail
+
+            while not signals.terminate():
+                events = watcher.read(INOTIFY_TIMEOUT)
+                if events or self.auto_reload_rcfile:
+                    break
+            if signals.terminate():
+                break
+
+            arrived = []
+            removed = []
+            for wd, mask, name in events:
+                if mask & inotify.IN_Q_OVERFLOW:
+                    self.log_info("==> inotify event queue overflowed; "
+                                  "rescanning maildirs")
+                    rescan = True
+                elif mask & inotify.IN_IGNORED:
+                    if wd in watches:
+                        self.log_error("Error: Directory %s is gone; no "
+                                       "longer watching it" % watches[wd][1])
+                        del watches[wd]
+                elif wd in watches and name and not mask & inotify.IN_ISDIR:
+                    maildir, subdir_path = watches[wd]
+                    if mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                        removed.append((maildir, name))
+                        continue
+                    mail_path = os.path.join(subdir_path, name)
+                    if mask & inotify.IN_CREATE and \
+                       not self._linked(mail_path):
+                        # Still being written; IN_CLOSE_WRITE follows.
+                        continue
+                    # The rc file may have moved the mail away already, or
+                    # some other process did.
+                    if mail_path not in scanned and \
+                       os.path.lexists(mail_path):
+                        scanned.add(mail_path)
+                        arrived.append((maildir, name, mail_path))
+
+            if rescan:
+                continue
+
+            if self.incremental:
+                arrived = self._unprocessed(arrived, removed)
+
+            for maildir, name, mail_path in arrived:
+                yield self._mail_class(self, maildir=maildir,
+                                       mail_path=mail_path)
+
+    def _linked(self, path):
+        """
+        Returns True if the file path has more than one link, which means it
+        was created with link(2), complete, rather than opened for writing.
+        """
+        try:
+            return os.lstat(path).st_nlink > 1
+        except OSError:
+            return False
+
+    def _unprocessed(self, arrived, removed):
+        """
+        Records the mail that arrived in and was removed from the watched
+        maildirs, given as (maildir, name, path) and (maildir, name) tuples,
+        and returns the arrived mail that has not been processed before.
+        """
+        unprocessed = []
+        keys = set()
+        for maildir, name, mail_path in arrived:
+            key = self._mail_key(name)
+            keys.add((maildir, key))
+            processed = self._processed.setdefault(maildir, set())
+            if key not in processed:
+                processed.add(key)
+                unprocessed.append((maildir, name, mail_path))
+
+        # A mail renamed to change its flags is removed under its old name
+        # and arrives under its new one, so it is only forgotten if it did
+        # not arrive again. The two events may end up in different batches,
+        # so mail is only forgotten once the batch after the one reporting
+        # its removal has been seen.
+        for maildir, key in self._removed:
+            if (maildir, key) not in keys:
+                self._processed.get(maildir, set()).discard(key)
+        self._removed = []
+        for maildir, name in removed:
+            key = self._mail_key(name)
+            if (maildir, key) not in keys:
+                self._removed.append((maildir, key))
+
+        return unprocessed
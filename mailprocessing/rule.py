@@ -0,0 +1,156 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Declarative filter rules.
+
+A rule combines simple criteria (a header containing a string, the \\Seen
+and \\Flagged flags) with actions to apply to all messages matching them.
+Since the criteria mean the same as IMAP SEARCH keys, rules can be evaluated
+by the IMAP server, and their actions applied to all matching messages at
+once, without downloading any message headers.
+"""
+
+import re
+
+# Characters a search string may consist of to be sent as a quoted string.
+Quotable = re.compile(r'^[\x20-\x7e]*$')
+
+
+class Rule(object):
+    """
+    Applies its actions to messages in which the header field header
+    contains the string contains (case-insensitively, like
+    MailHeader.contains()), whose \\Seen flag is set (seen=True) or not set
+    (seen=False) and whose \\Flagged flag is set (flagged=True) or not set
+    (flagged=False). Criteria that are not given are not checked. If folder
+    is given, the rule only applies to messages in that folder.
+
+    Actions are added with copy(), move() and delete(), which return the
+    rule, so they can be chained.
+    """
+
+    def __init__(self, header=None, contains=None, seen=None, flagged=None,
+                 folder=None):
+        if (header is None) != (contains is None):
+            raise ValueError("header and contains must be given together")
+        if header is None and seen is None and flagged is None:
+            raise ValueError("a rule needs at least one criterion")
+        if contains == "":
+            raise ValueError("contains must not be empty")
+        self.header = header
+        self.contains = contains
+        self.seen = seen
+        self.flagged = flagged
+        self.folder = folder
+        self.actions = []
+
+    def __str__(self):
+        criteria = []
+        if self.header is not None:
+            criteria.append("header {0} contains {1}".format(
+                self.header, ascii(self.contains)))
+        for flag in ('seen', 'flagged'):
+            if getattr(self, flag) is not None:
+                criteria.append("{0}{1}".format(
+                    "" if getattr(self, flag) else "not ", flag))
+        return ", ".join(criteria)
+
+    def copy(self, folder, create=False):
+        """
+        Copies matching messages to folder, creating it first if it does not
+        exist and create is True.
+        """
+        self._add_action('copy', folder, create)
+        return self
+
+    def move(self, folder, create=False):
+        """
+        Moves matching messages to folder, creating it first if it does not
+        exist and create is True.
+        """
+        self._add_action('move', folder, create)
+        return self
+
+    def delete(self):
+        """
+        Deletes matching messages.
+        """
+        self._add_action('delete', None, False)
+        return self
+
+    @property
+    def removes(self):
+        """
+        True if the rule's actions remove matching messages from their
+        folder.
+        """
+        return any(action in ('move', 'delete')
+                   for action, folder, create in self.actions)
+
+    def applies_to(self, folder):
+        return self.folder is None or self.folder == folder
+
+    def search_criteria(self):
+        """
+        Returns the rule's criteria as IMAP SEARCH keys, or None if they
+        cannot be expressed as such (for a search string with non-ASCII
+        characters, which the server would compare against the encoded
+        header field rather than its decoded text).
+        """
+        keys = []
+        if self.header is not None:
+            if not (Quotable.match(self.header) and
+                    Quotable.match(self.contains)):
+                return None
+            keys.append("HEADER %s %s" % (_quote(self.header),
+                                          _quote(self.contains)))
+        if self.seen is not None:
+            keys.append("SEEN" if self.seen else "UNSEEN")
+        if self.flagged is not None:
+            keys.append("FLAGGED" if self.flagged else "UNFLAGGED")
+        return " ".join(keys)
+
+    def matches(self, headers, flags):
+        """
+        Evaluates the rule's criteria for a message whose decoded headers
+        (a dict mapping lower case header names to values) and flags (a list
+        of flag strings) have been downloaded.
+        """
+        if self.header is not None:
+            value = headers.get(self.header.lower(), "")
+            if self.contains.lower() not in value.lower():
+                return False
+        if self.seen is not None and self.seen != ('\\Seen' in flags):
+            return False
+        if self.flagged is not None and \
+           self.flagged != ('\\Flagged' in flags):
+            return False
+        return True
+
+    # ----------------------------------------------------------------
+
+    def _add_action(self, action, folder, create):
+        if self.removes:
+            raise ValueError("no action can follow a move or delete action")
+        self.actions.append((action, folder, create))
+
+
+def _quote(s):
+    return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"')
@@ -0,0 +1,112 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Scheduling of recurring jobs on a shared pool of worker threads.
+
+Every job is run again a fixed interval after its previous run finished,
+plus a random delay of up to the scheduler's jitter. The first runs are
+spread out over the jitter as well, so jobs added at the same time do not
+all start at once.
+"""
+
+import concurrent.futures
+import heapq
+import itertools
+import random
+import time
+
+from mailprocessing import signals
+
+# Upper bound for how long the scheduler waits before checking for
+# termination signals again.
+POLL_INTERVAL = 1
+
+
+class Scheduler(object):
+    """
+    Runs jobs on up to workers threads until a termination signal is
+    received. Exceptions (including SystemExit) raised by a job are passed to
+    the callable log_error along with the job and do not keep it from being
+    run again.
+    """
+
+    def __init__(self, workers, jitter=0, log_error=None):
+        self.workers = workers
+        self.jitter = jitter
+        self.log_error = log_error
+        self._queue = []
+        self._sequence = itertools.count()
+
+    def add(self, job, interval=None):
+        """
+        Adds the callable job, to be run every interval seconds, or only once
+        if interval is None.
+        """
+        self._schedule(job, interval, time.time())
+
+    def run(self):
+        """
+        Runs the jobs added until a termination signal is received or no job
+        is left to run. Returns once the jobs running at that point have
+        finished.
+        """
+        running = {}
+
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            while not signals.signal_event.is_set():
+                now = time.time()
+                while (self._queue and self._queue[0][0] <= now and
+                       len(running) < self.workers):
+                    _, _, job, interval = heapq.heappop(self._queue)
+                    running[pool.submit(self._run_job, job)] = (job, interval)
+
+                if not running and not self._queue:
+                    break
+
+                timeout = POLL_INTERVAL
+                if self._queue and len(running) < self.workers:
+                    timeout = min(timeout, max(0, self._queue[0][0] - now))
+                done, _ = concurrent.futures.wait(
+                    running, timeout=timeout,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    job, interval = running.pop(future)
+                    if interval is not None:
+                        self._schedule(job, interval, time.time() + interval)
+
+            # Leaving the with block waits for the jobs still running.
+
+    # ----------------------------------------------------------------
+
+    def _schedule(self, job, interval, due):
+        if self.jitter:
+            due += random.uniform(0, self.jitter)
+        heapq.heappush(self._queue, (due, next(self._sequence), job, interval))
+
+    def _run_job(self, job):
+        try:
+            job()
+        except SystemExit as e:
+            if e.code and self.log_error is not None:
+                self.log_error(job, e)
+        except Exception as e:
+            if self.log_error is not None:
+                self.log_error(job, e)
@@ -18,8 +18,9 @@
 # 02110-1301, USA.
 
 import fcntl
-import hashlib
+import locale
 import os
+import subprocess
 import sys
 import time
 
@@ -51,25 +52,90 @@ def batch_list(to_batch, batchsize=1000):
     Divide large lists. Returns a list of lists with batchsize or fewer items.
     """
 
-    cur = 0
     batches = []
 
-    while cur <= len(to_batch):
-        increment = min(len(to_batch) - (cur - 1), batchsize)
-        batches.append(to_batch[cur:cur + increment])
-        cur += increment
+    for cur in range(0, len(to_batch), batchsize):
+        batches.append(to_batch[cur:cur + batchsize])
 
     return batches
 
 
-def sha1sum(fp):
-    sha_obj = hashlib.sha1()
-    while True:
-        data = fp.read(4096)
-        if not data:
-            break
-        sha_obj.update(data)
-    return sha_obj.hexdigest()
+def expand_uid_set(uid_set):
+    """
+    Expands an IMAP sequence set such as "1:3,7" into a list of UIDs in
+    string form. Ranges with a `*` end point cannot be expanded without
+    knowing the mailbox' highest UID and are not supported.
+    """
+
+    uids = []
+
+    for part in uid_set.split(","):
+        if not part:
+            continue
+        if ":" in part:
+            start, end = sorted(int(n) for n in part.split(":"))
+            uids.extend(str(n) for n in range(start, end + 1))
+        else:
+            uids.append(str(int(part)))
+
+    return uids
+
+
+def compact_uid_set(uids):
+    """
+    Compresses a list of UIDs into an IMAP sequence set such as "1:3,7".
+    """
+
+    numbers = sorted(set(int(uid) for uid in uids))
+    ranges = []
+
+    for n in numbers:
+        if ranges and ranges[-1][1] == n - 1:
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+
+    return ",".join(str(start) if start == end else "%d:%d" % (start, end)
+                    for start, end in ranges)
+
+
+def read_header(path, limit):
+    """
+    Reads the header of the message in file path, that is, everything up to
+    and including the first empty line, but no more than limit bytes.
+    Returns the header as bytes and whether it was cut off at limit. The
+    body is not read, so the time taken does not depend on the size of the
+    message. Raises OSError if the file cannot be read.
+    """
+
+    try:
+        # Reading mail should not update its access time.
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_NOATIME', 0))
+    except PermissionError:
+        # O_NOATIME is only permitted for the file's owner.
+        fd = os.open(path, os.O_RDONLY)
+
+    with open(fd, "rb") as fp:
+        try:
+            # Keep the kernel from reading ahead into the body.
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_RANDOM)
+        except (AttributeError, OSError):
+            pass
+
+        lines = []
+        size = 0
+        while size < limit:
+            line = fp.readline(limit - size)
+            if not line:
+                break
+            lines.append(line)
+            size += len(line)
+            if line in (b"\n", b"\r\n"):
+                break
+        else:
+            return b"".join(lines), fp.peek(1) != b""
+
+    return b"".join(lines), False
 
 
 def write_pidfile(pidfile):
@@ -96,6 +162,16 @@ def write_pidfile(pidfile):
     pidfile.flush()
 
 
+def password_from_command(command):
+    """
+    Runs the shell command command and returns the password it prints on
+    its standard output. Raises subprocess.CalledProcessError if the command
+    fails and OSError if it cannot be run.
+    """
+    p = subprocess.check_output(command, shell=True)
+    return p.decode(locale.getpreferredencoding()).rstrip("\n")
+
+
 def safe_write(fp, s):
     line = s + "\n"
     try:
@@ -0,0 +1,654 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+In-process stand-in for an IMAP server, for testing IMAP clients.
+
+ImapServer implements the part of IMAP4rev1 imapproc uses (plus IDLE, MOVE,
+UIDPLUS and, if advertised, LIST-STATUS and COMPRESS=DEFLATE) on top of
+mailboxes held in memory. It listens on a local port and serves every
+connection in a thread of its own.
+"""
+
+import collections
+import queue
+import re
+import select
+import socket
+import socketserver
+import threading
+import zlib
+
+CAPABILITIES = ('IMAP4rev1', 'IDLE', 'MOVE', 'UIDPLUS')
+
+Atom = re.compile(r'[^ ()"{\[]+(\[[^\]]*\](<[^>]*>)?)?')
+Literal = re.compile(br'\{(?P<size>\d+)\}\r\n$')
+
+
+class Message(object):
+    def __init__(self, data, flags=()):
+        self.data = data
+        self.flags = set(flags)
+
+    @property
+    def header(self):
+        end = self.data.find(b'\r\n\r\n')
+        if end < 0:
+            return self.data
+        return self.data[:end + 4]
+
+    def header_fields(self, names):
+        """
+        Returns the header fields named in names (lower case), followed by
+        the empty line ending the header.
+        """
+        fields = re.split(br'\r\n(?![ \t])', self.header[:-4])
+        selected = [field for field in fields
+                    if field.split(b':', 1)[0].decode('ascii').lower()
+                    in names]
+        return b''.join(field + b'\r\n' for field in selected) + b'\r\n'
+
+
+class DeflateReader(object):
+    """
+    Decompresses what the client sends after COMPRESS DEFLATE (RFC 4978)
+    from the buffered socket file fileobj.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.buffer = b''
+
+    @property
+    def closed(self):
+        return self.fileobj.closed
+
+    def readline(self):
+        while b'\n' not in self.buffer and self.fill():
+            pass
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def read(self, size):
+        while len(self.buffer) < size and self.fill():
+            pass
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def fill(self):
+        data = self.fileobj.read1(65536)
+        if not data:
+            return False
+        self.buffer += self.decompressor.decompress(data)
+        return True
+
+    def close(self):
+        self.fileobj.close()
+
+
+class DeflateWriter(object):
+    """
+    Compresses what is sent to the client after COMPRESS DEFLATE, flushing
+    the compressor with every write.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    @property
+    def closed(self):
+        return self.fileobj.closed
+
+    def write(self, data):
+        self.fileobj.write(self.compressor.compress(data) +
+                           self.compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+
+class Mailbox(object):
+    def __init__(self, name, uidvalidity):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.messages = collections.OrderedDict()
+
+    def add(self, data, flags=()):
+        uid = self.uidnext
+        self.uidnext += 1
+        self.messages[uid] = Message(data, flags)
+        return uid
+
+    def sequence_number(self, uid):
+        return list(self.messages).index(uid) + 1
+
+
+class ImapServer(socketserver.ThreadingTCPServer):
+    """
+    An IMAP server for the users in the dict users, mapping user names to
+    passwords, advertising capabilities. Every command received is appended
+    to commands as a (command, arguments) tuple, with the arguments parsed.
+    The DONE ending IDLE is recorded as ('done', []).
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, users=None, capabilities=CAPABILITIES):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 ImapHandler)
+        self.users = users or {'user': 'secret'}
+        self.capabilities = tuple(capabilities)
+        self.lock = threading.RLock()
+        self.mailboxes = {}
+        self.commands = []
+        self.idling = []
+        self.connections = []
+        self.create_mailbox('INBOX')
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def drop_connections(self):
+        """
+        Closes all client connections without logging them out.
+        """
+        with self.lock:
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def create_mailbox(self, name):
+        with self.lock:
+            if name not in self.mailboxes:
+                self.mailboxes[name] = Mailbox(name,
+                                               1000 + len(self.mailboxes))
+            return self.mailboxes[name]
+
+    def add_message(self, mailbox, data, flags=()):
+        """
+        Delivers the message data (bytes) to mailbox, notifying clients
+        waiting in IDLE. Returns the message's UID.
+        """
+        with self.lock:
+            target = self.create_mailbox(mailbox)
+            uid = target.add(data, flags)
+            self.notify(mailbox, b'* %d EXISTS' % len(target.messages))
+        return uid
+
+    def expunge_message(self, mailbox, uid, vanished=False):
+        """
+        Removes the message with the UID uid from mailbox, the way another
+        client expunging it would, and notifies clients waiting in IDLE. If
+        vanished is True, they are told with VANISHED (as with QRESYNC
+        enabled) rather than EXPUNGE.
+        """
+        with self.lock:
+            mailbox = self.mailboxes[mailbox]
+            if vanished:
+                response = b'* VANISHED %d' % uid
+            else:
+                response = b'* %d EXPUNGE' % mailbox.sequence_number(uid)
+            del mailbox.messages[uid]
+            self.notify(mailbox.name, response)
+
+    def notify(self, mailbox, response):
+        """
+        Sends the untagged response to the clients idling in mailbox.
+        """
+        with self.lock:
+            for handler in self.idling:
+                if handler.selected == mailbox:
+                    handler.events.put(response)
+
+
+class ImapHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.selected = None
+        self.events = queue.Queue()
+        with self.server.lock:
+            self.server.connections.append(self.connection)
+
+    def handle(self):
+        self.send(b'* OK stand-in IMAP server ready')
+        while True:
+            try:
+                command = self.read_command()
+            except (ConnectionError, ValueError):
+                return
+            if command is None:
+                return
+            tag, name, args = command
+            with self.server.lock:
+                self.server.commands.append((name, args))
+            method = getattr(self, 'do_' + name, None)
+            if method is None:
+                self.send(tag + b' BAD unknown command')
+                continue
+            try:
+                if method(tag, args) is False:
+                    return
+            except (IndexError, KeyError, ValueError) as e:
+                self.send(tag + b' BAD ' + str(e).encode('ascii', 'replace'))
+
+    def send(self, line):
+        self.wfile.write(line + b'\r\n')
+        self.wfile.flush()
+
+    def read_command(self):
+        """
+        Reads a command including its literals. Returns its tag (bytes), its
+        name (lower case) and its parsed arguments.
+        """
+        segments = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return None
+            m = Literal.search(line)
+            if m is None:
+                segments.append(line.rstrip(b'\r\n').decode('utf-8'))
+                break
+            segments.append(line[:m.start()].decode('utf-8') + '{}')
+            self.send(b'+ Ready for literal data')
+            segments.append(self.rfile.read(int(m.group('size'))))
+        tokens = parse_arguments(segments)
+        if len(tokens) < 2:
+            return b'*', 'bad', []
+        return tokens[0].encode('ascii'), tokens[1].lower(), tokens[2:]
+
+    # ----------------------------------------------------------------
+    # Commands
+
+    def do_capability(self, tag, args):
+        self.send(b'* CAPABILITY ' +
+                  ' '.join(self.server.capabilities).encode('ascii'))
+        self.send(tag + b' OK CAPABILITY completed')
+
+    def do_login(self, tag, args):
+        user, password = args
+        if self.server.users.get(user) != password:
+            self.send(tag + b' NO [AUTHENTICATIONFAILED] invalid credentials')
+        else:
+            self.send(tag + b' OK LOGIN completed')
+
+    def do_logout(self, tag, args):
+        self.send(b'* BYE logging out')
+        self.send(tag + b' OK LOGOUT completed')
+        return False
+
+    def do_compress(self, tag, args):
+        if 'COMPRESS=DEFLATE' not in self.server.capabilities or \
+           args[0].upper() != 'DEFLATE':
+            self.send(tag + b' BAD unsupported compression')
+            return
+        if isinstance(self.wfile, DeflateWriter):
+            self.send(tag + b' NO [COMPRESSIONACTIVE] already compressing')
+            return
+        self.send(tag + b' OK DEFLATE active')
+        self.rfile = DeflateReader(self.rfile)
+        self.wfile = DeflateWriter(self.wfile)
+
+    def do_noop(self, tag, args):
+        self.report_events()
+        self.send(tag + b' OK NOOP completed')
+
+    def do_list(self, tag, args):
+        reference, pattern = args[:2]
+        status = None
+        if args[2:]:
+            # LIST-STATUS (RFC 5819): RETURN (STATUS (items))
+            if 'LIST-STATUS' not in self.server.capabilities or \
+               args[2].upper() != 'RETURN' or args[3][0].upper() != 'STATUS':
+                self.send(tag + b' BAD unsupported LIST options')
+                return
+            status = args[3][1]
+        regex = re.escape(pattern).replace(r'\*', '.*').replace('%', '[^.]*')
+        for name in sorted(self.server.mailboxes):
+            if re.match(regex + '$', name):
+                self.send(('* LIST () "." %s' % quote(name)).encode('utf-8'))
+                if status is not None:
+                    self.send_status(name, status)
+        self.send(tag + b' OK LIST completed')
+
+    def do_create(self, tag, args):
+        if args[0] in self.server.mailboxes:
+            self.send(tag + b' NO mailbox exists')
+            return
+        self.server.create_mailbox(args[0])
+        self.send(tag + b' OK CREATE completed')
+
+    def do_subscribe(self, tag, args):
+        self.send(tag + b' OK SUBSCRIBE completed')
+
+    def do_status(self, tag, args):
+        if args[0] not in self.server.mailboxes:
+            self.send(tag + b' NO no such mailbox')
+            return
+        self.send_status(args[0], args[1])
+        self.send(tag + b' OK STATUS completed')
+
+    def do_select(self, tag, args, access=b'READ-WRITE'):
+        mailbox = self.server.mailboxes.get(args[0])
+        if mailbox is None:
+            self.selected = None
+            self.send(tag + b' NO no such mailbox')
+            return
+        self.selected = mailbox.name
+        self.send(b'* %d EXISTS' % len(mailbox.messages))
+        self.send(b'* 0 RECENT')
+        self.send(b'* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)')
+        self.send(b'* OK [UIDVALIDITY %d] UIDs valid' % mailbox.uidvalidity)
+        self.send(b'* OK [UIDNEXT %d] predicted next UID' % mailbox.uidnext)
+        self.send(tag + b' OK [' + access + b'] SELECT completed')
+
+    def do_examine(self, tag, args):
+        self.do_select(tag, args, access=b'READ-ONLY')
+
+    def do_close(self, tag, args):
+        with self.server.lock:
+            self.expunge(report=False)
+        self.selected = None
+        self.send(tag + b' OK CLOSE completed')
+
+    def do_expunge(self, tag, args):
+        with self.server.lock:
+            self.expunge()
+        self.send(tag + b' OK EXPUNGE completed')
+
+    def do_idle(self, tag, args):
+        with self.server.lock:
+            self.server.idling.append(self)
+        try:
+            self.send(b'+ idling')
+            while True:
+                self.report_events()
+                readable, _, _ = select.select([self.connection], [], [],
+                                               0.05)
+                if readable:
+                    line = self.rfile.readline()
+                    if not line:
+                        break
+                    if line.strip().upper() == b'DONE':
+                        with self.server.lock:
+                            self.server.commands.append(('done', []))
+                        break
+        finally:
+            with self.server.lock:
+                self.server.idling.remove(self)
+        self.send(tag + b' OK IDLE terminated')
+
+    def do_uid(self, tag, args):
+        if self.selected is None:
+            self.send(tag + b' BAD no mailbox selected')
+            return
+        command = args[0].lower()
+        with self.server.lock:
+            mailbox = self.server.mailboxes[self.selected]
+            method = getattr(self, 'uid_' + command, None)
+            if method is None:
+                self.send(tag + b' BAD unknown UID command')
+                return
+            method(tag, mailbox, args[1:])
+
+    # ----------------------------------------------------------------
+    # UID commands
+
+    def uid_search(self, tag, mailbox, args):
+        uids = [uid for uid, message in mailbox.messages.items()
+                if search_matches(mailbox, uid, message, args)]
+        self.send(b' '.join([b'* SEARCH'] +
+                            [str(uid).encode('ascii') for uid in uids]))
+        self.send(tag + b' OK SEARCH completed')
+
+    def uid_fetch(self, tag, mailbox, args):
+        items = args[1] if isinstance(args[1], list) else [args[1]]
+        for uid in uid_set(args[0], mailbox.messages):
+            self.send_fetch(mailbox, uid, items)
+        self.send(tag + b' OK FETCH completed')
+
+    def uid_store(self, tag, mailbox, args):
+        spec, operation, flags = args
+        if not isinstance(flags, list):
+            flags = [flags]
+        for uid in uid_set(spec, mailbox.messages):
+            message = mailbox.messages[uid]
+            if operation.upper().startswith('+'):
+                message.flags.update(flags)
+            elif operation.upper().startswith('-'):
+                message.flags.difference_update(flags)
+            else:
+                message.flags = set(flags)
+            if not operation.upper().endswith('.SILENT'):
+                self.send_fetch(mailbox, uid, ['FLAGS'])
+        self.send(tag + b' OK STORE completed')
+
+    def uid_copy(self, tag, mailbox, args, move=False):
+        spec, target = args
+        if target not in self.server.mailboxes:
+            self.send(tag + b' NO [TRYCREATE] no such mailbox')
+            return
+        target = self.server.mailboxes[target]
+        uids = uid_set(spec, mailbox.messages)
+        new_uids = [target.add(mailbox.messages[uid].data,
+                               mailbox.messages[uid].flags)
+                    for uid in uids]
+        if move:
+            for uid in uids:
+                self.send(b'* %d EXPUNGE' % mailbox.sequence_number(uid))
+                del mailbox.messages[uid]
+        code = 'COPYUID %d %s %s' % (target.uidvalidity,
+                                     ",".join(map(str, uids)),
+                                     ",".join(map(str, new_uids)))
+        self.send(tag + b' OK [' + code.encode('ascii') + b'] completed')
+
+    def uid_move(self, tag, mailbox, args):
+        if 'MOVE' not in self.server.capabilities:
+            self.send(tag + b' BAD MOVE not supported')
+            return
+        self.uid_copy(tag, mailbox, args, move=True)
+
+    def uid_expunge(self, tag, mailbox, args):
+        if 'UIDPLUS' not in self.server.capabilities:
+            self.send(tag + b' BAD UIDPLUS not supported')
+            return
+        self.expunge(uid_set(args[0], mailbox.messages))
+        self.send(tag + b' OK EXPUNGE completed')
+
+    # ----------------------------------------------------------------
+
+    def send_fetch(self, mailbox, uid, items):
+        message = mailbox.messages[uid]
+        response = b'* %d FETCH (UID %d' % (mailbox.sequence_number(uid), uid)
+        for item in items:
+            name = item.upper()
+            if name == 'UID':
+                continue
+            if name == 'FLAGS':
+                response += (' FLAGS (%s)' % " ".join(sorted(message.flags))
+                             ).encode('ascii')
+                continue
+            if name == 'RFC822.SIZE':
+                response += b' RFC822.SIZE %d' % len(message.data)
+                continue
+            m = re.match(r'BODY(\.PEEK)?\[(?P<section>[^\]]*)\]$', name)
+            if m is None:
+                raise ValueError("unsupported FETCH item %s" % item)
+            section = m.group('section')
+            if section == '':
+                data = message.data
+                if m.group(1) is None:
+                    message.flags.add('\\Seen')
+            elif section == 'HEADER':
+                data = message.header
+            elif section.startswith('HEADER.FIELDS'):
+                names = re.search(r'\((.*)\)', section).group(1)
+                data = message.header_fields(names.lower().split())
+            else:
+                raise ValueError("unsupported section %s" % section)
+            # Send the literal on the line it is announced on, the way the
+            # client has to deal with it.
+            self.send(response + b' BODY[%s] {%d}' %
+                      (section.encode('ascii'), len(data)))
+            self.wfile.write(data)
+            response = b''
+        self.send(response + b')')
+
+    def send_status(self, name, items):
+        mailbox = self.server.mailboxes[name]
+        values = {'MESSAGES': len(mailbox.messages),
+                  'UIDNEXT': mailbox.uidnext,
+                  'UIDVALIDITY': mailbox.uidvalidity}
+        items = " ".join("%s %d" % (item.upper(), values[item.upper()])
+                         for item in items)
+        self.send(('* STATUS %s (%s)' % (quote(name), items))
+                  .encode('utf-8'))
+
+    def expunge(self, uids=None, report=True):
+        mailbox = self.server.mailboxes[self.selected]
+        for uid in list(mailbox.messages):
+            if uids is not None and uid not in uids:
+                continue
+            if '\\Deleted' in mailbox.messages[uid].flags:
+                if report:
+                    self.send(b'* %d EXPUNGE' % mailbox.sequence_number(uid))
+                del mailbox.messages[uid]
+
+    def report_events(self):
+        while True:
+            try:
+                response = self.events.get_nowait()
+            except queue.Empty:
+                return
+            self.send(response)
+
+
+def parse_arguments(segments):
+    """
+    Parses a command into a list of tokens. segments alternate between text
+    and the literals announced at its end. Atoms and strings become str,
+    parenthesized lists become lists.
+    """
+    tokens = []
+    stack = [tokens]
+    for segment in segments:
+        if isinstance(segment, bytes):
+            stack[-1].append(segment.decode('utf-8'))
+            continue
+        pos = 0
+        while pos < len(segment):
+            c = segment[pos]
+            if c == ' ':
+                pos += 1
+            elif c == '(':
+                stack[-1].append([])
+                stack.append(stack[-1][-1])
+                pos += 1
+            elif c == ')':
+                stack.pop()
+                pos += 1
+            elif c == '"':
+                pos += 1
+                value = ''
+                while segment[pos] != '"':
+                    if segment[pos] == '\\':
+                        pos += 1
+                    value += segment[pos]
+                    pos += 1
+                stack[-1].append(value)
+                pos += 1
+            elif segment.startswith('{}', pos):
+                # The literal follows as the next segment.
+                pos += 2
+            else:
+                m = Atom.match(segment, pos)
+                stack[-1].append(m.group(0))
+                pos = m.end()
+    return tokens
+
+
+def uid_set(spec, messages):
+    """
+    Returns the UIDs of the messages in messages the UID set spec refers to.
+    """
+    last = max(messages) if messages else 0
+    uids = set()
+    for part in spec.split(','):
+        first, _, end = part.partition(':')
+        first = last if first == '*' else int(first)
+        if not end:
+            end = first
+        end = last if end == '*' else int(end)
+        low, high = min(first, end), max(first, end)
+        uids.update(uid for uid in messages if low <= uid <= high)
+    return sorted(uids)
+
+
+def search_matches(mailbox, uid, message, keys):
+    i = 0
+    while i < len(keys):
+        key = keys[i].upper()
+        if key == 'ALL':
+            pass
+        elif key in ('SEEN', 'FLAGGED', 'DELETED'):
+            if '\\' + key.capitalize() not in message.flags:
+                return False
+        elif key in ('UNSEEN', 'UNFLAGGED', 'UNDELETED'):
+            if '\\' + key[2:].capitalize() in message.flags:
+                return False
+        elif key == 'UID':
+            i += 1
+            if uid not in uid_set(keys[i], mailbox.messages):
+                return False
+        elif key == 'HEADER':
+            name, value = keys[i + 1].lower(), keys[i + 2].lower()
+            i += 2
+            fields = message.header_fields([name]).decode('utf-8', 'replace')
+            if value not in fields.lower():
+                return False
+        else:
+            raise ValueError("unsupported search key %s" % key)
+        i += 1
+    return True
+
+
+def quote(name):
+    return '"%s"' % name.replace('\\', '\\\\').replace('"', '\\"')
@@ -0,0 +1,238 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+In-process stand-in for an SMTP or LMTP server, for testing delivery.
+
+SmtpServer listens on a local TCP port, UnixSmtpServer on a UNIX socket.
+Both serve every connection in a thread of its own and keep the messages
+they receive in memory.
+
+With PIPELINING (RFC 2920), replies to MAIL and RCPT are held back until a
+command ending the group (such as DATA) arrives, as a server may do.
+A client waiting for each reply before sending the next command therefore
+hangs rather than passing by accident.
+"""
+
+import re
+import socket
+import socketserver
+import threading
+
+Address = re.compile(r'(?i)(?:FROM|TO):\s*<(?P<address>[^>]*)>')
+
+
+class _SmtpServer(object):
+    """
+    State shared by the SMTP servers. The server speaks LMTP if lmtp is
+    True, and advertises PIPELINING if pipelining is True. Senders and
+    recipients in refuse are refused at MAIL or RCPT; with LMTP, delivery to
+    the recipients in fail fails after the message data has been sent.
+
+    Every command received is appended to commands as a (command, arguments)
+    tuple, and every message delivered to messages as a (sender,
+    recipients, data) tuple, data being the message with its dot-stuffing
+    undone.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def _setup(self, lmtp, pipelining, refuse, fail):
+        self.lmtp = lmtp
+        self.pipelining = pipelining
+        self.refuse = set(refuse)
+        self.fail = set(fail)
+        self.lock = threading.Lock()
+        self.commands = []
+        self.messages = []
+        self.connections = []
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def drop_connections(self):
+        """
+        Closes all client connections without saying goodbye.
+        """
+        with self.lock:
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+class SmtpServer(_SmtpServer, socketserver.ThreadingTCPServer):
+    def __init__(self, lmtp=False, pipelining=True, refuse=(), fail=()):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 SmtpHandler)
+        self._setup(lmtp, pipelining, refuse, fail)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class UnixSmtpServer(_SmtpServer, socketserver.ThreadingUnixStreamServer):
+    def __init__(self, path, lmtp=False, pipelining=True, refuse=(),
+                 fail=()):
+        socketserver.ThreadingUnixStreamServer.__init__(self, path,
+                                                        SmtpHandler)
+        self._setup(lmtp, pipelining, refuse, fail)
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        with self.server.lock:
+            self.server.connections.append(self.request)
+        self.held = []
+        self.reset()
+        self.reply(220, "localhost ready")
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, _, args = line.rstrip(b'\r\n').decode(
+                'ascii').partition(' ')
+            command = command.lower()
+            with self.server.lock:
+                self.server.commands.append((command, args))
+            method = getattr(self, 'do_' + command, None)
+            if method is None:
+                self.reply(500, "unknown command")
+            elif method(args) is False:
+                return
+
+    def reset(self):
+        self.sender = None
+        self.recipients = []
+
+    def reply(self, code, *lines, held=False):
+        """
+        Sends the reply code with the text lines. Held replies are sent
+        along with the next reply that is not held.
+        """
+        lines = lines or ("OK",)
+        self.held.extend(b"%d%s%s\r\n" % (code, b'-' if i < len(lines) - 1
+                                          else b' ', line.encode('ascii'))
+                         for i, line in enumerate(lines))
+        if not (held and self.server.pipelining):
+            self.wfile.write(b''.join(self.held))
+            self.held = []
+
+    def do_ehlo(self, args):
+        if self.server.lmtp:
+            self.reply(500, "this is an LMTP server")
+            return
+        self.greet()
+
+    def do_helo(self, args):
+        if self.server.lmtp:
+            self.reply(500, "this is an LMTP server")
+            return
+        self.reset()
+        self.reply(250, "localhost")
+
+    def do_lhlo(self, args):
+        if not self.server.lmtp:
+            self.reply(500, "this is an SMTP server")
+            return
+        self.greet()
+
+    def greet(self):
+        self.reset()
+        lines = ["localhost"]
+        if self.server.pipelining:
+            lines.append("PIPELINING")
+        lines.append("8BITMIME")
+        self.reply(250, *lines)
+
+    def do_mail(self, args):
+        m = Address.match(args)
+        if m is None:
+            self.reply(501, "syntax error", held=True)
+        elif self.sender is not None:
+            self.reply(503, "nested MAIL command", held=True)
+        elif m.group('address') in self.server.refuse:
+            self.reply(550, "sender refused", held=True)
+        else:
+            self.sender = m.group('address')
+            self.reply(250, held=True)
+
+    def do_rcpt(self, args):
+        m = Address.match(args)
+        if m is None:
+            self.reply(501, "syntax error", held=True)
+        elif self.sender is None:
+            self.reply(503, "need MAIL first", held=True)
+        elif m.group('address') in self.server.refuse:
+            self.reply(550, "recipient refused", held=True)
+        else:
+            self.recipients.append(m.group('address'))
+            self.reply(250, held=True)
+
+    def do_data(self, args):
+        if not self.recipients:
+            self.reply(554, "no valid recipients")
+            return
+        self.reply(354, "end data with <CR><LF>.<CR><LF>")
+
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return False
+            if line == b'.\r\n':
+                break
+            if line.startswith(b'.'):
+                line = line[1:]
+            lines.append(line)
+
+        with self.server.lock:
+            self.server.messages.append((self.sender, self.recipients,
+                                         b''.join(lines)))
+
+        if self.server.lmtp:
+            for recipient in self.recipients:
+                if recipient in self.server.fail:
+                    self.reply(550, "delivery to %s failed" % recipient)
+                else:
+                    self.reply(250, "delivered to %s" % recipient)
+        else:
+            self.reply(250, "queued")
+        self.reset()
+
+    def do_rset(self, args):
+        self.reset()
+        self.reply(250)
+
+    def do_noop(self, args):
+        self.reply(250)
+
+    def do_quit(self, args):
+        self.reply(221, "bye")
+        return False
@@ -0,0 +1,238 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import io
+import os
+import tempfile
+import textwrap
+import unittest
+
+from mailprocessing import accounts
+
+DEFAULTS = {'interval': 300, 'port': 993, 'use_ssl': True,
+            'folders': ['INBOX']}
+
+
+class AccountsTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.log = io.StringIO()
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(textwrap.dedent(text))
+        return path
+
+    def read_accounts(self, text, **kwargs):
+        return accounts.read_accounts(self.write('accounts', text), DEFAULTS,
+                                      {'log_level': 1}, self.log, **kwargs)
+
+
+class ReadAccountsTest(AccountsTest):
+
+    def test_accounts(self):
+        alice, bob = self.read_accounts("""\
+            [alice]
+            host = imap.example.com
+            user = alice
+            password = secret
+            rcfile = /etc/rc.py
+            folders =
+                INBOX
+                Sent Items
+
+            [bob]
+            host = imap.example.org
+            port = 143
+            use_ssl = no
+            user = bob
+            password_command = pass bob
+            rcfile = /etc/rc.py
+            interval = 60
+            """, cache_directory=self.directory)
+
+        self.assertEqual(alice.name, 'alice')
+        self.assertEqual(alice.rcfile, '/etc/rc.py')
+        self.assertEqual(alice.interval, 300)
+        self.assertIsNone(alice.password_command)
+        self.assertEqual(alice.processor_kwargs, {
+            'log_level': 1, 'host': 'imap.example.com', 'port': 993,
+            'use_ssl': True, 'user': 'alice', 'password': 'secret',
+            'folders': ['INBOX', 'Sent Items'], 'interval': 300,
+            'cache_file': os.path.join(self.directory, 'alice.cache'),
+            'log_prefix': '[alice] ', 'scheduled': True})
+
+        self.assertEqual(bob.interval, 60)
+        self.assertEqual(bob.password_command, 'pass bob')
+        self.assertNotIn('password', bob.processor_kwargs)
+        self.assertEqual(bob.processor_kwargs['port'], 143)
+        self.assertFalse(bob.processor_kwargs['use_ssl'])
+        self.assertEqual(bob.processor_kwargs['folders'], ['INBOX'])
+
+    def assertInvalid(self, text, message):
+        with self.assertRaises(ValueError) as cm:
+            self.read_accounts(text)
+        self.assertIn(message, str(cm.exception))
+
+    def test_missing_host(self):
+        self.assertInvalid("""\
+            [alice]
+            user = alice
+            password = secret
+            rcfile = /etc/rc.py
+            """, "Account alice: no host given")
+
+    def test_password_and_password_command(self):
+        self.assertInvalid("""\
+            [alice]
+            host = imap.example.com
+            user = alice
+            password = secret
+            password_command = pass alice
+            rcfile = /etc/rc.py
+            """, "Account alice: please specify either password or "
+            "password_command")
+        self.assertInvalid("""\
+            [alice]
+            host = imap.example.com
+            user = alice
+            rcfile = /etc/rc.py
+            """, "Account alice: please specify either password or "
+            "password_command")
+
+    def test_unknown_key(self):
+        self.assertInvalid("""\
+            [alice]
+            host = imap.example.com
+            user = alice
+            password = secret
+            rcfile = /etc/rc.py
+            pasword = typo
+            """, "Account alice: unknown setting pasword")
+
+    def test_invalid_values(self):
+        self.assertInvalid("""\
+            [alice]
+            host = imap.example.com
+            port = imaps
+            user = alice
+            password = secret
+            rcfile = /etc/rc.py
+            """, "Account alice: invalid literal")
+        self.assertInvalid("""\
+            [alice]
+            host = imap.example.com
+            user = alice
+            password = secret
+            rcfile = -
+            """, "Account alice: the rc file cannot be read from standard "
+            "input")
+
+    def test_invalid_file(self):
+        self.assertInvalid("", "No accounts in accounts file")
+        self.assertInvalid("host = imap.example.com\n",
+                           "Could not read accounts file")
+        with self.assertRaises(ValueError):
+            accounts.read_accounts(os.path.join(self.directory, 'missing'),
+                                   DEFAULTS, {}, self.log)
+
+
+class CompileRcfileTest(AccountsTest):
+
+    def setUp(self):
+        super(CompileRcfileTest, self).setUp()
+        self.path = self.write('rc.py', "result = 1\n")
+        self.addCleanup(accounts._rcfiles.pop, self.path, None)
+
+    def run_rcfile(self):
+        namespace = {}
+        exec(accounts.compile_rcfile(self.path), namespace)
+        return namespace['result']
+
+    def test_cached(self):
+        code = accounts.compile_rcfile(self.path)
+        self.assertIs(accounts.compile_rcfile(self.path), code)
+        self.assertEqual(self.run_rcfile(), 1)
+
+    def test_recompiled_when_modified(self):
+        code = accounts.compile_rcfile(self.path)
+        self.write('rc.py', "result = 2\n")
+        os.utime(self.path, (0, os.path.getmtime(self.path) + 1))
+        self.assertIsNot(accounts.compile_rcfile(self.path), code)
+        self.assertEqual(self.run_rcfile(), 2)
+
+    def test_missing_file(self):
+        os.unlink(self.path)
+        with self.assertRaises(IOError):
+            accounts.compile_rcfile(self.path)
+
+
+class SharedLogTest(AccountsTest):
+
+    def setUp(self):
+        super(SharedLogTest, self).setUp()
+        self.path = os.path.join(self.directory, 'log')
+        self.shared_log = accounts.SharedLog(self.path)
+        self.addCleanup(lambda: self.shared_log.fp.close())
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_reopen_unchanged(self):
+        self.shared_log.write("one\n")
+        fp = self.shared_log.fp
+        self.shared_log.reopen()
+        self.assertIs(self.shared_log.fp, fp)
+        self.shared_log.write("two\n")
+        self.shared_log.flush()
+        self.assertEqual(self.read(self.path), "one\ntwo\n")
+
+    def test_reopen_rotated(self):
+        self.shared_log.write("one\n")
+        self.shared_log.flush()
+        rotated = self.path + '.1'
+        os.rename(self.path, rotated)
+        self.shared_log.reopen()
+        self.shared_log.write("two\n")
+        self.shared_log.flush()
+        self.assertEqual(self.read(rotated), "one\n")
+        self.assertEqual(self.read(self.path), "two\n")
+
+        # Only the first of several processors seeing SIGHUP reopens it.
+        fp = self.shared_log.fp
+        self.shared_log.reopen()
+        self.assertIs(self.shared_log.fp, fp)
+
+    def test_reopen_replaced(self):
+        os.rename(self.path, self.path + '.1')
+        with open(self.path, 'w') as f:
+            f.write("new\n")
+        self.shared_log.reopen()
+        self.shared_log.write("appended\n")
+        self.shared_log.flush()
+        self.assertEqual(self.read(self.path), "new\nappended\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
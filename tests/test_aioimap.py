@@ -0,0 +1,241 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import threading
+import time
+import unittest
+
+from mailprocessing import fetch
+from mailprocessing.aioimap import ImapClient
+
+from imapserver import ImapServer
+
+MESSAGE = (b"From: alice@example.com\r\n"
+           b"To: bob@example.com\r\n"
+           b"Subject: message %d\r\n"
+           b"\r\n"
+           b"Body of message %d.\r\n")
+
+
+def message(n):
+    return MESSAGE % (n, n)
+
+
+class ImapClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ImapServer(users={'user': 'secret',
+                                        'john "jd" doe': 'pa\\ss word'})
+        self.server.start()
+        for n in range(1, 4):
+            self.server.add_message('INBOX', message(n))
+        self.server.add_message('INBOX', message(4), flags=['\\Seen'])
+        self.server.create_mailbox('Archive')
+        self.client = ImapClient(host='127.0.0.1', port=self.server.port)
+
+    def tearDown(self):
+        self.client.logout()
+        self.server.stop()
+
+    def login(self):
+        typ, data = self.client.login('user', 'secret')
+        self.assertEqual(typ, 'OK')
+
+    def select(self, mailbox='INBOX'):
+        self.login()
+        typ, data = self.client.select(mailbox)
+        self.assertEqual(typ, 'OK')
+        return data
+
+    def test_greeting_and_capabilities(self):
+        self.assertIn('IDLE', self.client.capabilities)
+        self.assertEqual(self.client.state, 'NONAUTH')
+
+    def test_login(self):
+        self.login()
+        self.assertEqual(self.client.state, 'AUTH')
+        self.assertIn(('login', ['user', 'secret']), self.server.commands)
+
+    def test_login_quotes_user_and_password(self):
+        typ, data = self.client.login('john "jd" doe', 'pa\\ss word')
+        self.assertEqual(typ, 'OK')
+        self.assertIn(('login', ['john "jd" doe', 'pa\\ss word']),
+                      self.server.commands)
+
+    def test_login_failure(self):
+        with self.assertRaises(ImapClient.error):
+            self.client.login('user', 'wrong')
+        self.assertEqual(self.client.state, 'NONAUTH')
+
+    def test_list(self):
+        self.login()
+        typ, data = self.client.list('""', '*')
+        self.assertEqual(typ, 'OK')
+        self.assertEqual(data, [b'() "." "Archive"', b'() "." "INBOX"'])
+
+    def test_select(self):
+        self.assertEqual(self.select(), [b'4'])
+        self.assertEqual(self.client.state, 'SELECTED')
+        self.assertEqual(self.client.response('UIDVALIDITY'),
+                         ('UIDVALIDITY', [b'1000']))
+
+    def test_select_missing_mailbox(self):
+        self.login()
+        typ, data = self.client.select('Missing')
+        self.assertEqual(typ, 'NO')
+        self.assertEqual(self.client.state, 'AUTH')
+
+    def test_examine(self):
+        self.login()
+        typ, data = self.client.select('INBOX', readonly=True)
+        self.assertEqual((typ, data), ('OK', [b'4']))
+        self.assertEqual(self.server.commands[-1], ('examine', ['INBOX']))
+
+    def test_uid_search(self):
+        self.select()
+        self.assertEqual(self.client.uid('search', None, 'ALL'),
+                         ('OK', [b'1 2 3 4']))
+        self.assertEqual(self.client.uid('search', None, 'UNSEEN'),
+                         ('OK', [b'1 2 3']))
+        self.assertEqual(
+            self.client.uid('search', None, 'UID 2:* HEADER Subject "3"'),
+            ('OK', [b'3']))
+
+    def test_uid_fetch_literals(self):
+        self.select()
+        typ, data = self.client.uid('fetch', '2:3', '(FLAGS BODY.PEEK[])')
+        self.assertEqual(typ, 'OK')
+        # Each response with a literal is a (line, literal) tuple followed by
+        # the rest of the response.
+        self.assertEqual(len(data), 4)
+        for n, (line, literal) in zip((2, 3), data[::2]):
+            self.assertTrue(line.endswith(b'BODY[] {%d}' % len(message(n))))
+            self.assertEqual(literal, message(n))
+        self.assertEqual(data[1::2], [b')', b')'])
+
+    def test_uid_fetch_header_fields(self):
+        self.select()
+        typ, data = self.client.uid(
+            'fetch', '1', '(BODY.PEEK[HEADER.FIELDS (SUBJECT)])')
+        self.assertEqual(typ, 'OK')
+        self.assertEqual(data[0][1], b'Subject: message 1\r\n\r\n')
+
+    def test_uid_fetch_body_sink(self):
+        self.select()
+        chunks = []
+        responses = self.client.uid_fetch_body('4', chunks.append)
+        self.assertEqual(b''.join(chunks), message(4))
+        self.assertEqual(fetch.parse_fetch(responses[0])['UID'], b'4')
+
+    def test_uid_fetch_stream(self):
+        self.select()
+        uids = [fetch.parse_fetch(parts)['UID'] for parts in
+                self.client.uid_fetch_stream(
+                    [('1:2', 'FLAGS'), ('3', 'FLAGS'), ('4', 'FLAGS')], 2)]
+        self.assertEqual(uids, [b'1', b'2', b'3', b'4'])
+
+    def test_uid_store(self):
+        self.select()
+        typ, data = self.client.uid('store', '1', '+FLAGS', '(\\Flagged)')
+        self.assertEqual(typ, 'OK')
+        self.assertIn(b'FLAGS (\\Flagged)', data[0])
+        self.assertEqual(self.client.uid('search', None, 'FLAGGED'),
+                         ('OK', [b'1']))
+
+    def test_uid_copy_and_move(self):
+        self.select()
+        self.assertEqual(self.client.uid('copy', '1', 'Archive')[0], 'OK')
+        self.assertEqual(self.client.uid('move', '2:3', 'Archive')[0], 'OK')
+        self.assertEqual(self.client.response('EXPUNGE'),
+                         ('EXPUNGE', [b'2', b'2']))
+        self.assertEqual(list(self.server.mailboxes['Archive'].messages),
+                         [1, 2, 3])
+        self.assertEqual(list(self.server.mailboxes['INBOX'].messages),
+                         [1, 4])
+
+    def test_uid_copy_missing_mailbox(self):
+        self.select()
+        typ, data = self.client.uid('copy', '1', 'Missing')
+        self.assertEqual(typ, 'NO')
+        self.assertIn(b'TRYCREATE', data[0])
+
+    def test_expunge(self):
+        self.select()
+        self.client.uid('store', '1,3', '+FLAGS.SILENT', '(\\Deleted)')
+        self.assertEqual(self.client.expunge(), ('OK', [b'1', b'2']))
+        self.assertEqual(self.client.uid('search', None, 'ALL'),
+                         ('OK', [b'2 4']))
+
+    def test_pipelined_commands(self):
+        self.select()
+        responses = list(self.client.uid_pipelined(
+            'search', [(None, 'UID %d' % uid) for uid in range(1, 5)], 3))
+        self.assertEqual(responses, [('OK', [b'1']), ('OK', [b'2']),
+                                     ('OK', [b'3']), ('OK', [b'4'])])
+
+    def test_commands_from_several_threads(self):
+        self.select()
+        results = []
+
+        def search():
+            results.append(self.client.uid('search', None, 'ALL')[0])
+
+        threads = [threading.Thread(target=search) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['OK'] * 5)
+
+    def test_idle_reports_new_message(self):
+        self.select()
+        timer = threading.Timer(0.2, self.server.add_message,
+                                ('INBOX', message(5)))
+        timer.start()
+        start = time.time()
+        self.assertTrue(self.client.idle(10))
+        self.assertLess(time.time() - start, 5)
+        timer.join()
+        # The session is usable again after IDLE.
+        self.assertEqual(self.client.noop()[0], 'OK')
+
+    def test_idle_timeout(self):
+        self.select()
+        self.assertFalse(self.client.idle(0.3))
+
+    def test_idle_interrupted(self):
+        self.select()
+        start = time.time()
+        self.assertFalse(self.client.idle(10, lambda: True))
+        self.assertLess(time.time() - start, 5)
+
+    def test_logout(self):
+        self.login()
+        self.assertEqual(self.client.logout()[0], 'BYE')
+        self.assertEqual(self.client.state, 'LOGOUT')
+
+    def test_dropped_connection(self):
+        self.login()
+        self.server.drop_connections()
+        with self.assertRaises(ImapClient.abort):
+            self.client.noop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import json
+import os
+import tempfile
+import unittest
+
+from mailprocessing import cache
+
+
+def header_cache():
+    return {
+        'INBOX': {
+            'uidvalidity': '7',
+            'highestmodseq': 12,
+            'header_fields': ['subject'],
+            'watermark': 2,
+            'status': ['2', '3', '7'],
+            'uids': {
+                '1': {'flags': ['\\Seen'], 'headers': {'subject': 'one'}},
+                '2': {'flags': [], 'headers': {'subject': 'two'}},
+                },
+            },
+        }
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'cache')
+
+    def open_sqlite(self, host='imap.example.com', user='alice'):
+        store = cache.SqliteCache(self.path, host, user)
+        self.addCleanup(store.close)
+        return store
+
+    def plain(self, loaded):
+        """
+        Returns loaded with its SqliteUidMaps turned into dicts.
+        """
+        return {folder: dict(entry, uids={
+            uid: {'flags': message['flags'],
+                  'headers': dict(message['headers'])}
+            for uid, message in entry['uids'].items()})
+                for folder, entry in loaded.items()}
+
+
+class JsonCacheTest(CacheTest):
+
+    def test_load_missing_file(self):
+        self.assertEqual(cache.JsonCache(self.path).load(), {})
+
+    def test_save_and_load(self):
+        cache.JsonCache(self.path).save(header_cache())
+        self.assertEqual(cache.JsonCache(self.path).load(), header_cache())
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+
+class SqliteCacheTest(CacheTest):
+
+    def test_save_and_load(self):
+        self.open_sqlite().save(header_cache())
+        loaded = self.open_sqlite().load()
+        self.assertIsInstance(loaded['INBOX']['uids'], cache.SqliteUidMap)
+        self.assertEqual(self.plain(loaded), header_cache())
+
+    def test_save_replaces_messages_in_memory(self):
+        store = self.open_sqlite()
+        saved = header_cache()
+        store.save(saved)
+        self.assertIsInstance(saved['INBOX']['uids'], cache.SqliteUidMap)
+        self.assertEqual(self.plain(saved), header_cache())
+
+    def test_accounts_are_separate(self):
+        self.open_sqlite().save(header_cache())
+        self.assertEqual(self.open_sqlite(user='bob').load(), {})
+
+    def test_uidvalidity_change_drops_messages(self):
+        store = self.open_sqlite()
+        store.save(header_cache())
+        entry = store.load()['INBOX']
+        entry['uidvalidity'] = '8'
+        entry['uids'] = {'5': {'flags': [], 'headers': {'subject': 'new'}}}
+        store.save({'INBOX': entry})
+        loaded = self.open_sqlite().load()
+        self.assertEqual(loaded['INBOX']['uidvalidity'], '8')
+        self.assertEqual(list(loaded['INBOX']['uids']), ['5'])
+
+    def test_folders_without_uids_are_not_saved(self):
+        store = self.open_sqlite()
+        store.save({'INBOX': {'uidvalidity': '7'}})
+        self.assertEqual(store.load(), {})
+
+    def test_migrate_json(self):
+        cache.JsonCache(self.path).save(header_cache())
+        loaded = self.open_sqlite().load()
+        self.assertEqual(self.plain(loaded), header_cache())
+        # The JSON cache is kept under a new name.
+        with open(self.path + '.json') as f:
+            self.assertEqual(json.load(f), header_cache())
+        # It is only imported once.
+        os.remove(self.path + '.json')
+        self.assertEqual(self.plain(self.open_sqlite().load()),
+                         header_cache())
+
+
+class SqliteUidMapTest(CacheTest):
+
+    def setUp(self):
+        super(SqliteUidMapTest, self).setUp()
+        self.store = self.open_sqlite()
+        self.store.save(header_cache())
+        self.uids = self.store.load()['INBOX']['uids']
+
+    def reload(self):
+        self.store.save({})
+        return self.open_sqlite().load()['INBOX']['uids']
+
+    def test_mapping(self):
+        self.assertEqual(len(self.uids), 2)
+        self.assertEqual(list(self.uids), ['1', '2'])
+        self.assertIn('1', self.uids)
+        self.assertNotIn('3', self.uids)
+        self.assertEqual(self.uids['1']['flags'], ['\\Seen'])
+        self.assertEqual(self.uids['1']['headers']['subject'], 'one')
+        with self.assertRaises(KeyError):
+            self.uids['3']
+
+    def test_set_and_delete(self):
+        self.uids['10'] = {'flags': [], 'headers': {'subject': 'ten'}}
+        del self.uids['1']
+        with self.assertRaises(KeyError):
+            del self.uids['1']
+        uids = self.reload()
+        self.assertEqual(list(uids), ['2', '10'])
+        self.assertEqual(uids['10']['headers']['subject'], 'ten')
+
+    def test_assigning_flags_writes_through(self):
+        message = self.uids['2']
+        message['flags'] = ['\\Flagged']
+        self.assertEqual(message['flags'], ['\\Flagged'])
+        self.assertEqual(self.reload()['2']['flags'], ['\\Flagged'])
+
+    def test_assigning_headers_writes_through(self):
+        message = self.uids['2']
+        message['headers'] = dict(message['headers'], to='bob')
+        self.assertEqual(message['headers']['to'], 'bob')
+        self.assertEqual(dict(self.reload()['2']['headers']),
+                         {'subject': 'two', 'to': 'bob'})
+
+    def test_headers_are_read_only(self):
+        # Changes made in place would be lost, so they are refused.
+        with self.assertRaises(TypeError):
+            self.uids['2']['headers']['to'] = 'bob'
+        message = self.uids['2']
+        message['headers'] = {'subject': 'changed'}
+        with self.assertRaises(TypeError):
+            message['headers']['to'] = 'bob'
+
+    def test_values_are_copies(self):
+        self.uids['2']['flags'].append('\\Flagged')
+        self.assertEqual(self.uids['2']['flags'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,237 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import os
+import stat
+import tempfile
+import unittest
+
+from mailprocessing import delivery
+
+from smtpserver import SmtpServer, UnixSmtpServer
+
+SENDER = 'alice@example.com'
+RECIPIENTS = ['bob@example.com', 'carol@example.com']
+
+# A message written in chunks that split lines (and a CRLF) and use bare LF
+# and CR line endings, with lines that need dot-stuffing.
+CHUNKS = [b'Subject: test\n\n', b'.hidden\r', b'\n.. two\rlast', b' line']
+MESSAGE = b'Subject: test\r\n\r\n.hidden\r\n.. two\r\nlast line\r\n'
+
+
+class SmtpConnectionTest(unittest.TestCase):
+
+    def start_server(self, **kwargs):
+        server = SmtpServer(**kwargs).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def connect(self, url):
+        # Short timeout: a client not pipelining properly waits for replies
+        # the server holds back.
+        connection = delivery.SmtpConnection(url, timeout=5)
+        self.addCleanup(connection.close)
+        return connection
+
+    def deliver(self, connection, chunks=CHUNKS, recipients=RECIPIENTS):
+        message = connection.start(SENDER, recipients)
+        for chunk in chunks:
+            message.write(chunk)
+        message.finish()
+        return message
+
+    def test_parse_server(self):
+        self.assertEqual(delivery.parse_server('smtp://mx.example.com'),
+                         ('smtp', 'mx.example.com', None))
+        self.assertEqual(delivery.parse_server('lmtp://127.0.0.1:24'),
+                         ('lmtp', '127.0.0.1', 24))
+        self.assertEqual(delivery.parse_server('lmtp:/run/lmtp'),
+                         ('lmtp', '/run/lmtp', None))
+        for url in ('http://example.com', 'smtp:relative/path'):
+            with self.assertRaises(ValueError):
+                delivery.parse_server(url)
+
+    def test_deliver(self):
+        for pipelining in (True, False):
+            with self.subTest(pipelining=pipelining):
+                server = self.start_server(pipelining=pipelining)
+                connection = self.connect('smtp://127.0.0.1:%d' % server.port)
+                message = self.deliver(connection)
+                self.assertEqual(connection.pipelining, pipelining)
+                self.assertEqual(message.rejected, [])
+                self.assertEqual(server.messages,
+                                 [(SENDER, RECIPIENTS, MESSAGE)])
+                self.assertEqual(
+                    [command for command, args in server.commands],
+                    ['ehlo', 'mail', 'rcpt', 'rcpt', 'data'])
+
+    def test_message_ending_with_line_ending(self):
+        for end in (b'\n', b'\r', b'\r\n'):
+            with self.subTest(end=end):
+                server = self.start_server()
+                connection = self.connect('smtp://127.0.0.1:%d' % server.port)
+                self.deliver(connection, [b'Subject: test\n\nbody', end])
+                self.assertEqual(server.messages[0][2],
+                                 b'Subject: test\r\n\r\nbody\r\n')
+
+    def test_connection_is_reused(self):
+        server = self.start_server()
+        connection = self.connect('smtp://127.0.0.1:%d' % server.port)
+        for i in range(3):
+            self.deliver(connection)
+        self.assertEqual(len(server.messages), 3)
+        self.assertEqual(len(server.connections), 1)
+
+    def test_reconnect_after_server_dropped_connection(self):
+        server = self.start_server()
+        connection = self.connect('smtp://127.0.0.1:%d' % server.port)
+        self.deliver(connection)
+        server.drop_connections()
+        self.deliver(connection)
+        self.assertEqual(len(server.messages), 2)
+        self.assertEqual(len(server.connections), 2)
+
+    def test_rejected_recipient(self):
+        for pipelining in (True, False):
+            with self.subTest(pipelining=pipelining):
+                server = self.start_server(pipelining=pipelining,
+                                           refuse=[RECIPIENTS[1]])
+                connection = self.connect('smtp://127.0.0.1:%d' % server.port)
+                message = self.deliver(connection)
+                self.assertEqual(message.rejected,
+                                 [(RECIPIENTS[1],
+                                   (550, b'recipient refused'))])
+                self.assertEqual(server.messages,
+                                 [(SENDER, RECIPIENTS[:1], MESSAGE)])
+
+    def test_all_recipients_refused(self):
+        for pipelining in (True, False):
+            with self.subTest(pipelining=pipelining):
+                server = self.start_server(pipelining=pipelining,
+                                           refuse=RECIPIENTS[1:])
+                connection = self.connect('smtp://127.0.0.1:%d' % server.port)
+                with self.assertRaises(delivery.DeliveryError):
+                    connection.start(SENDER, RECIPIENTS[1:])
+                self.deliver(connection, recipients=RECIPIENTS[:1])
+                self.assertEqual(server.messages,
+                                 [(SENDER, RECIPIENTS[:1], MESSAGE)])
+
+    def test_sender_refused(self):
+        for pipelining in (True, False):
+            with self.subTest(pipelining=pipelining):
+                server = self.start_server(pipelining=pipelining,
+                                           refuse=[SENDER])
+                connection = self.connect('smtp://127.0.0.1:%d' % server.port)
+                with self.assertRaises(delivery.DeliveryError):
+                    connection.start(SENDER, RECIPIENTS)
+                self.assertEqual(server.messages, [])
+
+    def test_abort(self):
+        server = self.start_server()
+        connection = self.connect('smtp://127.0.0.1:%d' % server.port)
+        message = connection.start(SENDER, RECIPIENTS)
+        message.write(CHUNKS[0])
+        message.abort()
+        # The next message goes through a new connection.
+        self.deliver(connection)
+        self.assertEqual(server.messages, [(SENDER, RECIPIENTS, MESSAGE)])
+        self.assertEqual(len(server.connections), 2)
+
+    def test_lmtp(self):
+        server = self.start_server(lmtp=True)
+        connection = self.connect('lmtp://127.0.0.1:%d' % server.port)
+        self.deliver(connection)
+        self.assertEqual(server.messages, [(SENDER, RECIPIENTS, MESSAGE)])
+        self.assertEqual(server.commands[0][0], 'lhlo')
+
+    def test_lmtp_delivery_failure(self):
+        server = self.start_server(lmtp=True, fail=[RECIPIENTS[1]])
+        connection = self.connect('lmtp://127.0.0.1:%d' % server.port)
+        with self.assertRaises(delivery.DeliveryError) as cm:
+            self.deliver(connection)
+        self.assertIn(RECIPIENTS[1], str(cm.exception))
+        # All replies were read, so the connection is still in sync.
+        self.deliver(connection, recipients=RECIPIENTS[:1])
+        self.assertEqual(len(server.messages), 2)
+        self.assertEqual(len(server.connections), 1)
+
+    def test_unix_socket(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for scheme in delivery.SCHEMES:
+            with self.subTest(scheme=scheme):
+                path = os.path.join(directory.name, scheme)
+                server = UnixSmtpServer(path, lmtp=(scheme == 'lmtp'))
+                server.start()
+                self.addCleanup(server.stop)
+                connection = self.connect('%s:%s' % (scheme, path))
+                self.deliver(connection)
+                self.assertEqual(server.messages,
+                                 [(SENDER, RECIPIENTS, MESSAGE)])
+
+    def test_server_unreachable(self):
+        server = self.start_server()
+        url = 'smtp://127.0.0.1:%d' % server.port
+        server.stop()
+        with self.assertRaises(delivery.DeliveryError):
+            self.connect(url).start(SENDER, RECIPIENTS)
+
+
+class SendmailMessageTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.arguments = os.path.join(directory.name, 'arguments')
+        self.received = os.path.join(directory.name, 'received')
+        self.sendmail = os.path.join(directory.name, 'sendmail')
+        with open(self.sendmail, 'w') as fp:
+            fp.write('#!/bin/sh\n'
+                     'echo "$@" > %s\n'
+                     'cat > %s\n'
+                     'exit ${SENDMAIL_STATUS:-0}\n' % (self.arguments,
+                                                      self.received))
+        os.chmod(self.sendmail, stat.S_IRWXU)
+
+    def read(self, path):
+        with open(path, 'rb') as fp:
+            return fp.read()
+
+    def test_deliver(self):
+        message = delivery.SendmailMessage(self.sendmail, '-i', SENDER,
+                                           RECIPIENTS)
+        for chunk in CHUNKS:
+            message.write(chunk)
+        message.finish()
+        self.assertEqual(self.read(self.received), b''.join(CHUNKS))
+        self.assertEqual(self.read(self.arguments).decode('ascii').split(),
+                         ['-i', '-f', SENDER, '--'] + RECIPIENTS)
+
+    def test_failure(self):
+        os.environ['SENDMAIL_STATUS'] = '75'
+        self.addCleanup(os.environ.pop, 'SENDMAIL_STATUS')
+        message = delivery.SendmailMessage(self.sendmail, '-i', None,
+                                           RECIPIENTS)
+        message.write(CHUNKS[0])
+        with self.assertRaises(delivery.DeliveryError):
+            message.finish()
+
+
+if __name__ == '__main__':
+    unittest.main()
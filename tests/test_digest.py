@@ -0,0 +1,153 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from mailprocessing import digest
+
+
+class DigestCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.database = os.path.join(self.directory, 'digests')
+
+        # Counts the files actually read.
+        self.reads = 0
+        file_digest = digest.file_digest
+
+        def counting_file_digest(fp, algorithm):
+            self.reads += 1
+            return file_digest(fp, algorithm)
+
+        patcher = mock.patch.object(digest, 'file_digest',
+                                    counting_file_digest)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def open_cache(self, path=None):
+        cache = digest.DigestCache(path)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_hits_and_misses(self):
+        cache = self.open_cache()
+        path = self.write('mail', b'message')
+        expected = hashlib.sha1(b'message').hexdigest()
+        self.assertEqual(cache.digest(path, 'sha1'), expected)
+        self.assertEqual(cache.digest(path, 'sha1'), expected)
+        self.assertEqual(self.reads, 1)
+
+        # Renaming keeps the inode, so the digest is still cached.
+        renamed = os.path.join(self.directory, 'renamed')
+        os.rename(path, renamed)
+        self.assertEqual(cache.digest(renamed, 'sha1'), expected)
+        self.assertEqual(self.reads, 1)
+
+        # Other algorithms are cached separately.
+        self.assertEqual(cache.digest(renamed, 'md5'),
+                         hashlib.md5(b'message').hexdigest())
+        self.assertEqual(self.reads, 2)
+
+    def test_modified_file(self):
+        cache = self.open_cache()
+        path = self.write('mail', b'message')
+        cache.digest(path, 'sha1')
+        with open(path, 'r+b') as f:
+            f.write(b'MESSAGE')
+        # Same size, so only the modification time tells.
+        os.utime(path, ns=(0, 10 ** 9))
+        self.assertEqual(cache.digest(path, 'sha1'),
+                         hashlib.sha1(b'MESSAGE').hexdigest())
+        self.assertEqual(self.reads, 2)
+
+    def test_memory_size(self):
+        cache = self.open_cache()
+        paths = [self.write('mail%d' % i, b'message %d' % i)
+                 for i in range(3)]
+        with mock.patch.object(digest, 'MEMORY_SIZE', 2):
+            for path in paths:
+                cache.digest(path, 'sha1')
+            # The least recently used digest was dropped.
+            cache.digest(paths[2], 'sha1')
+            cache.digest(paths[1], 'sha1')
+            self.assertEqual(self.reads, 3)
+            cache.digest(paths[0], 'sha1')
+            self.assertEqual(self.reads, 4)
+
+    def test_persistent(self):
+        path = self.write('mail', b'message')
+        cache = self.open_cache(self.database)
+        cache.digest(path, 'sha1')
+        cache.close()
+
+        cache = self.open_cache(self.database)
+        self.assertEqual(cache.digest(path, 'sha1'),
+                         hashlib.sha1(b'message').hexdigest())
+        self.assertEqual(self.reads, 1)
+
+    def test_save_commits(self):
+        path = self.write('mail', b'message')
+        cache = self.open_cache(self.database)
+        cache.digest(path, 'sha1')
+        db = sqlite3.connect(self.database)
+        self.addCleanup(db.close)
+        count = "SELECT COUNT(*) FROM digests"
+        self.assertEqual(db.execute(count).fetchone()[0], 0)
+        cache.save()
+        self.assertEqual(db.execute(count).fetchone()[0], 1)
+
+    def test_expiry(self):
+        path = self.write('mail', b'message')
+        cache = self.open_cache(self.database)
+        cache.digest(path, 'sha1')
+        cache.close()
+
+        db = sqlite3.connect(self.database)
+        db.execute("UPDATE digests SET used = ?",
+                   (int(time.time()) - digest.EXPIRY - 1,))
+        db.commit()
+        db.close()
+
+        cache = self.open_cache(self.database)
+        cache.digest(path, 'sha1')
+        self.assertEqual(self.reads, 2)
+
+    def test_missing_file(self):
+        cache = self.open_cache()
+        with self.assertRaises(OSError):
+            cache.digest(os.path.join(self.directory, 'missing'), 'sha1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,244 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import imaplib
+import io
+import socket
+import threading
+import unittest
+from unittest import mock
+
+from mailprocessing import fetch
+
+HEADER = b'Subject: test\r\nFrom: alice@example.com\r\n\r\n'
+
+
+def reader(data):
+    """
+    Returns readline and read callables for read_response() reading data,
+    the way imaplib's _get_line() and read() would.
+    """
+    fp = io.BytesIO(data)
+    return (lambda: fp.readline().rstrip(b'\r\n')), fp.read
+
+
+class ScriptedImap(imaplib.IMAP4):
+    """
+    An imaplib connection to a server reading from a script: responses is a
+    list of byte strings, each sent in reply to a command with TAG replaced
+    by the command's tag. The server closes the connection after the last
+    one.
+    """
+
+    def __init__(self, responses):
+        self.responses = [b'* CAPABILITY IMAP4rev1\r\nTAG OK done\r\n'] + \
+            list(responses)
+        imaplib.IMAP4.__init__(self)
+        self.state = 'SELECTED'
+
+    def _create_socket(self, timeout):
+        client, server = socket.socketpair()
+        self.thread = threading.Thread(target=self._serve, args=(server,))
+        self.thread.start()
+        return client
+
+    def _serve(self, sock):
+        with sock, sock.makefile('rb') as fp:
+            sock.sendall(b'* OK scripted server ready\r\n')
+            for response in self.responses:
+                line = fp.readline()
+                if not line:
+                    return
+                tag = line.split(b' ', 1)[0]
+                sock.sendall(response.replace(b'TAG', tag))
+            sock.shutdown(socket.SHUT_RDWR)
+
+
+class ParseFetchTest(unittest.TestCase):
+
+    def test_atoms_and_lists(self):
+        attributes = fetch.parse_fetch(
+            [b'* 12 FETCH (UID 7 FLAGS (\\Seen \\Flagged) RFC822.SIZE 120)'])
+        self.assertEqual(attributes, {'UID': b'7',
+                                      'FLAGS': [b'\\Seen', b'\\Flagged'],
+                                      'RFC822.SIZE': b'120'})
+        self.assertEqual(fetch.flags(attributes), ['\\Seen', '\\Flagged'])
+        self.assertEqual(fetch.flags({'FLAGS': None}), [])
+        self.assertIsNone(fetch.body(attributes))
+
+    def test_quoted_strings_nil_and_nested_lists(self):
+        attributes = fetch.parse_fetch(
+            [b'* 1 FETCH (UID 1 ENVELOPE ("say \\"hi\\" \\\\o/" NIL '
+             b'("(not a list)" (NIL ""))) flags ())'])
+        self.assertEqual(attributes['ENVELOPE'],
+                         [b'say "hi" \\o/', None,
+                          [b'(not a list)', [None, b'']]])
+        # Item names are upper case.
+        self.assertEqual(attributes['FLAGS'], [])
+
+    def test_literals_in_list(self):
+        attributes = fetch.parse_fetch(
+            [(b'* 1 FETCH (UID 1 ENVELOPE ("date" {7}', b'sub)j"('),
+             (b' NIL {0}', b''),
+             b'))'])
+        self.assertEqual(attributes['ENVELOPE'],
+                         [b'date', b'sub)j"(', None, b''])
+
+    def test_header_fields(self):
+        attributes = fetch.parse_fetch(
+            [(b'* 1 FETCH (UID 1 BODY[HEADER.FIELDS (SUBJECT FROM)] {%d}'
+              % len(HEADER), HEADER),
+             b' body[]<0> "" BODY[HEADER.FIELDS.NOT (TO)] NIL)'])
+        self.assertEqual(attributes, {
+            'UID': b'1',
+            'BODY[HEADER.FIELDS (SUBJECT FROM)]': HEADER,
+            'BODY[]<0>': b'',
+            'BODY[HEADER.FIELDS.NOT (TO)]': None})
+        self.assertEqual(fetch.body(attributes), HEADER)
+
+    def test_malformed(self):
+        for parts in ([b'* 1 EXISTS'],
+                      [b'* 1 FETCH (UID)'],
+                      [b'* 1 FETCH (UID 1 FLAGS (\\Seen)'],
+                      [b'* 1 FETCH ((UID) 1)'],
+                      [b'* 1 FETCH (UID 1 "unterminated)']):
+            with self.subTest(parts=parts):
+                with self.assertRaises(ValueError):
+                    fetch.parse_fetch(parts)
+
+    def test_is_fetch(self):
+        self.assertTrue(fetch.is_fetch([b'* 1 FETCH (UID 1)']))
+        self.assertTrue(fetch.is_fetch([(b'* 1 fetch (BODY[] {0}', b''),
+                                        b')']))
+        self.assertFalse(fetch.is_fetch([b'* 1 EXISTS']))
+        self.assertFalse(fetch.is_fetch([b'* SEARCH 1 2']))
+
+
+class ReadResponseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chunks = []
+        patcher = mock.patch.object(fetch, 'CHUNK_SIZE', 4)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_literals(self):
+        readline, read = reader(
+            b'* 1 FETCH (UID 1 BODY[HEADER] {%d}\r\n' % len(HEADER) +
+            HEADER + b' BODY[TEXT] {4}\r\nbody)\r\n* 2 EXISTS\r\n')
+        self.assertEqual(fetch.read_response(readline, read),
+                         [(b'* 1 FETCH (UID 1 BODY[HEADER] {%d}'
+                           % len(HEADER), HEADER),
+                          (b' BODY[TEXT] {4}', b'body'),
+                          b')'])
+        self.assertEqual(fetch.read_response(readline, read),
+                         [b'* 2 EXISTS'])
+
+    def test_sink(self):
+        message = HEADER + b'body\r\n'
+        readline, read = reader(
+            b'* 1 FETCH (UID 1 BODY[HEADER] {4}\r\nhead'
+            b' BODY[] {%d}\r\n' % len(message) + message + b')\r\n')
+        parts = fetch.read_response(readline, read, self.chunks.append)
+        # Only complete bodies are streamed, in chunks of CHUNK_SIZE.
+        self.assertEqual(parts, [(b'* 1 FETCH (UID 1 BODY[HEADER] {4}',
+                                  b'head'),
+                                 (b' BODY[] {%d}' % len(message), b''),
+                                 b')'])
+        self.assertEqual(b''.join(self.chunks), message)
+        self.assertEqual(max(len(chunk) for chunk in self.chunks), 4)
+
+    def test_connection_closed_in_literal(self):
+        readline, read = reader(b'* 1 FETCH (UID 1 BODY[] {100}\r\n' +
+                                HEADER)
+        parts = fetch.read_response(readline, read, self.chunks.append)
+        self.assertEqual(b''.join(self.chunks), HEADER)
+        # The line that was never sent comes out empty.
+        self.assertEqual(parts, [(b'* 1 FETCH (UID 1 BODY[] {100}', b''),
+                                 b''])
+
+
+class ImaplibFetchTest(unittest.TestCase):
+
+    def connect(self, *responses):
+        imap = ScriptedImap(responses)
+        self.addCleanup(imap.thread.join)
+        self.addCleanup(imap.shutdown)
+        return imap
+
+    def test_untagged_responses(self):
+        imap = self.connect(
+            b'* 1 FETCH (UID 1 FLAGS ())\r\n'
+            b'* 3 EXISTS\r\n'
+            b'* 2 FETCH (UID 2 BODY[HEADER] {%d}\r\n' % len(HEADER) +
+            HEADER + b')\r\n'
+            b'* OK [HIGHESTMODSEQ 5] modified\r\n'
+            b'* 3 FETCH (UID 3 FLAGS (\\Seen))\r\n'
+            b'TAG OK done\r\n')
+        responses = [fetch.parse_fetch(parts) for parts in
+                     fetch.uid_fetch_imaplib(imap, [('1:3', '(FLAGS)')], 1)]
+        self.assertEqual([attributes['UID'] for attributes in responses],
+                         [b'1', b'2', b'3'])
+        self.assertEqual(fetch.body(responses[1]), HEADER)
+        # The other responses are stored the way imaplib stores them.
+        self.assertEqual(imap.untagged_responses['EXISTS'], [b'3'])
+        self.assertEqual(imap.untagged_responses['HIGHESTMODSEQ'], [b'5'])
+        self.assertNotIn('FETCH', imap.untagged_responses)
+        self.assertEqual(imap.tagged_commands, {})
+
+    def test_pipelined(self):
+        imap = self.connect(
+            b'* 1 FETCH (UID 1 FLAGS ())\r\nTAG OK done\r\n',
+            b'* 2 FETCH (UID 2 FLAGS ())\r\nTAG OK done\r\n',
+            b'* 3 FETCH (UID 3 FLAGS ())\r\nTAG OK done\r\n')
+        uids = [fetch.parse_fetch(parts)['UID'] for parts in
+                fetch.uid_fetch_imaplib(
+                    imap, [(uid, '(FLAGS)') for uid in '123'], 2)]
+        self.assertEqual(uids, [b'1', b'2', b'3'])
+
+    def test_failure(self):
+        imap = self.connect(b'TAG NO no such message\r\n')
+        with self.assertRaises(imap.error):
+            list(fetch.uid_fetch_imaplib(imap, [('1', '(FLAGS)')], 1))
+
+    def test_bye(self):
+        imap = self.connect(b'* 1 FETCH (UID 1 FLAGS ())\r\n'
+                            b'* BYE shutting down\r\n')
+        with self.assertRaises(imap.abort):
+            list(fetch.uid_fetch_imaplib(imap, [('1', '(FLAGS)')], 1))
+
+    def test_body_streamed(self):
+        chunks = []
+        imap = self.connect(b'* 1 FETCH (UID 1 BODY[] {%d}\r\n'
+                            % len(HEADER) + HEADER + b')\r\n'
+                            b'TAG OK done\r\n')
+        responses = fetch.uid_fetch_body_imaplib(imap, '1', chunks.append)
+        self.assertEqual(b''.join(chunks), HEADER)
+        self.assertEqual(fetch.body(fetch.parse_fetch(responses[0])), b'')
+
+    def test_connection_closed_in_body(self):
+        chunks = []
+        imap = self.connect(b'* 1 FETCH (UID 1 BODY[] {100}\r\n' + HEADER)
+        with self.assertRaises(imap.abort):
+            fetch.uid_fetch_body_imaplib(imap, '1', chunks.append)
+        self.assertEqual(b''.join(chunks), HEADER)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import errno
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from mailprocessing import filecopy
+
+MESSAGE = b'Subject: test\n\nbody\n'
+
+
+def unsupported(*args):
+    raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+
+
+class CopyFileTest(unittest.TestCase):
+    """
+    Forces each of copy_file()'s fallbacks by making the ways of copying
+    before it fail.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.source = os.path.join(directory.name, 'source')
+        self.target = os.path.join(directory.name, 'target')
+        with open(self.source, 'wb') as f:
+            f.write(MESSAGE)
+
+    def patch(self, name, *args, **kwargs):
+        patcher = mock.patch.object(*args, **kwargs)
+        setattr(self, name, patcher.start())
+        self.addCleanup(patcher.stop)
+
+    def no_link(self):
+        self.patch('link', os, 'link',
+                   side_effect=OSError(errno.EXDEV, "Cross-device link"))
+
+    def no_reflink(self):
+        self.patch('ioctl', filecopy.fcntl, 'ioctl', side_effect=unsupported)
+
+    def copy(self, strategy='link'):
+        method = filecopy.copy_file(self.source, self.target, strategy)
+        with open(self.target, 'rb') as f:
+            self.assertEqual(f.read(), MESSAGE)
+        return method
+
+    def test_link(self):
+        self.assertEqual(self.copy(), 'link')
+        self.assertTrue(os.path.samefile(self.source, self.target))
+
+    @unittest.skipUnless(sys.platform.startswith('linux'),
+                         "FICLONE is Linux only")
+    def test_reflink(self):
+        self.no_link()
+
+        # Pretend to clone by copying, so the target has the data.
+        def clone(target_fd, request, source_fd):
+            self.assertEqual(request, filecopy.FICLONE)
+            os.write(target_fd, os.pread(source_fd, len(MESSAGE), 0))
+            return 0
+        self.patch('ioctl', filecopy.fcntl, 'ioctl', side_effect=clone)
+        self.assertEqual(self.copy(), 'reflink')
+        self.assertEqual(self.ioctl.call_count, 1)
+        self.assertFalse(os.path.samefile(self.source, self.target))
+
+    @unittest.skipUnless(hasattr(os, 'copy_file_range'),
+                         "copy_file_range() is not available")
+    def test_copy_file_range(self):
+        self.no_link()
+        self.no_reflink()
+        self.assertEqual(self.copy(), 'copy_file_range')
+
+    @unittest.skipUnless(hasattr(os, 'sendfile'),
+                         "sendfile() is not available")
+    def test_sendfile(self):
+        self.no_link()
+        self.no_reflink()
+        for effect in (unsupported, [0]):
+            with self.subTest(effect=effect):
+                if os.path.exists(self.target):
+                    os.unlink(self.target)
+                # Some file systems report nothing copied instead of an
+                # error.
+                with mock.patch.object(os, 'copy_file_range',
+                                       side_effect=effect, create=True):
+                    self.assertEqual(self.copy(), 'sendfile')
+
+    def test_read_write(self):
+        self.no_link()
+        self.no_reflink()
+        self.patch('copy_file_range', os, 'copy_file_range',
+                   side_effect=unsupported, create=True)
+        self.patch('sendfile', os, 'sendfile', side_effect=unsupported,
+                   create=True)
+        self.assertEqual(self.copy(), 'read/write')
+
+    def test_copy_strategies(self):
+        self.patch('link', os, 'link', wraps=os.link)
+        self.patch('ioctl', filecopy.fcntl, 'ioctl', side_effect=unsupported)
+        for strategy, reflinks in (('reflink', True), ('copy', False)):
+            with self.subTest(strategy=strategy):
+                if os.path.exists(self.target):
+                    os.unlink(self.target)
+                self.ioctl.reset_mock()
+                self.assertNotEqual(self.copy(strategy), 'link')
+                self.assertFalse(self.link.called)
+                self.assertEqual(self.ioctl.called, reflinks and
+                                 sys.platform.startswith('linux'))
+
+    def test_failure_removes_target(self):
+        self.no_link()
+        self.patch('ioctl', filecopy.fcntl, 'ioctl',
+                   side_effect=OSError(errno.EIO, "I/O error"))
+        with self.assertRaises(OSError):
+            filecopy.copy_file(self.source, self.target)
+        self.assertFalse(os.path.exists(self.target))
+
+    @unittest.skipUnless(hasattr(os, 'copy_file_range'),
+                         "copy_file_range() is not available")
+    def test_partial_copy_is_not_retried(self):
+        self.no_link()
+        self.no_reflink()
+
+        def copy_some(source_fd, target_fd, count, offset_src, offset_dst):
+            if offset_src:
+                raise OSError(errno.EXDEV, "Cross-device link")
+            os.pwrite(target_fd, os.pread(source_fd, 4, 0), 0)
+            return 4
+
+        self.patch('copy_file_range', os, 'copy_file_range',
+                   side_effect=copy_some)
+        with self.assertRaises(OSError):
+            filecopy.copy_file(self.source, self.target)
+        self.assertFalse(os.path.exists(self.target))
+
+    def test_existing_target(self):
+        with open(self.target, 'wb') as f:
+            f.write(b'other')
+        for strategy in filecopy.STRATEGIES:
+            with self.subTest(strategy=strategy):
+                with self.assertRaises(FileExistsError):
+                    filecopy.copy_file(self.source, self.target, strategy)
+                with open(self.target, 'rb') as f:
+                    self.assertEqual(f.read(), b'other')
+
+
+if __name__ == '__main__':
+    unittest.main()
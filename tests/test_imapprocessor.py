@@ -0,0 +1,662 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import base64
+import contextlib
+import io
+import os
+import select
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+from mailprocessing import cache
+from mailprocessing import signals
+from mailprocessing.processor.imap import ImapProcessor
+
+import imapserver
+from imapserver import ImapServer
+
+# "Grüße vom Spam", encoded as header fields have to be.
+GREETINGS = '=?utf-8?q?Gr=C3=BC=C3=9Fe?= vom Spam'
+
+
+def message(subject, **fields):
+    """
+    Returns a message with the header fields subject and fields (with
+    underscores in their names turned into dashes).
+    """
+    header = "Subject: %s\r\n" % subject
+    for name, value in sorted(fields.items()):
+        header += "%s: %s\r\n" % (name.replace('_', '-').title(), value)
+    return (header + "\r\nbody of %s\r\n" % subject).encode('utf-8')
+
+
+class ImapProcessorTest(unittest.TestCase):
+    """
+    Runs ImapProcessor against an ImapServer started for every test.
+    """
+
+    def setUp(self):
+        self.server = self.start_server()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.addCleanup(self.reset_signals)
+
+    def start_server(self, **kwargs):
+        server = ImapServer(**kwargs).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def reset_signals(self):
+        signals.signal_received = None
+        signals.signal_event.clear()
+
+    def processor(self, **kwargs):
+        """
+        Returns an ImapProcessor logged in on the server. Unless kwargs say
+        otherwise, iterating over it runs a single pass.
+        """
+        args = dict(user='user', password='secret', host='127.0.0.1',
+                    port=self.server.port, use_ssl=False, insecure=False,
+                    certfile=None, interval=1, log_level=1,
+                    folders=['INBOX'], header_batchsize=10,
+                    flag_batchsize=10, run_once=False, scheduled=True)
+        args.update(kwargs)
+        # MailProcessor announces the log level on stdout.
+        with contextlib.redirect_stdout(io.StringIO()):
+            processor = ImapProcessor('-', io.StringIO(), **args)
+        self.addCleanup(processor.close)
+        return processor
+
+    def when_idling(self, func):
+        """
+        Invokes func in a thread of its own once a client waits in IDLE.
+        """
+        server = self.server
+
+        def run():
+            deadline = time.time() + 5
+            while time.time() < deadline:
+                with server.lock:
+                    if server.idling:
+                        break
+                time.sleep(0.01)
+            func()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def commands(self, *names):
+        """
+        Returns the commands (and UID commands) named in names the server
+        received so far, and forgets all commands received.
+        """
+        with self.server.lock:
+            commands = [(name, args) for name, args in self.server.commands
+                        if name in names
+                        or name == 'uid' and args[0].lower() in names]
+            del self.server.commands[:]
+        return commands
+
+    def subjects(self, mailbox):
+        """
+        Returns the subjects of the messages in mailbox on the server.
+        """
+        with self.server.lock:
+            messages = self.server.mailboxes[mailbox].messages.values()
+            return sorted(m.header_fields(['subject']).decode('utf-8')
+                          .split(': ', 1)[1].strip() for m in messages)
+
+    def header_fetches(self):
+        """
+        Returns the header downloads among the commands the server received
+        so far (see commands()).
+        """
+        return [args for name, args in self.commands('fetch')
+                if 'BODY.PEEK[HEADER' in str(args[2])]
+
+
+class MissingHeadersTest(ImapProcessorTest):
+
+    def test_missing_headers_are_cached(self):
+        for backend in cache.BACKENDS:
+            with self.subTest(backend=backend):
+                self.server = self.start_server()
+                path = os.path.join(self.directory, backend)
+                for i in range(3):
+                    self.server.add_message(
+                        'INBOX', message('message %d' % i,
+                                         list_id='list%d.example' % i))
+                kwargs = dict(cache_file=path, cache_backend=backend)
+
+                # The first pass caches the headers without List-Id.
+                processor = self.processor(**kwargs)
+                processor.header_fields = []
+                self.assertEqual(len(list(processor)), 3)
+
+                # The second one finds them missing when it is asked for.
+                processor = self.processor(**kwargs)
+                processor.header_fields = []
+                self.commands()
+                list_ids = [str(mail['list-id']) for mail in processor]
+                self.assertEqual(list_ids, ['list0.example', 'list1.example',
+                                            'list2.example'])
+                # One download for all messages.
+                self.assertEqual(len(self.header_fetches()), 1)
+
+                store = cache.open_cache(backend, path, '127.0.0.1', 'user')
+                self.addCleanup(store.close)
+                entry = store.load()['INBOX']
+                self.assertIn('list-id', entry['header_fields'])
+                self.assertEqual(
+                    [entry['uids'][uid]['headers']['list-id']
+                     for uid in entry['uids']],
+                    ['list0.example', 'list1.example', 'list2.example'])
+
+
+class SelectTest(ImapProcessorTest):
+
+    def test_changed_folder_is_selected_once(self):
+        path = os.path.join(self.directory, 'cache')
+        self.server.add_message('INBOX', message('first'))
+        for subject in ('second', 'third'):
+            self.commands()
+            list(self.processor(cache_file=path))
+            self.assertEqual([args for name, args in self.commands('select')],
+                             [['INBOX']])
+            self.server.add_message('INBOX', message(subject))
+
+    def test_unchanged_folders_are_not_selected(self):
+        for capabilities, queries in (
+                (imapserver.CAPABILITIES, ['status', 'status']),
+                (imapserver.CAPABILITIES + ('LIST-STATUS',), ['list'])):
+            with self.subTest(capabilities=capabilities):
+                self.server = self.start_server(capabilities=capabilities)
+                self.server.create_mailbox('Archive')
+                self.server.add_message('INBOX', message('first'))
+                # Without a cache file, no flags need to be refreshed, so
+                # only the header cache update selects folders.
+                processor = self.processor(folders=['INBOX', 'Archive'])
+                processor._update_header_cache()
+                self.commands()
+                for mailbox, expected in (('Archive', ['Archive']),
+                                          ('INBOX', ['INBOX']),
+                                          (None, [])):
+                    if mailbox is not None:
+                        self.server.add_message(mailbox, message('new'))
+                    processor._update_header_cache()
+                    commands = self.commands('status', 'list', 'select')
+                    # Folders are listed for other reasons as well.
+                    self.assertEqual([name for name, args in commands
+                                      if name == 'status'
+                                      or 'RETURN' in args], queries)
+                    self.assertEqual([args for name, args in commands
+                                      if name == 'select'],
+                                     [[name] for name in expected])
+                self.assertEqual(
+                    len(processor.header_cache['Archive']['uids']), 1)
+                self.assertEqual(
+                    len(processor.header_cache['INBOX']['uids']), 2)
+
+
+class FlagsTest(ImapProcessorTest):
+
+    def flag_fetches(self):
+        return [args for name, args in self.commands('fetch')
+                if args[2] in ('FLAGS', ['FLAGS'])]
+
+    def test_flags_are_not_fetched_twice(self):
+        path = os.path.join(self.directory, 'cache')
+        self.server.add_message('INBOX', message('first'))
+        # The first pass downloads headers and flags at once.
+        list(self.processor(cache_file=path))
+        self.assertEqual(self.flag_fetches(), [])
+        # Later ones refresh the flags of cached messages.
+        list(self.processor(cache_file=path))
+        self.assertEqual(len(self.flag_fetches()), 1)
+
+
+class CacheFileTest(ImapProcessorTest):
+
+    def test_cache_is_loaded_once_per_session(self):
+        processor = self.processor(cache_file=os.path.join(self.directory,
+                                                           'cache'),
+                                   keep_alive=True)
+        loads = []
+        load_cache = processor._load_cache
+
+        def count_loads():
+            loads.append(True)
+            return load_cache()
+
+        processor._load_cache = count_loads
+        self.server.add_message('INBOX', message('first'))
+        self.assertTrue(processor._update_header_cache())
+        self.server.add_message('INBOX', message('second'))
+        self.assertTrue(processor._update_header_cache())
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(list(processor.header_cache['INBOX']['uids']),
+                         ['1', '2'])
+
+        # After logging out, the cache file is read again.
+        processor.clean_sleep()
+        processor.reconnect_all()
+        self.assertTrue(processor._update_header_cache())
+        self.assertEqual(len(loads), 2)
+        self.assertEqual(list(processor.header_cache['INBOX']['uids']),
+                         ['1', '2'])
+
+
+class RulesTest(ImapProcessorTest):
+
+    def setUp(self):
+        super(RulesTest, self).setUp()
+        self.server.create_mailbox('Junk')
+        for subject in ('hello', GREETINGS, 'cheap spam'):
+            self.server.add_message('INBOX', message(subject))
+
+    def searches(self):
+        return [args[1:] for name, args in self.commands('search')]
+
+    def test_rule_evaluated_by_server(self):
+        processor = self.processor()
+        processor.rule(header='Subject', contains='spam').move('Junk')
+        self.assertEqual([str(mail['subject']) for mail in processor],
+                         ['hello'])
+        self.assertIn(['UID', '1:3', 'HEADER', 'Subject', 'spam'],
+                      self.searches())
+        self.assertEqual(self.subjects('INBOX'), ['hello'])
+        self.assertEqual(self.subjects('Junk'), [GREETINGS, 'cheap spam'])
+
+    def test_rule_evaluated_locally(self):
+        processor = self.processor()
+        processor.header_fields = []
+        processor.rule(header='Subject', contains='grüße').move('Junk')
+        processor.rule(header='Subject', contains='cheap').delete()
+        self.assertEqual([str(mail['subject']) for mail in processor],
+                         ['hello'])
+        # Neither rule went to the server: the second one has to be
+        # evaluated after the first one.
+        self.assertEqual([args for args in self.searches()
+                          if 'HEADER' in args], [])
+        self.assertEqual(self.subjects('INBOX'), ['hello'])
+        self.assertEqual(self.subjects('Junk'), [GREETINGS])
+
+    def test_dry_run(self):
+        path = os.path.join(self.directory, 'cache')
+        for expected, downloaded in ((['hello'], '1,2,3'),
+                                     (['hello', 'news'], '4')):
+            processor = self.processor(cache_file=path, dry_run=True,
+                                       scheduled=False)
+            processor.rule(header='Subject', contains='spam').move('Junk')
+            subjects = []
+            with self.assertRaises(SystemExit):
+                for mail in processor:
+                    subjects.append(str(mail['subject']))
+            # The rule was not applied, but its matches are left out.
+            self.assertEqual(subjects, expected)
+            self.assertEqual(self.subjects('Junk'), [])
+            # They are cached like the rest, so the next pass only
+            # downloads the new message.
+            self.assertEqual([args[1] for args in self.header_fetches()],
+                             [downloaded])
+            self.server.add_message('INBOX', message('news'))
+
+
+class ActionsTest(ImapProcessorTest):
+
+    def setUp(self):
+        super(ActionsTest, self).setUp()
+        self.add_messages()
+
+    def add_messages(self):
+        for mailbox in ('Archive', 'Junk'):
+            self.server.create_mailbox(mailbox)
+        for i in range(1, 6):
+            self.server.add_message('INBOX', message('message %d' % i))
+
+    def process(self, act, **kwargs):
+        """
+        Runs a pass, invoking act with every mail and its UID.
+        """
+        processor = self.processor(**kwargs)
+        self.commands()
+        for mail in processor:
+            act(mail, int(mail.uid))
+
+    def uid_commands(self, *names):
+        return [args for name, args in self.commands(*names)
+                if name == 'uid']
+
+    def test_moves_are_grouped(self):
+        def act(mail, uid):
+            if uid < 5:
+                mail.move('Archive' if uid % 2 else 'Junk')
+
+        self.process(act, action_batchsize=100)
+        self.assertEqual(
+            sorted(self.uid_commands('move', 'copy', 'store', 'expunge')),
+            [['MOVE', '1,3', 'Archive'], ['MOVE', '2,4', 'Junk']])
+        self.assertEqual(self.subjects('Archive'),
+                         ['message 1', 'message 3'])
+        self.assertEqual(self.subjects('Junk'), ['message 2', 'message 4'])
+        self.assertEqual(self.subjects('INBOX'), ['message 5'])
+
+    def test_batch_size(self):
+        for batchsize, uid_sets in ((0, ['1', '2', '3', '4', '5']),
+                                    (2, ['1:2', '3:4', '5']),
+                                    (100, ['1:5'])):
+            with self.subTest(batchsize=batchsize):
+                self.server = self.start_server()
+                self.add_messages()
+                self.process(lambda mail, uid: mail.move('Junk'),
+                             action_batchsize=batchsize)
+                self.assertEqual([args[1] for args in
+                                  self.uid_commands('move')], uid_sets)
+                self.assertEqual(len(self.subjects('Junk')), 5)
+
+    def test_copy_creating_folder(self):
+        self.process(lambda mail, uid: mail.copy('Later', create=True),
+                     action_batchsize=100)
+        self.assertEqual([(name, args) for name, args
+                          in self.commands('copy', 'create')],
+                         [('uid', ['COPY', '1:5', 'Later']),
+                          ('create', ['Later']),
+                          ('uid', ['COPY', '1:5', 'Later'])])
+        self.assertEqual(len(self.subjects('Later')), 5)
+        self.assertEqual(len(self.subjects('INBOX')), 5)
+
+    def test_copy_without_creating_folder(self):
+        with contextlib.redirect_stderr(io.StringIO()):
+            with self.assertRaises(SystemExit) as cm:
+                self.process(lambda mail, uid: mail.copy('Later'),
+                             action_batchsize=100)
+        self.assertEqual(cm.exception.code, 1)
+        self.assertEqual(self.commands('create'), [])
+        self.assertNotIn('Later', self.server.mailboxes)
+
+    def test_delete(self):
+        self.process(lambda mail, uid: uid in (1, 3) and mail.delete(),
+                     action_batchsize=100)
+        self.assertEqual(self.uid_commands('store', 'expunge'),
+                         [['STORE', '1,3', '+FLAGS.SILENT', ['\\Deleted']],
+                          ['EXPUNGE', '1,3']])
+        self.assertEqual(self.subjects('INBOX'),
+                         ['message 2', 'message 4', 'message 5'])
+
+    def test_delete_without_uidplus(self):
+        self.server = self.start_server(capabilities=('IMAP4rev1', 'MOVE'))
+        self.add_messages()
+        self.process(lambda mail, uid: uid in (1, 3) and mail.delete(),
+                     action_batchsize=100)
+        self.assertEqual(self.commands('store', 'expunge'),
+                         [('uid', ['STORE', '1,3', '+FLAGS.SILENT',
+                                   ['\\Deleted']]),
+                          ('expunge', [])])
+        self.assertEqual(self.subjects('INBOX'),
+                         ['message 2', 'message 4', 'message 5'])
+
+    def test_move_without_move(self):
+        self.server = self.start_server(capabilities=('IMAP4rev1',
+                                                      'UIDPLUS'))
+        self.add_messages()
+        self.process(lambda mail, uid: uid < 3 and mail.move('Junk'),
+                     action_batchsize=100)
+        self.assertEqual(
+            self.uid_commands('move', 'copy', 'store', 'expunge'),
+            [['COPY', '1:2', 'Junk'],
+             ['STORE', '1:2', '+FLAGS.SILENT', ['\\Deleted']],
+             ['EXPUNGE', '1:2']])
+        self.assertEqual(self.subjects('Junk'), ['message 1', 'message 2'])
+        self.assertEqual(len(self.subjects('INBOX')), 3)
+
+
+class IncrementalTest(ImapProcessorTest):
+
+    def setUp(self):
+        super(IncrementalTest, self).setUp()
+        self.add_messages()
+
+    def add_messages(self):
+        for i in range(1, 4):
+            self.server.add_message('INBOX', message('message %d' % i))
+
+    def process(self, **kwargs):
+        """
+        Runs a pass and returns the subjects of the mails processed.
+        """
+        processor = self.processor(incremental=True, **kwargs)
+        return [str(mail['subject']) for mail in processor]
+
+    def watermark(self, cache_file, cache_backend):
+        store = cache.open_cache(cache_backend, cache_file, '127.0.0.1',
+                                 'user')
+        try:
+            return store.load()['INBOX']['watermark']
+        finally:
+            store.close()
+
+    def test_watermark(self):
+        for backend in cache.BACKENDS:
+            with self.subTest(backend=backend):
+                self.server = self.start_server()
+                self.add_messages()
+                kwargs = dict(cache_file=os.path.join(self.directory,
+                                                      backend),
+                              cache_backend=backend)
+                self.assertEqual(self.process(**kwargs),
+                                 ['message 1', 'message 2', 'message 3'])
+                self.assertEqual(self.watermark(**kwargs), 3)
+                self.assertEqual(self.process(**kwargs), [])
+
+                uid = self.server.add_message('INBOX', message('new'))
+                self.assertEqual(self.process(**kwargs), ['new'])
+                self.assertEqual(self.watermark(**kwargs), uid)
+                self.assertEqual(self.process(**kwargs), [])
+
+    def test_uidvalidity_change(self):
+        path = os.path.join(self.directory, 'cache')
+        self.assertEqual(len(self.process(cache_file=path)), 3)
+        with self.server.lock:
+            self.server.mailboxes['INBOX'].uidvalidity += 1
+        # The old watermark means nothing now.
+        self.assertEqual(len(self.process(cache_file=path)), 3)
+        self.assertEqual(self.process(cache_file=path), [])
+
+    def test_flag_changes(self):
+        for reprocess, expected in ((False, []), (True, ['message 2'])):
+            with self.subTest(reprocess_flag_changes=reprocess):
+                self.server = self.start_server()
+                self.add_messages()
+                path = os.path.join(self.directory, str(reprocess))
+                kwargs = dict(cache_file=path,
+                              reprocess_flag_changes=reprocess)
+                self.process(**kwargs)
+                with self.server.lock:
+                    flags = self.server.mailboxes['INBOX'].messages[2].flags
+                    flags.symmetric_difference_update(['\\Seen'])
+                self.assertEqual(self.process(**kwargs), expected)
+                # Only once.
+                self.assertEqual(self.process(**kwargs), [])
+
+
+class CompressTest(ImapProcessorTest):
+
+    def setUp(self):
+        super(CompressTest, self).setUp()
+        # Large enough to take many reads, and hardly compressible.
+        self.large = message('large').replace(
+            b'body of large', base64.encodebytes(os.urandom(200000)))
+
+    def compressing_server(self, capabilities=imapserver.CAPABILITIES +
+                           ('COMPRESS=DEFLATE',)):
+        self.server = self.start_server(capabilities=capabilities)
+        self.server.create_mailbox('Junk')
+        for subject in ('hello', 'cheap spam'):
+            self.server.add_message('INBOX', message(subject))
+        self.server.add_message('INBOX', self.large)
+
+    def test_round_trip(self):
+        for use_asyncio in (False, True):
+            with self.subTest(asyncio=use_asyncio):
+                self.compressing_server()
+                processor = self.processor(compress=True,
+                                           asyncio=use_asyncio)
+                self.assertEqual(self.commands('compress'),
+                                 [('compress', ['DEFLATE'])])
+
+                chunks = []
+                processor.select('INBOX')
+                self.assertTrue(processor.fetch_message('3', chunks.append))
+                self.assertEqual(b''.join(chunks), self.large)
+
+                processor.rule(header='Subject', contains='spam').move('Junk')
+                self.assertEqual(sorted(str(mail['subject'])
+                                        for mail in processor),
+                                 ['hello', 'large'])
+                self.assertEqual(self.subjects('Junk'), ['cheap spam'])
+
+    def test_idle(self):
+        self.compressing_server()
+        processor = self.processor(compress=True)
+        server = self.server
+        self.when_idling(lambda: server.add_message('INBOX', message('new')))
+        start = time.time()
+        self.assertTrue(processor.idle('INBOX', 10))
+        self.assertLess(time.time() - start, 5)
+        processor.noop()
+
+    def test_not_supported(self):
+        self.compressing_server(capabilities=imapserver.CAPABILITIES)
+        processor = self.processor(compress=True)
+        self.assertEqual(self.commands('compress'), [])
+        self.assertEqual(len(list(processor)), 3)
+
+
+class IdleTest(ImapProcessorTest):
+
+    def idle_processor(self, **kwargs):
+        """
+        Returns a processor on a new server with three messages in INBOX.
+        """
+        self.server = self.start_server()
+        for i in range(3):
+            self.server.add_message('INBOX', message('message %d' % i))
+        processor = self.processor(**kwargs)
+        self.commands()
+        return processor
+
+    def idle_commands(self):
+        return [name for name, args in self.commands('idle', 'done',
+                                                     'logout')]
+
+    def assertWokenUp(self, change):
+        """
+        Asserts that change, invoked with the server, ends IDLE long before
+        its timeout.
+        """
+        for use_asyncio in (False, True):
+            with self.subTest(asyncio=use_asyncio):
+                processor = self.idle_processor(asyncio=use_asyncio)
+                server = self.server
+                self.when_idling(lambda: change(server))
+                start = time.time()
+                self.assertTrue(processor.idle('INBOX', 10))
+                self.assertLess(time.time() - start, 5)
+                self.assertEqual(self.idle_commands(), ['idle', 'done'])
+
+    def test_new_message(self):
+        self.assertWokenUp(
+            lambda server: server.add_message('INBOX', message('new')))
+
+    def test_expunged_message(self):
+        self.assertWokenUp(
+            lambda server: server.expunge_message('INBOX', 2))
+
+    def test_vanished_message(self):
+        self.assertWokenUp(
+            lambda server: server.expunge_message('INBOX', 2, vanished=True))
+
+    def test_timeout(self):
+        for use_asyncio in (False, True):
+            with self.subTest(asyncio=use_asyncio):
+                processor = self.idle_processor(asyncio=use_asyncio)
+                start = time.time()
+                self.assertFalse(processor.idle('INBOX', 0.3))
+                self.assertGreaterEqual(time.time() - start, 0.3)
+                # IDLE was ended with DONE, so the session is usable again.
+                self.assertEqual(self.idle_commands(), ['idle', 'done'])
+                processor.noop()
+                self.assertEqual(len(self.commands('noop')), 1)
+
+    def test_changes_in_other_folders_are_ignored(self):
+        processor = self.idle_processor()
+        self.server.create_mailbox('Archive')
+        server = self.server
+        self.when_idling(
+            lambda: server.add_message('Archive', message('archived')))
+        self.assertFalse(processor.idle('INBOX', 0.5))
+
+    def test_sigterm(self):
+        for use_asyncio in (False, True):
+            with self.subTest(asyncio=use_asyncio):
+                self.reset_signals()
+                processor = self.idle_processor(asyncio=use_asyncio,
+                                                idle=True, scheduled=False,
+                                                interval=60)
+                self.when_idling(
+                    lambda: signals.handler(signal.SIGTERM, None))
+                start = time.time()
+                mails = []
+                with self.assertRaises(SystemExit) as cm:
+                    for mail in processor:
+                        mails.append(mail)
+                self.assertEqual(cm.exception.code, 0)
+                self.assertEqual(len(mails), 3)
+                self.assertLess(time.time() - start, 10)
+                self.assertEqual(self.idle_commands(),
+                                 ['idle', 'done', 'logout'])
+
+    def test_input_pending(self):
+        processor = self.idle_processor()
+        processor.select('INBOX')
+        sock = processor.imap.socket()
+        self.assertFalse(processor._input_pending(sock))
+
+        tag = processor.imap._command('UID', 'SEARCH', 'ALL')
+        # Let the untagged and the tagged response arrive, so reading the
+        # first buffers the second.
+        time.sleep(0.2)
+        self.assertEqual(processor.imap._get_line(), b'* SEARCH 1 2 3')
+        self.assertEqual(select.select([sock], [], [], 0)[0], [])
+        self.assertTrue(processor._input_pending(sock))
+
+        processor.imap._command_complete('UID', tag)
+        self.assertFalse(processor._input_pending(sock))
+        # Checking did not change the socket's timeout.
+        self.assertIsNone(sock.gettimeout())
+
+
+if __name__ == '__main__':
+    unittest.main()
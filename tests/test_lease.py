@@ -0,0 +1,162 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from mailprocessing import lease
+
+NAMES = ['alice', 'bob', 'carol', 'dave']
+
+
+class LeaseManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.messages = []
+
+    def manager(self, node, names=NAMES, timeout=60):
+        return lease.LeaseManager(self.directory, names, node=node,
+                                  timeout=timeout, log=self.messages.append)
+
+    def read_lease(self, name):
+        with open(os.path.join(self.directory,
+                               name + lease.LEASE_SUFFIX), 'rb') as f:
+            return lease._parse_lease(f.read())
+
+    def write_lease(self, name, owner, expires):
+        with open(os.path.join(self.directory,
+                               name + lease.LEASE_SUFFIX), 'w') as f:
+            f.write("%s %.3f\n" % (owner, expires))
+
+    def test_claim(self):
+        manager = self.manager('node1')
+        before = time.time()
+        manager.renew()
+        self.assertEqual(sorted(manager.held), NAMES)
+        for name in NAMES:
+            owner, expires = self.read_lease(name)
+            self.assertEqual(owner, 'node1')
+            self.assertAlmostEqual(expires, manager.held[name], places=2)
+            # Lease files hold milliseconds.
+            self.assertGreaterEqual(expires, before + 60 - 0.001)
+            with manager.holding(name) as held:
+                self.assertTrue(held)
+
+    def test_leases_of_others_are_not_claimed(self):
+        self.write_lease('alice', 'node2', time.time() + 60)
+        # An expired lease is up for grabs.
+        self.write_lease('bob', 'node3', time.time() - 1)
+        manager = self.manager('node1')
+        manager.renew()
+        self.assertEqual(sorted(manager.held), NAMES[1:])
+        self.assertFalse(manager.holds('alice'))
+        self.assertEqual(self.read_lease('bob')[0], 'node1')
+
+    def test_renew(self):
+        manager = self.manager('node1')
+        manager.renew()
+        # Pretend the leases were about to expire.
+        for name in NAMES:
+            manager.held[name] = time.time() + 1
+        manager.renew()
+        for name in NAMES:
+            self.assertGreater(manager.held[name], time.time() + 30)
+            self.assertAlmostEqual(self.read_lease(name)[1],
+                                   manager.held[name], places=2)
+
+    def test_lost_lease(self):
+        manager = self.manager('node1')
+        manager.renew()
+        self.write_lease('alice', 'node2', time.time() + 60)
+        manager.renew()
+        self.assertNotIn('alice', manager.held)
+        self.assertIn("==> Lost lease for account alice", self.messages)
+
+    def test_expired_lease_is_not_held(self):
+        manager = self.manager('node1')
+        manager.renew()
+        manager.held['alice'] = time.time() - 1
+        with manager.holding('alice') as held:
+            self.assertFalse(held)
+        self.assertFalse(manager.holds('alice'))
+        self.assertTrue(manager.holds('bob'))
+
+    def test_renew_failure(self):
+        manager = self.manager('node1', timeout=0.3)
+        manager.renew()
+
+        def fail():
+            raise OSError("lease directory unreachable")
+
+        manager._share = fail
+        thread = threading.Thread(target=manager._run)
+        thread.start()
+        try:
+            deadline = time.time() + 5
+            while manager.held and time.time() < deadline:
+                time.sleep(0.05)
+        finally:
+            manager._stopped.set()
+            thread.join()
+        self.assertEqual(manager.held, {})
+        self.assertIn("Error: Renewing leases failed: lease directory "
+                      "unreachable", self.messages)
+        for name in NAMES:
+            with manager.holding(name) as held:
+                self.assertFalse(held)
+
+    def test_rebalance(self):
+        first = self.manager('node1')
+        first.renew()
+        self.assertEqual(len(first.held), 4)
+
+        # A second node joins. All leases are taken, so it has to wait for
+        # the first node to hand over its surplus.
+        second = self.manager('node2')
+        second.renew()
+        self.assertEqual(second.held, {})
+
+        # Accounts being processed are not handed over.
+        busy = sorted(first.held)[0]
+        with first.holding(busy) as held:
+            self.assertTrue(held)
+            first.renew()
+        self.assertEqual(len(first.held), 2)
+        self.assertIn(busy, first.held)
+
+        second.renew()
+        self.assertEqual(len(second.held), 2)
+        self.assertEqual(sorted(list(first.held) + list(second.held)),
+                         NAMES)
+
+        # When the second node stops, the first one takes over again.
+        second.stop()
+        self.assertEqual(second.held, {})
+        first.renew()
+        self.assertEqual(sorted(first.held), NAMES)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,326 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import contextlib
+import errno
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from mailprocessing import inotify
+from mailprocessing.mail.maildir import MaildirMail
+from mailprocessing.processor.maildir import MaildirProcessor
+
+MESSAGE = b'Subject: test\n\nbody\n'
+
+
+class MaildirProcessorTest(unittest.TestCase):
+    """
+    Runs MaildirProcessor on a maildir in a temporary directory.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.base = directory.name
+        for subdir in ('cur', 'new', 'tmp'):
+            os.makedirs(os.path.join(self.base, 'inbox', subdir))
+        self.log = io.StringIO()
+        self.deliveries = 0
+
+    def processor(self, **kwargs):
+        args = dict(log_level=1, run_once=False, incremental=False,
+                    inotify=False)
+        args.update(kwargs)
+        # MailProcessor announces the log level on stdout.
+        with contextlib.redirect_stdout(io.StringIO()):
+            processor = MaildirProcessor('-', self.log, **args)
+        processor.maildir_base = self.base
+        processor.maildirs = ['inbox']
+        return processor
+
+    def iterate(self, processor):
+        """
+        Returns an iterator over processor yielding the names of the mail
+        files the rc file gets to see.
+        """
+        mails = iter(processor)
+        self.addCleanup(mails.close)
+        return (os.path.basename(mail.path) for mail in mails)
+
+    def path(self, subdir, name):
+        return os.path.join(self.base, 'inbox', subdir, name)
+
+    def deliver(self):
+        """
+        Delivers a message to new, the way maildir wants it. Returns its
+        name.
+        """
+        self.deliveries += 1
+        name = '%d.test.localhost' % self.deliveries
+        with open(self.path('tmp', name), 'wb') as f:
+            f.write(MESSAGE)
+        os.rename(self.path('tmp', name), self.path('new', name))
+        return name
+
+    def rename(self, name, flags):
+        """
+        Moves mail name from new to cur, or renames it within cur, giving
+        it the flags flags. Returns its new name.
+        """
+        old = self.path('new', name)
+        if not os.path.exists(old):
+            old = self.path('cur', name)
+        new_name = name.partition(':2,')[0] + ':2,' + flags
+        os.rename(old, self.path('cur', new_name))
+        return new_name
+
+
+class InotifyTest(MaildirProcessorTest):
+
+    def setUp(self):
+        super(InotifyTest, self).setUp()
+        try:
+            inotify.Inotify().close()
+        except OSError as e:
+            self.skipTest("inotify is not available: %s" % e)
+
+    def test_existing_and_arriving_mail(self):
+        first = self.deliver()
+        mails = self.iterate(self.processor(inotify=True))
+        self.assertEqual(next(mails), first)
+        second = self.deliver()
+        self.assertEqual(next(mails), second)
+
+    def test_mail_being_written_is_not_picked_up(self):
+        first = self.deliver()
+        mails = self.iterate(self.processor(inotify=True))
+        self.assertEqual(next(mails), first)
+        name = 'written.in.place'
+        with open(self.path('new', name), 'wb') as f:
+            f.write(MESSAGE[:10])
+            f.flush()
+            # The file is still open, so the next mail is yielded first.
+            delivered = self.deliver()
+            self.assertEqual(next(mails), delivered)
+            f.write(MESSAGE[10:])
+        self.assertEqual(next(mails), name)
+
+    def test_linked_mail(self):
+        first = self.deliver()
+        mails = self.iterate(self.processor(inotify=True))
+        self.assertEqual(next(mails), first)
+        with open(self.path('tmp', 'linked'), 'wb') as f:
+            f.write(MESSAGE)
+        os.link(self.path('tmp', 'linked'), self.path('new', 'linked'))
+        self.assertEqual(next(mails), 'linked')
+
+    def test_fallback_to_polling(self):
+        first = self.deliver()
+        with mock.patch.object(inotify, 'Inotify',
+                               side_effect=OSError("no inotify")):
+            mails = self.iterate(self.processor(inotify=True,
+                                                incremental=True))
+            self.assertEqual(next(mails), first)
+        self.assertIn("inotify is not available (no inotify); falling back "
+                      "to polling", self.log.getvalue())
+        second = self.deliver()
+        self.assertEqual(next(mails), second)
+
+
+class PollingTest(MaildirProcessorTest):
+
+    def test_run_once(self):
+        names = sorted([self.deliver(), self.deliver()])
+        self.assertEqual(sorted(self.iterate(self.processor(run_once=True))),
+                         names)
+
+    def test_arriving_mail(self):
+        first = self.deliver()
+        mails = self.iterate(self.processor(incremental=True))
+        self.assertEqual(next(mails), first)
+        second = self.deliver()
+        self.assertEqual(next(mails), second)
+
+
+class IncrementalTest(MaildirProcessorTest):
+
+    def scan(self, processor):
+        paths = [os.path.join(self.base, 'inbox', subdir)
+                 for subdir in ('cur', 'new')]
+        return sorted(os.path.basename(mail.path)
+                      for mail in processor._scan('inbox', paths))
+
+    def test_scan(self):
+        processor = self.processor(incremental=True)
+        first, second = self.deliver(), self.deliver()
+        self.assertEqual(self.scan(processor), [first, second])
+        # Processed mail is remembered by hashed keys, not by name.
+        self.assertEqual(processor._processed['inbox'],
+                         {processor._mail_key(first),
+                          processor._mail_key(second)})
+
+        # Renamed mail is not processed again, removed mail is forgotten.
+        self.rename(first, 'S')
+        os.remove(self.path('new', second))
+        third = self.deliver()
+        self.assertEqual(self.scan(processor), [third])
+        self.assertNotIn(processor._mail_key(second),
+                         processor._processed['inbox'])
+        self.assertEqual(self.scan(processor), [])
+
+        # Mail coming back after it was forgotten is processed again.
+        with open(self.path('new', second), 'wb') as f:
+            f.write(MESSAGE)
+        self.assertEqual(self.scan(processor), [second])
+
+    def test_scan_reprocessing_flag_changes(self):
+        processor = self.processor(incremental=True,
+                                   reprocess_flag_changes=True)
+        first = self.deliver()
+        self.assertEqual(self.scan(processor), [first])
+        # Moving mail to cur without changing its flags changes nothing.
+        first = self.rename(first, '')
+        self.assertEqual(self.scan(processor), [])
+        first = self.rename(first, 'S')
+        self.assertEqual(self.scan(processor), [first])
+
+    def test_removal_is_deferred(self):
+        processor = self.processor(incremental=True)
+        first = self.deliver()
+        arrived = [('inbox', first, self.path('new', first))]
+        self.assertEqual(processor._unprocessed(arrived, []), arrived)
+        key = processor._mail_key(first)
+
+        # A rename reported in two batches: first the removal under the old
+        # name, then the arrival under the new one.
+        renamed = self.rename(first, 'S')
+        self.assertEqual(processor._unprocessed([], [('inbox', first)]), [])
+        self.assertIn(key, processor._processed['inbox'])
+        self.assertEqual(processor._unprocessed(
+            [('inbox', renamed, self.path('cur', renamed))], []), [])
+        self.assertIn(key, processor._processed['inbox'])
+
+        # Mail that does not arrive again in the next batch is forgotten.
+        os.remove(self.path('cur', renamed))
+        processor._unprocessed([], [('inbox', renamed)])
+        self.assertIn(key, processor._processed['inbox'])
+        processor._unprocessed([], [])
+        self.assertNotIn(key, processor._processed['inbox'])
+
+    def test_renamed_mail_with_inotify(self):
+        try:
+            inotify.Inotify().close()
+        except OSError as e:
+            self.skipTest("inotify is not available: %s" % e)
+        first = self.deliver()
+        mails = self.iterate(self.processor(inotify=True, incremental=True))
+        self.assertEqual(next(mails), first)
+        self.rename(first, 'S')
+        second = self.deliver()
+        self.assertEqual(next(mails), second)
+
+
+class MoveAcrossDevicesTest(MaildirProcessorTest):
+
+    def setUp(self):
+        super(MoveAcrossDevicesTest, self).setUp()
+        for subdir in ('cur', 'new', 'tmp'):
+            os.makedirs(os.path.join(self.base, 'archive', subdir))
+        self.source = self.path('new', self.deliver())
+        os.utime(self.source, ns=(10 ** 9, 2 * 10 ** 9))
+        self.target = os.path.join(self.base, 'archive', 'new', 'moved')
+        self.tmp = os.path.join(self.base, 'archive', 'tmp')
+
+    def rename_across_devices(self, processor):
+        """
+        Renames the source to the target with processor, as if they were
+        on different file systems.
+        """
+        rename = os.rename
+
+        def cross_device_rename(source, target):
+            if source == self.source:
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            return rename(source, target)
+
+        with mock.patch.object(os, 'rename',
+                               side_effect=cross_device_rename):
+            with mock.patch.object(os, 'link', side_effect=OSError(
+                    errno.EXDEV, "Invalid cross-device link")):
+                processor.rename(self.source, self.target)
+
+    def test_move(self):
+        self.rename_across_devices(self.processor())
+        self.assertFalse(os.path.exists(self.source))
+        with open(self.target, 'rb') as f:
+            self.assertEqual(f.read(), MESSAGE)
+        self.assertEqual(os.stat(self.target).st_mtime_ns, 2 * 10 ** 9)
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_failed_move(self):
+        processor = self.processor()
+        with mock.patch.object(os, 'utime',
+                               side_effect=OSError(errno.EIO, "I/O error")):
+            with self.assertRaises(OSError):
+                self.rename_across_devices(processor)
+        # The copy is removed, the original kept.
+        self.assertTrue(os.path.exists(self.source))
+        self.assertFalse(os.path.exists(self.target))
+        self.assertEqual(os.listdir(self.tmp), [])
+
+
+class HeaderTest(MaildirProcessorTest):
+
+    def parse(self, data, limit=1024):
+        path = self.path('new', 'mail')
+        with open(path, 'wb') as f:
+            f.write(data)
+        processor = self.processor()
+        processor.max_header_size = limit
+        return MaildirMail(processor, maildir='inbox', mail_path=path)
+
+    def test_header_only_is_parsed(self):
+        mail = self.parse(b'Subject: =?utf-8?q?Gr=C3=BC=C3=9Fe?=\r\n'
+                          b'X-Folded: one\r\n two\r\n\r\n'
+                          b'Subject: not a header\r\n')
+        self.assertEqual(str(mail['subject']), 'Grüße')
+        self.assertEqual(str(mail['x-folded']), 'one\n two')
+        self.assertNotIn('Error', self.log.getvalue())
+
+    def test_header_at_limit(self):
+        data = b'Subject: test\nTo: bob@example.com\n\n'
+        mail = self.parse(data + b'body\n', limit=len(data))
+        self.assertEqual(str(mail['to']), 'bob@example.com')
+        self.assertNotIn('Error', self.log.getvalue())
+
+    def test_truncated_header(self):
+        mail = self.parse(b'Subject: test\nTo: bob@example.com\n\nbody\n',
+                          limit=20)
+        self.assertEqual(str(mail['subject']), 'test')
+        # The field cut off is parsed as far as it was read.
+        self.assertEqual(str(mail['to']), 'bo')
+        self.assertIn("Header of %s exceeds 20 bytes" %
+                      ascii(self.path('new', 'mail')), self.log.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import unittest
+
+from mailprocessing.rule import Rule
+
+
+class RuleTest(unittest.TestCase):
+
+    def test_invalid_rules(self):
+        for kwargs in ({}, {'header': 'subject'}, {'contains': 'spam'},
+                       {'header': 'subject', 'contains': ''},
+                       {'folder': 'INBOX'}):
+            with self.subTest(kwargs=kwargs):
+                with self.assertRaises(ValueError):
+                    Rule(**kwargs)
+
+    def test_search_criteria(self):
+        for kwargs, criteria in (
+                ({'header': 'Subject', 'contains': 'spam'},
+                 'HEADER "Subject" "spam"'),
+                ({'header': 'Subject', 'contains': 'say "hi" \\o/'},
+                 'HEADER "Subject" "say \\"hi\\" \\\\o/"'),
+                ({'seen': True}, 'SEEN'),
+                ({'seen': False}, 'UNSEEN'),
+                ({'flagged': True}, 'FLAGGED'),
+                ({'flagged': False}, 'UNFLAGGED'),
+                ({'header': 'From', 'contains': 'alice', 'seen': True,
+                  'flagged': False},
+                 'HEADER "From" "alice" SEEN UNFLAGGED')):
+            with self.subTest(kwargs=kwargs):
+                self.assertEqual(Rule(**kwargs).search_criteria(), criteria)
+
+    def test_search_criteria_not_quotable(self):
+        # The server would compare these against the encoded header field.
+        for header, contains in (('Subject', 'Grüße'), ('Subject', 'a\tb'),
+                                 ('Betreff', 'spam\r\n')):
+            with self.subTest(contains=contains):
+                rule = Rule(header=header, contains=contains, seen=True)
+                self.assertIsNone(rule.search_criteria())
+
+    def test_matches(self):
+        headers = {'subject': 'Grüße and SPAM', 'from': 'alice'}
+        for kwargs, flags, expected in (
+                ({'header': 'Subject', 'contains': 'spam'}, [], True),
+                ({'header': 'Subject', 'contains': 'grüße'}, [], True),
+                ({'header': 'Subject', 'contains': 'ham'}, [], False),
+                ({'header': 'To', 'contains': 'bob'}, [], False),
+                ({'seen': True}, ['\\Seen'], True),
+                ({'seen': True}, [], False),
+                ({'seen': False}, [], True),
+                ({'flagged': False}, ['\\Flagged'], False),
+                ({'header': 'From', 'contains': 'alice', 'flagged': True},
+                 ['\\Seen', '\\Flagged'], True)):
+            with self.subTest(kwargs=kwargs, flags=flags):
+                self.assertEqual(Rule(**kwargs).matches(headers, flags),
+                                 expected)
+
+    def test_actions(self):
+        rule = Rule(seen=True)
+        self.assertFalse(rule.removes)
+        self.assertIs(rule.copy('Archive'), rule)
+        self.assertFalse(rule.removes)
+        rule.move('Old', create=True)
+        self.assertTrue(rule.removes)
+        self.assertEqual(rule.actions, [('copy', 'Archive', False),
+                                        ('move', 'Old', True)])
+        # Nothing is left to act upon after a move or delete.
+        with self.assertRaises(ValueError):
+            rule.delete()
+
+    def test_applies_to(self):
+        self.assertTrue(Rule(seen=True).applies_to('INBOX'))
+        rule = Rule(seen=True, folder='INBOX')
+        self.assertTrue(rule.applies_to('INBOX'))
+        self.assertFalse(rule.applies_to('Archive'))
+
+    def test_str(self):
+        rule = Rule(header='Subject', contains='Grüße', seen=False)
+        self.assertEqual(str(rule),
+                         "header Subject contains 'Gr\\xfc\\xdfe', not seen")
+
+
+if __name__ == '__main__':
+    unittest.main()
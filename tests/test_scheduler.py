@@ -0,0 +1,159 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import signal
+import threading
+import time
+import unittest
+from unittest import mock
+
+from mailprocessing import scheduler
+from mailprocessing import signals
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(self.reset_signals)
+        self.errors = []
+        self.runs = []
+
+    def reset_signals(self):
+        signals.signal_received = None
+        signals.signal_event.clear()
+
+    def scheduler(self, workers=1, jitter=0):
+        return scheduler.Scheduler(workers, jitter, self.log_error)
+
+    def log_error(self, job, e):
+        self.errors.append((job, e))
+
+    def job(self, name, effect=None):
+        def job():
+            self.runs.append(name)
+            if effect is not None:
+                effect()
+        return job
+
+    def terminate_after(self, runs):
+        """
+        Returns a callable sending SIGTERM once it was invoked runs times.
+        """
+        calls = []
+
+        def terminate():
+            calls.append(None)
+            if len(calls) == runs:
+                signals.handler(signal.SIGTERM, None)
+        return terminate
+
+    def test_jobs_run_once(self):
+        sched = self.scheduler()
+        sched.add(self.job('a'))
+        sched.add(self.job('b'))
+        sched.run()
+        self.assertEqual(self.runs, ['a', 'b'])
+
+    def test_recurring_jobs_until_terminated(self):
+        sched = self.scheduler()
+        sched.add(self.job('a', self.terminate_after(3)), interval=0.01)
+        start = time.time()
+        sched.run()
+        self.assertEqual(self.runs, ['a', 'a', 'a'])
+        self.assertGreaterEqual(time.time() - start, 0.02)
+        self.assertLess(time.time() - start, scheduler.POLL_INTERVAL)
+
+    def test_interval_counts_from_end_of_run(self):
+        starts = []
+
+        def slow():
+            starts.append(time.time())
+            time.sleep(0.1)
+            if len(starts) == 2:
+                signals.handler(signal.SIGTERM, None)
+
+        sched = self.scheduler()
+        sched.add(slow, interval=0.1)
+        sched.run()
+        self.assertGreaterEqual(starts[1] - starts[0], 0.2)
+
+    def test_workers(self):
+        lock = threading.Lock()
+        running = []
+        most = []
+
+        def job():
+            with lock:
+                running.append(None)
+                most.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+
+        sched = self.scheduler(workers=2)
+        for i in range(6):
+            sched.add(job)
+        sched.run()
+        self.assertEqual(len(most), 6)
+        self.assertEqual(max(most), 2)
+
+    def test_errors(self):
+        def fail():
+            raise RuntimeError("failed")
+
+        def exit_cleanly():
+            raise SystemExit(0)
+
+        sched = self.scheduler()
+        failing = self.job('fail', fail)
+        exiting = self.job('exit', exit_cleanly)
+        sched.add(failing, interval=0.01)
+        sched.add(exiting)
+        sched.add(self.job('last', self.terminate_after(2)), interval=0.1)
+        sched.run()
+        # Failing jobs are logged and run again; a clean exit is not an
+        # error.
+        self.assertGreater(self.runs.count('fail'), 1)
+        self.assertEqual(self.runs.count('exit'), 1)
+        self.assertTrue(self.errors)
+        for job, e in self.errors:
+            self.assertIs(job, failing)
+            self.assertEqual(str(e), "failed")
+
+    def test_jitter(self):
+        with mock.patch.object(scheduler.random, 'uniform',
+                               return_value=0.1) as uniform:
+            sched = self.scheduler(jitter=5)
+            start = time.time()
+            sched.add(self.job('a'))
+            sched.run()
+        uniform.assert_called_once_with(0, 5)
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        self.assertEqual(self.runs, ['a'])
+
+    def test_terminated_before_run(self):
+        signals.handler(signal.SIGTERM, None)
+        sched = self.scheduler()
+        sched.add(self.job('a'))
+        sched.run()
+        self.assertEqual(self.runs, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8; mode: python -*-
+
+# Copyright (C) 2019 Johannes Grassler <johannes@btw23.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import os
+import tempfile
+import unittest
+
+from mailprocessing.util import read_header
+
+HEADER = b'Subject: test\nFrom: alice@example.com\n\n'
+
+
+class ReadHeaderTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'mail')
+
+    def read(self, data, limit=1024):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        return read_header(self.path, limit)
+
+    def test_header_and_body(self):
+        self.assertEqual(self.read(HEADER + b'body\n\nmore body\n'),
+                         (HEADER, False))
+
+    def test_crlf(self):
+        header = HEADER.replace(b'\n', b'\r\n')
+        self.assertEqual(self.read(header + b'body\r\n'), (header, False))
+
+    def test_header_only(self):
+        # Without an empty line, the whole file is the header.
+        self.assertEqual(self.read(HEADER[:-1]), (HEADER[:-1], False))
+        self.assertEqual(self.read(b''), (b'', False))
+
+    def test_header_at_limit(self):
+        for data in (HEADER, HEADER + b'body\n'):
+            with self.subTest(data=data):
+                self.assertEqual(self.read(data, limit=len(HEADER)),
+                                 (HEADER, False))
+        # A file ending at the limit is not truncated either.
+        self.assertEqual(self.read(HEADER[:-1], limit=len(HEADER) - 1),
+                         (HEADER[:-1], False))
+
+    def test_truncated_header(self):
+        # Cut off in the middle of a line...
+        self.assertEqual(self.read(HEADER + b'body\n', limit=10),
+                         (HEADER[:10], True))
+        # ...and right before the empty line ending the header.
+        self.assertEqual(self.read(HEADER, limit=len(HEADER) - 1),
+                         (HEADER[:-1], True))
+
+    def test_missing_file(self):
+        with self.assertRaises(OSError):
+            read_header(self.path, 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()